@@ -0,0 +1,68 @@
+# bloom.py
+# -*- coding: utf-8 -*-
+'''
+A fixed-size Bloom filter: a set that can answer "definitely not" or
+"probably", in a few bits per member, and that can't remove anything.
+'''
+
+from hashlib import md5
+from math import ceil, log
+import struct
+
+class BloomFilter(object):
+    '''
+    Args:
+        capacity (int): how many members it is sized for.
+        error_rate (float): the false positive rate at capacity. It gets
+            worse beyond that; see is_full().
+
+    Positions come from one md5 of the key, split into two 64 bit hashes and
+    combined as h1 + i*h2 (Kirsch and Mitzenmacher), so adding or testing a
+    key costs one hash however many positions there are.
+
+    Adding is not atomic: two threads setting bits in the same byte at once
+    can lose one of them. That makes a member look absent, so only use this
+    where a false "no" costs some work rather than a wrong answer.
+
+    Slots:
+        capacity (int)
+        n_bits (int)
+        n_hashes (int)
+        count (int): members added since the last clear().
+        _bits (bytearray)
+    '''
+    __slots__ = ('capacity', 'n_bits', 'n_hashes', 'count', '_bits')
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.n_bits = int(ceil(-self.capacity * log(error_rate) / log(2) ** 2))
+        self.n_hashes = max(1, int(round(self.n_bits * log(2) / self.capacity)))
+        self.count = 0
+        self._bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', md5(key).digest())
+        n_bits = self.n_bits
+        return [(h1 + i * h2) % n_bits for i in xrange(self.n_hashes)]
+
+    def add(self, key):
+        bits = self._bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self.count = 0
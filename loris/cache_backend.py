@@ -0,0 +1,477 @@
+# cache_backend.py
+# -*- coding: utf-8 -*-
+'''
+Where the caches keep what they keep. InfoCache (and BackendImageCache, in
+img.py) only talk to a Backend, so the storage can be chosen per deployment
+with `backend` in loris2.conf:
+
+ * 'fs' (FSBackend): a file per key, under a root directory, i.e. what the
+   caches have always done.
+ * 'memory' (MemoryBackend): a dict, per process and gone on restart; for
+   tests and benchmarks.
+ * 'sqlite' (SQLiteBackend): a table in an SQLite database, which suits many
+   small objects better than a file each.
+
+Keys are relative paths ('/'-separated str), e.g.
+`info/01/02/0001.jp2/info.json`, and values are str.
+'''
+
+from contextlib import contextmanager
+from errno import EEXIST, EINVAL, ENOENT, ENOTDIR, ENOTEMPTY
+from logging import getLogger
+from os import path, sep, getpid
+from threading import Lock, local
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+
+logger = getLogger(__name__)
+
+BACKENDS = ('fs', 'memory', 'sqlite')
+
+# get() with `since`, of something that hasn't changed since
+NOT_MODIFIED = object()
+
+class Backend(object):
+    '''The interface. Every method is safe to call from many threads, and,
+    but for MemoryBackend, many processes.
+    '''
+    __slots__ = ()
+
+    def put(self, key, data):
+        '''Store data under key, atomically: anyone else sees the old value
+        or the new one, never part of it.
+
+        Returns:
+            float: the new mtime (seconds since the epoch).
+        '''
+        raise NotImplementedError
+
+    def get(self, key, since=None):
+        '''
+        Args:
+            key (str)
+            since (float): an mtime.
+        Returns:
+            (str, float): the data and its mtime, None if there's nothing
+            under key, or NOT_MODIFIED if since is given and the mtime isn't
+            after it.
+        '''
+        raise NotImplementedError
+
+    def stat(self, key):
+        '''
+        Returns:
+            (int, float): the size and mtime, or None.
+        '''
+        raise NotImplementedError
+
+    def open(self, key):
+        '''
+        Returns:
+            iterable: the data, for a response body.
+        Raises:
+            IOError (ENOENT): if there's nothing under key.
+        '''
+        got = self.get(key)
+        if got is None:
+            raise IOError(ENOENT, 'Not in the cache', key)
+        return [got[0]]
+
+    def file_path(self, key):
+        '''
+        Returns:
+            str: the file that key is kept in, if it's kept in a file of its
+            own, else None.
+        '''
+        return None
+
+    def link(self, alias, key):
+        '''Make alias another name for key, which needn't be there yet. It
+        goes when key does.
+        '''
+        raise NotImplementedError
+
+    def resolve(self, key):
+        '''
+        Returns:
+            str: the key that key is a link to, or key itself.
+        '''
+        return key
+
+    def delete(self, keys):
+        '''
+        Returns:
+            int: how many of keys there were.
+        '''
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        '''Delete prefix and everything under `prefix/`, e.g. every
+        derivative of an identifier.
+
+        Returns:
+            int: how many keys that was.
+        '''
+        raise NotImplementedError
+
+    def stats(self):
+        '''
+        Returns:
+            dict: entries, bytes (what they add up to) and links.
+        '''
+        raise NotImplementedError
+
+
+class FSBackend(Backend):
+    '''A file per key, under root, and a symlink per link. Puts are written
+    to a temporary file beside the target and renamed into place. stats()
+    walks the whole tree, so isn't cheap.
+
+    Slots:
+        root (str)
+    '''
+    __slots__ = ('root',)
+
+    def __init__(self, root):
+        self.root = path.realpath(root)
+
+    def _fp(self, key):
+        fp = path.normpath(path.join(self.root, key))
+        if not fp.startswith(self.root + sep):
+            raise ValueError('%r is not under %s' % (key, self.root))
+        return fp
+
+    def put(self, key, data):
+        fp = self._fp(key)
+        dp, fn = path.split(fp)
+        _makedirs(dp)
+        tmp_fp = path.join(dp, '.%s.%s' % (uuid.uuid4().hex, fn))
+        try:
+            with open(tmp_fp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_fp, fp)
+        finally:
+            if path.exists(tmp_fp):
+                os.unlink(tmp_fp)
+        return path.getmtime(fp)
+
+    def get(self, key, since=None):
+        try:
+            with open(self._fp(key), 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                if since is not None and mtime <= since:
+                    return NOT_MODIFIED
+                return (f.read(), mtime)
+        except IOError as e:
+            if e.errno in (ENOENT, ENOTDIR):
+                return None
+            raise
+
+    def stat(self, key):
+        try:
+            st = os.stat(self._fp(key))
+        except OSError as e:
+            if e.errno in (ENOENT, ENOTDIR):
+                return None
+            raise
+        return (st.st_size, st.st_mtime)
+
+    def open(self, key):
+        return open(self._fp(key), 'rb')
+
+    def file_path(self, key):
+        return self._fp(key)
+
+    def link(self, alias, key):
+        alias_fp = self._fp(alias)
+        key_fp = self._fp(key)
+        if alias_fp == key_fp:
+            return
+        _makedirs(path.dirname(alias_fp))
+        if path.lexists(alias_fp):
+            os.unlink(alias_fp)
+        try:
+            os.symlink(key_fp, alias_fp)
+        except OSError as e:
+            if e.errno != EEXIST: # someone else just made it
+                raise
+
+    def resolve(self, key):
+        fp = self._fp(key)
+        try:
+            target = os.readlink(fp)
+        except OSError as e:
+            if e.errno in (EINVAL, ENOENT, ENOTDIR): # not a link
+                return key
+            raise
+        return path.relpath(path.join(path.dirname(fp), target), self.root)
+
+    def delete(self, keys):
+        deleted = 0
+        for key in keys:
+            fp = self._fp(key)
+            try:
+                os.unlink(fp)
+                deleted += 1
+            except OSError as e:
+                if e.errno not in (ENOENT, ENOTDIR):
+                    raise
+            self._prune(path.dirname(fp))
+        return deleted
+
+    def delete_prefix(self, prefix):
+        fp = self._fp(prefix)
+        if not path.isdir(fp) or path.islink(fp):
+            return self.delete((prefix,))
+        deleted = sum(len(fns) for _, _, fns in os.walk(fp))
+        shutil.rmtree(fp, ignore_errors=True)
+        self._prune(path.dirname(fp))
+        return deleted
+
+    def _prune(self, dp):
+        # Remove dp and its parents while they're empty, but never root.
+        while dp.startswith(self.root + sep):
+            try:
+                os.rmdir(dp)
+            except OSError as e:
+                if e.errno in (ENOTEMPTY, EEXIST, ENOENT):
+                    return
+                raise
+            dp = path.dirname(dp)
+
+    def stats(self):
+        stats = {'entries' : 0, 'bytes' : 0, 'links' : 0}
+        for dp, _, fns in os.walk(self.root):
+            for fn in fns:
+                fp = path.join(dp, fn)
+                if path.islink(fp):
+                    stats['links'] += 1
+                elif not fn.startswith('.'):
+                    stats['entries'] += 1
+                    stats['bytes'] += path.getsize(fp)
+        return stats
+
+
+class MemoryBackend(Backend):
+    '''A dict, for tests and benchmarks. It isn't bounded, and each process
+    has its own.
+
+    Slots:
+        _entries ({str: (str, float)}): key -> (data, mtime)
+        _links ({str: str}): alias -> key
+        _lock (Lock)
+    '''
+    __slots__ = ('_entries', '_links', '_lock')
+
+    def __init__(self):
+        self._entries = {}
+        self._links = {}
+        self._lock = Lock()
+
+    def _entry(self, key):
+        return self._entries.get(self._links.get(key, key))
+
+    def put(self, key, data):
+        mtime = time.time()
+        with self._lock:
+            self._entries[key] = (data, mtime)
+        return mtime
+
+    def get(self, key, since=None):
+        entry = self._entry(key)
+        if entry is not None and since is not None and entry[1] <= since:
+            return NOT_MODIFIED
+        return entry
+
+    def stat(self, key):
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        return (len(entry[0]), entry[1])
+
+    def link(self, alias, key):
+        if alias != key:
+            with self._lock:
+                self._links[alias] = key
+
+    def resolve(self, key):
+        return self._links.get(key, key)
+
+    def delete(self, keys):
+        deleted = 0
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    deleted += 1
+                self._links.pop(key, None)
+            self._drop_links()
+        return deleted
+
+    def delete_prefix(self, prefix):
+        under = prefix + '/'
+        with self._lock:
+            keys = [k for k in self._entries if k == prefix or k.startswith(under)]
+            for key in keys:
+                del self._entries[key]
+            for alias in [a for a in self._links if a == prefix or a.startswith(under)]:
+                del self._links[alias]
+            self._drop_links()
+        return len(keys)
+
+    def _drop_links(self):
+        # to keys that are gone; the caller holds _lock
+        for alias, key in self._links.items():
+            if key not in self._entries:
+                del self._links[alias]
+
+    def stats(self):
+        with self._lock:
+            return {'entries' : len(self._entries),
+                'bytes' : sum(len(d) for d, _ in self._entries.itervalues()),
+                'links' : len(self._links)}
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS links (
+    alias TEXT PRIMARY KEY,
+    key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_by_key ON links (key);
+'''
+
+# the key, or what it's a link to
+_RESOLVE = 'COALESCE((SELECT key FROM links WHERE alias = ?), ?)'
+
+class SQLiteBackend(Backend):
+    '''A row per key, in an SQLite database (in WAL mode, so readers don't
+    wait for writers), and one per link. Each put is a single statement,
+    and so atomic.
+
+    Slots:
+        db_fp (str)
+        _local (threading.local): a connection per thread (and process).
+    '''
+    __slots__ = ('db_fp', '_local')
+
+    def __init__(self, db_fp):
+        self.db_fp = db_fp
+        self._local = local()
+        _makedirs(path.dirname(path.abspath(db_fp)))
+
+    @property
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != getpid():
+            conn = sqlite3.connect(self.db_fp, timeout=60, isolation_level=None)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def put(self, key, data):
+        mtime = time.time()
+        self._db.execute('INSERT OR REPLACE INTO entries (key, data, size, mtime) '
+            'VALUES (?, ?, ?, ?)', (key, sqlite3.Binary(data), len(data), mtime))
+        return mtime
+
+    def get(self, key, since=None):
+        if since is not None:
+            row = self._db.execute('SELECT mtime FROM entries WHERE key = ' +
+                _RESOLVE, (key, key)).fetchone()
+            if row is None:
+                return None
+            if row[0] <= since:
+                return NOT_MODIFIED
+        row = self._db.execute('SELECT data, mtime FROM entries WHERE key = ' +
+            _RESOLVE, (key, key)).fetchone()
+        if row is None:
+            return None
+        return (str(row[0]), row[1])
+
+    def stat(self, key):
+        return self._db.execute('SELECT size, mtime FROM entries WHERE key = ' +
+            _RESOLVE, (key, key)).fetchone()
+
+    def link(self, alias, key):
+        if alias != key:
+            self._db.execute('INSERT OR REPLACE INTO links (alias, key) VALUES (?, ?)',
+                (alias, key))
+
+    def resolve(self, key):
+        return self._db.execute('SELECT ' + _RESOLVE, (key, key)).fetchone()[0]
+
+    def delete(self, keys):
+        deleted = 0
+        with self._transaction() as db:
+            for key in keys:
+                deleted += db.execute('DELETE FROM entries WHERE key = ?', (key,)).rowcount
+                db.execute('DELETE FROM links WHERE key = ? OR alias = ?', (key, key))
+        return deleted
+
+    def delete_prefix(self, prefix):
+        # prefix/ up to (not including) prefix0, '0' being the next after '/'
+        where = '%s = ? OR (%s >= ? AND %s < ?)'
+        args = (prefix, prefix + '/', prefix + '0')
+        with self._transaction() as db:
+            deleted = db.execute('DELETE FROM entries WHERE ' +
+                where % (('key',) * 3), args).rowcount
+            db.execute('DELETE FROM links WHERE ' + where % (('alias',) * 3), args)
+            db.execute('DELETE FROM links WHERE key NOT IN (SELECT key FROM entries)')
+        return deleted
+
+    def stats(self):
+        db = self._db
+        entries, n_bytes = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+            'FROM entries').fetchone()
+        links = db.execute('SELECT COUNT(*) FROM links').fetchone()[0]
+        return {'entries' : entries, 'bytes' : n_bytes, 'links' : links}
+
+
+def from_config(config, root, name):
+    '''The backend for a cache's section of loris2.conf, i.e. `backend` (one
+    of BACKENDS; 'fs' by default) and, for 'sqlite', `backend_fp`.
+
+    Args:
+        config (dict): the section.
+        root (str): the cache's cache_dp.
+        name (str): the database is <root>/<name>.sqlite by default.
+    '''
+    kind = config.get('backend', 'fs')
+    if kind == 'fs':
+        return FSBackend(root)
+    if kind == 'memory':
+        return MemoryBackend()
+    if kind == 'sqlite':
+        return SQLiteBackend(config.get('backend_fp') or
+            path.join(root, '%s.sqlite' % (name,)))
+    raise ValueError('Cache backend must be one of %s, not %r' % (BACKENDS, kind))
+
+def _makedirs(dp):
+    try:
+        os.makedirs(dp)
+    except OSError as e:
+        if e.errno != EEXIST:
+            raise
@@ -0,0 +1,62 @@
+# cache_layout.py
+# -*- coding: utf-8 -*-
+'''
+Where things about an identifier go under a cache root.
+
+'flat' is the original layout: a directory per identifier, right under the
+root, so a big collection means millions of entries in one directory.
+'sharded' puts that directory under two more, named for the first two and
+next three hex digits of the MD5 of the identifier (as
+SimpleHTTPResolver._ident_file_structure does for sources), e.g.
+`3f/a2c/01/02/0001.jp2/`, which spreads a million identifiers over about a
+million directories of one each rather than one of a million.
+'''
+
+from os import path, sep
+import hashlib
+
+FLAT = 'flat'
+SHARDED = 'sharded'
+LAYOUTS = (FLAT, SHARDED)
+
+def check(layout):
+    if layout not in LAYOUTS:
+        raise ValueError('Cache layout must be one of %s, not %r' % (LAYOUTS, layout))
+    return layout
+
+def _shard(ident):
+    if isinstance(ident, unicode):
+        ident = ident.encode('utf-8')
+    h = hashlib.md5(ident).hexdigest()
+    return path.join(h[0:2], h[2:5])
+
+def prefix(ident, layout):
+    '''
+    Args:
+        ident (str): the identifier, unquoted.
+        layout (str): one of LAYOUTS.
+    Returns:
+        str: the directories, relative to the root, that the identifier's own
+        directory goes in ('' for the flat layout).
+    '''
+    if layout == SHARDED:
+        return _shard(ident)
+    return ''
+
+def ident_dir(ident, layout):
+    '''The identifier's directory, relative to the root.
+    '''
+    return path.join(prefix(ident, layout), ident)
+
+def ident_of(rel_dir, layout):
+    '''The inverse of ident_dir().
+
+    Returns:
+        str: the identifier, or None if rel_dir isn't laid out that way.
+    '''
+    parts = rel_dir.split(sep)
+    looks_sharded = len(parts) > 2 and \
+        path.join(parts[0], parts[1]) == _shard(sep.join(parts[2:]))
+    if layout == SHARDED:
+        return sep.join(parts[2:]) if looks_sharded else None
+    return None if looks_sharded else rel_dir
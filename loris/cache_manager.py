@@ -0,0 +1,471 @@
+# cache_manager.py
+# -*- coding: utf-8 -*-
+'''
+Keeps the derivative cache (img.ImageCache) under a byte budget.
+
+Every derivative is recorded in an index, a SQLite database next to the
+cache, with its size, when it was last served and how often. Totals are kept
+up to date by triggers, so knowing how big the cache is never means walking
+it (no `du`), and knowing what to throw away never depends on atime (which
+is often mounted noatime). When the total goes over the high watermark,
+derivatives are deleted, least recently (LRU) or least frequently (LFU) used
+first, until it is under the low watermark, along with any symlinks from
+non-canonical requests that pointed at them.
+
+Loris records accesses in memory and writes them to the index in one
+transaction every `interval` seconds, evicting a batch at a time if need be
+(see maintain()). Alternatively, bin/loris-cache_manager does the evicting as
+a daemon. It can also sweep the whole tree (see sweep()), which indexes
+derivatives that were made before the index existed, forgets ones that have
+gone, and deletes dangling symlinks and empty directories.
+'''
+
+from constants import FORMATS_BY_EXTENSION
+from errno import ENOENT, ENOTEMPTY, EEXIST
+from logging import getLogger
+from os import path, getpid, lstat, rmdir, unlink, error as os_error
+from stat import S_ISLNK, S_ISREG
+from threading import Lock, local
+import os
+import sqlite3
+import sys
+import time
+
+logger = getLogger(__name__)
+
+INDEX_FILE_NAME = '.loris_cache_index.sqlite'
+
+POLICIES = ('lru', 'lfu')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_by_access ON files (last_access);
+CREATE INDEX IF NOT EXISTS files_by_hits ON files (hits, last_access);
+CREATE TABLE IF NOT EXISTS links (
+    path TEXT PRIMARY KEY,
+    target TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_by_target ON links (target);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (id, bytes, files) VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+    UPDATE totals SET bytes = bytes + NEW.size, files = files + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size, files = files - 1;
+END;
+CREATE TRIGGER IF NOT EXISTS files_resize AFTER UPDATE OF size ON files BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size + NEW.size;
+END;
+'''
+
+_ORDER_BY = {
+    'lru' : 'last_access',
+    'lfu' : 'hits, last_access'
+}
+
+class CacheManager(object):
+    '''
+    Slots:
+        cache_root (str): realpath of the ImageCache's cache_root.
+        index_fp (str): the SQLite database.
+        max_bytes (int): the budget.
+        high_water (float): evict once the cache is over this much of
+            max_bytes...
+        low_water (float): ...until it is down to this much.
+        policy (str): 'lru' or 'lfu'.
+        interval (float): seconds between writes to the index from maintain().
+        evict (bool): whether maintain() evicts, or leaves it to a daemon.
+        batch (int): derivatives deleted per transaction, and at most per
+            call to maintain().
+        max_pending (int): accesses kept in memory before they are written
+            regardless of interval.
+        _pending ({str: [size, last_access, hits]}): accesses not yet written.
+        _pending_links ({str: str}): symlinks not yet written, to their target.
+        _lock (Lock): guards the above.
+        _maintaining (Lock): so that only one thread at a time does maintain().
+        _last_flush (float)
+        _local (threading.local): a connection per thread (and process).
+    '''
+    __slots__ = ('cache_root', 'index_fp', 'max_bytes', 'high_water',
+        'low_water', 'policy', 'interval', 'evict', 'batch', 'max_pending',
+        '_pending', '_pending_links', '_lock', '_maintaining', '_last_flush',
+        '_local')
+
+    def __init__(self, cache_root, max_bytes, high_water=0.95, low_water=0.85,
+            policy='lru', index_fp=None, interval=5, evict=True, batch=500,
+            max_pending=10000):
+        if policy not in POLICIES:
+            raise ValueError('Eviction policy must be one of %s, not %r' % (POLICIES, policy))
+        if not 0 < low_water <= high_water:
+            raise ValueError('Need 0 < low_water <= high_water')
+        self.cache_root = path.realpath(cache_root)
+        self.index_fp = index_fp or path.join(self.cache_root, INDEX_FILE_NAME)
+        self.max_bytes = max_bytes
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+        self.interval = interval
+        self.evict = evict
+        self.batch = batch
+        self.max_pending = max_pending
+        self._pending = {}
+        self._pending_links = {}
+        self._lock = Lock()
+        self._maintaining = Lock()
+        self._last_flush = time.time()
+        self._local = local()
+
+    @property
+    def _db(self):
+        # sqlite3 connections can't be shared between threads, nor survive a
+        # fork (e.g. into WSGI worker processes).
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != getpid():
+            conn = sqlite3.connect(self.index_fp, timeout=60, isolation_level=None)
+            conn.text_factory = str # paths aren't necessarily ASCII
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = getpid()
+        return conn
+
+    def _rel(self, fp):
+        rel = path.relpath(fp, self.cache_root)
+        if rel.startswith(os.pardir):
+            return None
+        return rel
+
+    def touch(self, fp, size, now=None):
+        '''Record that the derivative at fp (its canonical path) was served.
+        This only costs a dict update; see maintain().
+        '''
+        rel = self._rel(fp)
+        if rel is None:
+            return
+        now = now or time.time()
+        with self._lock:
+            entry = self._pending.get(rel)
+            if entry is None:
+                self._pending[rel] = [size, now, 1]
+            else:
+                entry[0] = size
+                entry[1] = now
+                entry[2] += 1
+        self.maintain()
+
+    def link(self, link_fp, target_fp):
+        '''Record a symlink from a non-canonical request, so that it can be
+        deleted with its target.
+        '''
+        link_rel, target_rel = self._rel(link_fp), self._rel(target_fp)
+        if link_rel is None or target_rel is None:
+            return
+        with self._lock:
+            self._pending_links[link_rel] = target_rel
+
+    def maintain(self, force=False):
+        '''Every interval seconds (or when there's a lot of it), write what's
+        been recorded to the index, and if the cache is over the high
+        watermark (and evict is set), delete up to a batch of derivatives.
+
+        Returns:
+            bool: whether anything was done.
+        '''
+        if not force:
+            due = time.time() - self._last_flush >= self.interval
+            if not due and len(self._pending) < self.max_pending:
+                return False
+        if not self._maintaining.acquire(False):
+            return False # another thread is on it
+        try:
+            self._last_flush = time.time()
+            self.flush()
+            if self.evict and self.usage()[0] > self.max_bytes * self.high_water:
+                self.evict_to(self.max_bytes * self.low_water, max_files=self.batch)
+            return True
+        except sqlite3.Error:
+            # Losing track of some accesses is no reason to fail a request.
+            logger.exception('Could not update the cache index at %s' % (self.index_fp,))
+            return False
+        finally:
+            self._maintaining.release()
+
+    def flush(self):
+        '''Write recorded accesses and symlinks to the index, in one
+        transaction.
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            pending_links, self._pending_links = self._pending_links, {}
+        if not (pending or pending_links):
+            return
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT OR IGNORE INTO files (path, size, last_access) '
+                'VALUES (?, ?, ?)', ((k, v[0], v[1]) for k, v in pending.iteritems()))
+            db.executemany('UPDATE files SET size = ?, last_access = MAX(last_access, ?), '
+                'hits = hits + ? WHERE path = ?',
+                ((v[0], v[1], v[2], k) for k, v in pending.iteritems()))
+            db.executemany('INSERT OR REPLACE INTO links (path, target) VALUES (?, ?)',
+                pending_links.iteritems())
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def usage(self):
+        '''
+        Returns:
+            (int, int): bytes and files in the cache, per the index.
+        '''
+        return self._db.execute('SELECT bytes, files FROM totals').fetchone()
+
+    def evict_to(self, target_bytes, max_files=None):
+        '''Delete derivatives, in policy order, until the index says the cache
+        is at most target_bytes.
+
+        Args:
+            target_bytes (int)
+            max_files (int): stop after this many, even if still over.
+        Returns:
+            (int, int): files and bytes deleted.
+        '''
+        deleted_files, deleted_bytes = 0, 0
+        db = self._db
+        order = _ORDER_BY[self.policy]
+        while max_files is None or deleted_files < max_files:
+            limit = self.batch
+            if max_files is not None:
+                limit = min(limit, max_files - deleted_files)
+            # Rows are deleted before the files, in a transaction that takes
+            # the write lock straight away, so that two processes evicting at
+            # once pick different victims. A crash in between leaves files the
+            # index doesn't know about, which sweep() picks up again.
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                over = db.execute('SELECT bytes FROM totals').fetchone()[0] - target_bytes
+                if over <= 0:
+                    db.execute('COMMIT')
+                    break
+                victims, n_bytes = [], 0
+                for rel, size in db.execute('SELECT path, size FROM files '
+                        'ORDER BY %s LIMIT ?' % (order,), (limit,)).fetchall():
+                    victims.append(rel)
+                    n_bytes += size
+                    if n_bytes >= over:
+                        break
+                if not victims:
+                    db.execute('COMMIT')
+                    break
+                links = []
+                for rel in victims:
+                    links.extend(r[0] for r in db.execute(
+                        'SELECT path FROM links WHERE target = ?', (rel,)))
+                db.executemany('DELETE FROM files WHERE path = ?', ((r,) for r in victims))
+                db.executemany('DELETE FROM links WHERE path = ?', ((r,) for r in links))
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+            for rel in victims:
+                self._unlink(rel)
+            for rel in links:
+                self._unlink(rel, only_links=True)
+            deleted_files += len(victims)
+            deleted_bytes += n_bytes
+        if deleted_files:
+            logger.info('Evicted %d derivatives (%d bytes) from %s' %
+                (deleted_files, deleted_bytes, self.cache_root))
+        return (deleted_files, deleted_bytes)
+
+    def _unlink(self, rel, only_links=False):
+        fp = path.join(self.cache_root, rel)
+        try:
+            # the link may since have been replaced with something else
+            if only_links and not path.islink(fp):
+                return
+            unlink(fp)
+        except os_error as ose:
+            if ose.errno != ENOENT:
+                raise
+
+    def sweep(self, min_dir_age=60):
+        '''Walk the whole cache: index derivatives that aren't (as last used
+        at their mtime), forget ones that are gone, delete dangling symlinks,
+        and delete empty directories older than min_dir_age seconds (younger
+        ones may be about to get a derivative). This is what the old cron
+        script did on every run; here it's only needed now and then.
+
+        LFU hit counts are also halved, so that what was popular long ago
+        eventually makes way.
+
+        Returns:
+            dict: counts of what was found and done.
+        '''
+        self.flush()
+        stats = {'files' : 0, 'added' : 0, 'forgotten' : 0, 'links' : 0,
+            'dangling' : 0, 'dirs' : 0}
+        started = time.time()
+        db = self._db
+        db.execute('CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)')
+        db.execute('DELETE FROM seen')
+        found, found_links = [], []
+        for dp, dirnames, filenames in os.walk(self.cache_root, topdown=False):
+            for fn in filenames + dirnames:
+                if fn.startswith('.'):
+                    continue # the index, lock files and renders in progress
+                fp = path.join(dp, fn)
+                try:
+                    st = lstat(fp)
+                except os_error as ose:
+                    if ose.errno == ENOENT:
+                        continue
+                    raise
+                if S_ISLNK(st.st_mode):
+                    target = path.realpath(fp)
+                    if not path.exists(target):
+                        self._unlink(self._rel(fp), only_links=True)
+                        stats['dangling'] += 1
+                    elif self._rel(target) is not None:
+                        found_links.append((self._rel(fp), self._rel(target)))
+                        stats['links'] += 1
+                elif S_ISREG(st.st_mode) and fn.rsplit('.', 1)[-1] in FORMATS_BY_EXTENSION:
+                    found.append((self._rel(fp), st.st_size, st.st_mtime))
+                    stats['files'] += 1
+                if len(found) + len(found_links) >= self.batch:
+                    stats['added'] += self._record_sweep(found, found_links)
+                    found, found_links = [], []
+            if dp != self.cache_root and time.time() - _mtime(dp) > min_dir_age:
+                try:
+                    rmdir(dp)
+                    stats['dirs'] += 1
+                except os_error as ose:
+                    if ose.errno not in (ENOTEMPTY, EEXIST, ENOENT):
+                        raise
+        stats['added'] += self._record_sweep(found, found_links)
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Anything used since the sweep started was there.
+            cursor = db.execute('DELETE FROM files WHERE last_access < ? AND '
+                'path NOT IN (SELECT path FROM seen)', (started,))
+            stats['forgotten'] = cursor.rowcount
+            db.execute('DELETE FROM links WHERE target NOT IN (SELECT path FROM files)')
+            db.execute('UPDATE files SET hits = hits / 2')
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('DELETE FROM seen')
+        logger.info('Swept %s: %r' % (self.cache_root, stats))
+        return stats
+
+    def _record_sweep(self, found, found_links):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            before = db.execute('SELECT files FROM totals').fetchone()[0]
+            db.executemany('INSERT OR IGNORE INTO seen (path) VALUES (?)',
+                ((f[0],) for f in found))
+            db.executemany('INSERT OR IGNORE INTO files (path, size, last_access) '
+                'VALUES (?, ?, ?)', found)
+            db.executemany('UPDATE files SET size = ? WHERE path = ? AND size != ?',
+                ((f[1], f[0], f[1]) for f in found))
+            db.executemany('INSERT OR REPLACE INTO links (path, target) VALUES (?, ?)',
+                found_links)
+            added = db.execute('SELECT files FROM totals').fetchone()[0] - before
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        return added
+
+    def run_forever(self, interval=60, sweep_every=None):
+        '''The daemon: write what this process recorded (if anything), and
+        evict down to the low watermark, every interval seconds; sweep every
+        sweep_every seconds, if given.
+        '''
+        last_sweep = time.time()
+        while True:
+            if sweep_every and time.time() - last_sweep >= sweep_every:
+                self.sweep()
+                last_sweep = time.time()
+            self.flush()
+            if self.usage()[0] > self.max_bytes * self.high_water:
+                self.evict_to(self.max_bytes * self.low_water)
+            time.sleep(interval)
+
+
+def _mtime(fp):
+    try:
+        return path.getmtime(fp)
+    except os_error:
+        return 0
+
+def from_config(cache_dp, config):
+    '''
+    Args:
+        cache_dp (str): the ImageCache's root.
+        config (dict): the [img.ImageCache] section.
+    Returns:
+        CacheManager, or None if there's no budget (max_mb).
+    '''
+    max_mb = int(config.get('max_mb', 0))
+    if max_mb <= 0:
+        return None
+    return CacheManager(cache_dp, max_mb * 1024 * 1024,
+        float(config.get('high_water', 0.95)),
+        float(config.get('low_water', 0.85)),
+        config.get('eviction', 'lru'),
+        config.get('index_fp'),
+        float(config.get('maintain_interval', 5)),
+        config.get('evict_in_process', True))
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    from pregen import _make_app
+    parser = ArgumentParser(description='Keep the Loris image cache under '
+        'its byte budget ([img.ImageCache] max_mb).')
+    parser.add_argument('--config', help='loris2.conf to use (default: the '
+        'dev config, as with create_app(debug=True))')
+    parser.add_argument('--sweep', action='store_true', help='walk the whole '
+        'cache first, indexing what is there and deleting dangling symlinks '
+        'and empty directories (do this once after upgrading)')
+    parser.add_argument('--daemon', action='store_true',
+        help='keep running, rather than evicting once and exiting')
+    parser.add_argument('--interval', type=float, default=60,
+        help='seconds between evictions, as a daemon (default: 60)')
+    parser.add_argument('--sweep-every', type=float, default=None,
+        metavar='SECONDS', help='as a daemon, sweep this often')
+    args = parser.parse_args(argv)
+
+    app = _make_app(args.config)
+    manager = app.img_cache.manager if app.enable_caching else None
+    if manager is None:
+        sys.stderr.write('No budget for the image cache; set max_mb in '
+            '[img.ImageCache]\n')
+        return 1
+    if args.sweep:
+        sys.stderr.write('Swept: %r\n' % (manager.sweep(),))
+    if args.daemon:
+        manager.run_forever(args.interval, args.sweep_every)
+    else:
+        start_bytes = manager.usage()[0]
+        n_files, n_bytes = 0, 0
+        if start_bytes > manager.max_bytes * manager.high_water:
+            n_files, n_bytes = manager.evict_to(manager.max_bytes * manager.low_water)
+        sys.stderr.write('Deleted %d files (%d bytes) to get the cache from %d '
+            'to %d bytes (%d files).\n' % ((n_files, n_bytes, start_bytes) + tuple(manager.usage())))
+    return 0
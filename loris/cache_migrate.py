@@ -0,0 +1,165 @@
+# cache_migrate.py
+# -*- coding: utf-8 -*-
+'''
+Moves the image and info caches from one layout (see cache_layout.py) to
+the one in the config, e.g. from 'flat' to 'sharded'.
+
+Loris can keep running meanwhile, with `previous_layout` set to the old
+layout: every file is moved with a rename(), so it's always in one place or
+the other, and symlinks from non-canonical requests are made again, pointing
+at the new place, before the old ones are removed.
+
+See bin/loris-cache_migrate for the command line.
+'''
+
+from constants import FORMATS_BY_EXTENSION
+from errno import EEXIST, ENOENT, ENOTEMPTY
+from img_info import InfoCache
+from logging import getLogger
+from os import path, sep, makedirs, readlink, rename, rmdir, symlink, unlink
+from os import error as os_error
+import cache_layout
+import os
+import sys
+
+logger = getLogger(__name__)
+
+# region/size/rotation/quality.fmt
+_PARAMS = 4
+
+class Migrator(object):
+    '''
+    Slots:
+        from_layout (str)
+        to_layout (str)
+        stats ({str: int}): files, links and info entries moved.
+    '''
+    __slots__ = ('from_layout', 'to_layout', 'stats')
+
+    def __init__(self, from_layout, to_layout):
+        self.from_layout = cache_layout.check(from_layout)
+        self.to_layout = cache_layout.check(to_layout)
+        self.stats = {'files' : 0, 'links' : 0, 'info' : 0}
+
+    def _new_rel(self, rel, n_after):
+        # rel is an ident directory followed by n_after more parts
+        parts = rel.split(sep)
+        if len(parts) <= n_after:
+            return None
+        ident = cache_layout.ident_of(sep.join(parts[:-n_after]), self.from_layout)
+        if ident is None:
+            return None
+        return path.join(cache_layout.ident_dir(ident, self.to_layout), *parts[-n_after:])
+
+    def migrate_images(self, cache_root):
+        '''Move every derivative and symlink under cache_root.
+        '''
+        cache_root = path.realpath(cache_root)
+        for dp, dirnames, filenames in os.walk(cache_root):
+            for fn in filenames:
+                if fn.startswith('.') or fn.rsplit('.', 1)[-1] not in FORMATS_BY_EXTENSION:
+                    continue
+                fp = path.join(dp, fn)
+                new_rel = self._new_rel(path.relpath(fp, cache_root), _PARAMS)
+                if new_rel is None:
+                    continue # already moved, or not a derivative
+                new_fp = path.join(cache_root, new_rel)
+                if path.islink(fp):
+                    target = readlink(fp)
+                    target_rel = path.relpath(target, cache_root)
+                    new_target_rel = None
+                    if not target_rel.startswith(os.pardir):
+                        new_target_rel = self._new_rel(target_rel, _PARAMS)
+                    if new_target_rel is not None:
+                        target = path.join(cache_root, new_target_rel)
+                    _makedirs(path.dirname(new_fp))
+                    _symlink(target, new_fp)
+                    unlink(fp)
+                    self.stats['links'] += 1
+                elif path.isfile(fp):
+                    _makedirs(path.dirname(new_fp))
+                    rename(fp, new_fp)
+                    self.stats['files'] += 1
+            _prune(dp, cache_root)
+
+    def migrate_info(self, info_root):
+        '''Move every entry under the InfoCache's root, i.e. its info.json and
+        the files beside it.
+        '''
+        info_root = path.realpath(info_root)
+        for dp, dirnames, filenames in os.walk(info_root):
+            if 'info.json' not in filenames:
+                continue
+            new_rel = self._new_rel(path.relpath(path.join(dp, 'info.json'), info_root), 1)
+            if new_rel is None:
+                continue
+            info_fp = path.join(info_root, new_rel)
+            _makedirs(path.dirname(info_fp))
+            # info.json goes last, as in InfoCache._write
+            old_info_fp = path.join(dp, 'info.json')
+            for old_fp, new_fp in zip(InfoCache._sidecar_fps(old_info_fp),
+                    InfoCache._sidecar_fps(info_fp)):
+                if path.exists(old_fp):
+                    rename(old_fp, new_fp)
+            rename(old_info_fp, info_fp)
+            self.stats['info'] += 1
+            _prune(dp, info_root)
+
+
+def _makedirs(dp):
+    try:
+        makedirs(dp)
+    except os_error as ose:
+        if ose.errno != EEXIST:
+            raise
+
+def _symlink(target, link_fp):
+    try:
+        symlink(target, link_fp)
+    except os_error as ose:
+        if ose.errno != EEXIST:
+            raise
+
+def _prune(dp, root):
+    # Remove dp and its parents while they're empty, but never root.
+    while dp != root and dp.startswith(root):
+        try:
+            rmdir(dp)
+        except os_error as ose:
+            if ose.errno in (ENOTEMPTY, EEXIST, ENOENT):
+                return
+            raise
+        dp = path.dirname(dp)
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    from pregen import _make_app
+    parser = ArgumentParser(description='Move the image and info caches to '
+        'the layout in the config (layout in [img.ImageCache] and '
+        '[img_info.InfoCache]).')
+    parser.add_argument('--config', help='loris2.conf to use (default: the '
+        'dev config, as with create_app(debug=True))')
+    parser.add_argument('--from', dest='from_layout', default=cache_layout.FLAT,
+        choices=cache_layout.LAYOUTS, help='the layout the caches are in now '
+        '(default: flat)')
+    args = parser.parse_args(argv)
+
+    app = _make_app(args.config)
+    if not app.enable_caching:
+        sys.stderr.write('Caching is off in the config, so there is nothing to move\n')
+        return 1
+    # only an ImageCache has a layout
+    to_layout = getattr(app.img_cache, 'layout', args.from_layout)
+    img_migrator = Migrator(args.from_layout, to_layout)
+    if img_migrator.from_layout != img_migrator.to_layout:
+        img_migrator.migrate_images(app.img_cache.cache_root)
+    info_migrator = Migrator(args.from_layout, app.info_cache.layout)
+    if info_migrator.from_layout != info_migrator.to_layout:
+        info_migrator.migrate_info(app.info_cache.root)
+    sys.stderr.write('Moved %d derivatives, %d symlinks and %d info.json\n' %
+        (img_migrator.stats['files'], img_migrator.stats['links'],
+        info_migrator.stats['info']))
+    if app.img_cache.manager is not None and img_migrator.stats['files']:
+        # its index has the old paths
+        sys.stderr.write('Swept: %r\n' % (app.img_cache.manager.sweep(),))
+    return 0
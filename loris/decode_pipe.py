@@ -0,0 +1,343 @@
+# decode_pipe.py
+# -*- coding: utf-8 -*-
+'''
+Runs external JP2 decoders (kdu_expand, opj_decompress) and collects what
+they write to a named pipe.
+
+No shell is involved: commands are argument vectors, and FIFOs are made with
+os.mkfifo() in a per-process pool and reused from one decode to the next.
+Names carry the pid and a uuid, so they can't collide between workers or
+requests. The FIFO is opened O_RDWR|O_NONBLOCK, which never blocks waiting for
+the decoder to open its end (even if it dies first), and then the FIFO and
+the decoder's stderr are read in large blocks with select() until stderr
+closes, i.e. the decoder exits.
+
+What's read goes to a reader. PNMReader parses a binary PGM/PPM header and
+then reads the pixels with readinto() straight into a bytearray of the right
+size, which becomes the PIL.Image; BytesReader just collects the bytes.
+'''
+
+from PIL import Image
+from errno import EEXIST, EINTR, ENOENT
+from logging import getLogger
+from threading import Lock
+import atexit
+import fcntl
+import io
+import os
+import select
+import subprocess
+import uuid
+
+logger = getLogger(__name__)
+
+BLOCK_SIZE = 1048576
+POLL_INTERVAL = 1
+F_SETPIPE_SZ = 1031 # Linux; not in the fcntl module until Python 3.10
+PNM_WHITESPACE = ' \t\n\v\f\r'
+PNM_HEADER_MAX = 1024
+
+class DecoderException(Exception):
+    def __init__(self, argv, returncode, stderr):
+        msg = '%s exited with %d: %s' % (argv[0], returncode, stderr.strip())
+        super(DecoderException, self).__init__(msg)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class FifoPool(object):
+    '''A pool of named pipes belonging to this process.
+
+    FIFOs are made on demand and kept (up to `size` per extension) for reuse.
+    After a fork the child starts a pool of its own rather than sharing the
+    parent's pipes.
+
+    Slots:
+        dp (str): where the FIFOs live.
+        size (int): how many idle FIFOs to keep per extension.
+        _pid (int): the process the FIFOs belong to.
+        _idle ({str: [str]}): idle FIFOs by extension.
+        _lock (Lock)
+    '''
+    __slots__ = ('dp', 'size', '_pid', '_idle', '_lock')
+
+    def __init__(self, dp, size=8):
+        self.dp = dp
+        self.size = size
+        self._pid = os.getpid()
+        self._idle = {}
+        self._lock = Lock()
+        if not os.path.exists(dp):
+            try:
+                os.makedirs(dp)
+            except OSError as ose:
+                if ose.errno != EEXIST:
+                    raise
+        atexit.register(self.close)
+
+    def acquire(self, ext):
+        '''
+        Args:
+            ext (str): the extension the decoder uses to pick an output format.
+        Returns:
+            str: the path to a FIFO that no one else is using.
+        '''
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.get(ext)
+            if idle:
+                return idle.pop()
+        fifo_fp = os.path.join(self.dp,
+            '%d-%s.%s' % (self._pid, uuid.uuid4().hex, ext))
+        os.mkfifo(fifo_fp, 0600)
+        return fifo_fp
+
+    def release(self, fifo_fp, reuse=True):
+        '''Give a FIFO back. Pass `reuse=False` if the decode failed and there
+        may be something left in it.
+        '''
+        ext = fifo_fp.rsplit('.', 1)[1]
+        with self._lock:
+            if reuse and os.getpid() == self._pid:
+                idle = self._idle.setdefault(ext, [])
+                if len(idle) < self.size:
+                    idle.append(fifo_fp)
+                    return
+        FifoPool._unlink(fifo_fp)
+
+    def close(self):
+        with self._lock:
+            if os.getpid() == self._pid:
+                for idle in self._idle.values():
+                    map(FifoPool._unlink, idle)
+            self._idle = {}
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # forked: the parent still owns (and may be using) those FIFOs
+            self._pid = pid
+            self._idle = {}
+
+    @staticmethod
+    def _unlink(fifo_fp):
+        try:
+            os.unlink(fifo_fp)
+        except OSError as ose:
+            if ose.errno != ENOENT:
+                raise
+
+
+class BytesReader(object):
+    '''Collects whatever the decoder writes.
+    '''
+    def __init__(self):
+        self._chunks = []
+
+    def read_from(self, f):
+        '''Read what is available from the non-blocking file `f`.
+        '''
+        while True:
+            chunk = f.read(BLOCK_SIZE)
+            if not chunk: # None (would block) or '' (nothing more)
+                return
+            self._chunks.append(chunk)
+
+    def result(self):
+        return ''.join(self._chunks)
+
+
+class PNMReader(object):
+    '''Reads a binary PGM (P5) or PPM (P6) into a PIL.Image.
+
+    Once the header has been parsed, the pixels are read with readinto()
+    directly into a bytearray of exactly the right size, which is handed to
+    Image.frombuffer() (without a copy for 8-bit gray; RGB is unpacked to
+    Pillow's 4 bytes per pixel in one pass). Samples wider than 8 bits, or
+    with an unusual maxval, are scaled down to 8 bits.
+    '''
+    def __init__(self):
+        self._header = ''
+        self._buf = None
+        self._view = None
+        self._pos = 0
+        self._extra = 0
+        self.size = None
+        self.channels = None
+        self.maxval = None
+
+    def read_from(self, f):
+        '''Read what is available from the non-blocking file `f`.
+        '''
+        while self._buf is None:
+            chunk = f.read(PNM_HEADER_MAX)
+            if not chunk:
+                return
+            self._header += chunk
+            self._parse_header()
+        while True:
+            if self._pos < len(self._buf):
+                n = f.readinto(self._view[self._pos:])
+            else: # more than the header said; read it so the decoder can exit
+                chunk = f.read(BLOCK_SIZE)
+                n = len(chunk) if chunk is not None else None
+                self._extra += n or 0
+            if not n:
+                return
+            self._pos += n
+
+    def _parse_header(self):
+        parsed = PNMReader.parse_header(self._header)
+        if parsed is None:
+            if len(self._header) > PNM_HEADER_MAX:
+                raise IOError('Could not find a PNM header')
+            return
+        magic, w, h, maxval, offset = parsed
+        self.channels = {'P5': 1, 'P6': 3}[magic]
+        self.size = (w, h)
+        self.maxval = maxval
+        sample_size = 1 if maxval < 256 else 2
+        self._buf = bytearray(w * h * self.channels * sample_size)
+        self._view = memoryview(self._buf)
+        pixels = self._header[offset:offset+len(self._buf)]
+        self._buf[:len(pixels)] = pixels
+        self._pos = len(pixels)
+        self._header = None
+
+    @staticmethod
+    def parse_header(data):
+        '''
+        Args:
+            data (str): the beginning of a PNM.
+        Returns:
+            (magic, width, height, maxval, offset of the first pixel), or None
+            if data doesn't have the whole header yet.
+        Raises:
+            IOError: if it isn't a binary PGM or PPM.
+        '''
+        if len(data) >= 2 and data[:2] not in ('P5', 'P6'):
+            raise IOError('Not a binary PGM or PPM: %r' % (data[:2],))
+        tokens = []
+        i = 0
+        n = len(data)
+        while len(tokens) < 4:
+            while i < n and data[i] in PNM_WHITESPACE:
+                i += 1
+            if i < n and data[i] == '#':
+                i = data.find('\n', i)
+                if i == -1:
+                    return None
+                continue
+            j = i
+            while j < n and data[j] not in PNM_WHITESPACE:
+                j += 1
+            if j >= n:
+                return None # may be cut off
+            tokens.append(data[i:j])
+            i = j
+        # exactly one whitespace character separates maxval from the pixels
+        return (tokens[0], int(tokens[1]), int(tokens[2]), int(tokens[3]), i+1)
+
+    def result(self):
+        '''
+        Returns:
+            PIL.Image: mode L or RGB.
+        Raises:
+            IOError: if the PNM was incomplete.
+        '''
+        if self._buf is None or self._pos < len(self._buf):
+            raise IOError('Decoder output was truncated')
+        if self._extra:
+            logger.warn('Ignored %d bytes after the image' % (self._extra,))
+        w, h = self.size
+        mode = {1: 'L', 3: 'RGB'}[self.channels]
+        if self.maxval == 255:
+            return Image.frombuffer(mode, self.size, buffer(self._buf), 'raw', mode, 0, 1)
+
+        # Scale the samples, all channels together, as one wide image.
+        scale = 255.0 / self.maxval
+        if self.maxval < 256:
+            im = Image.frombuffer('L', (w * self.channels, h), buffer(self._buf),
+                'raw', 'L', 0, 1)
+            im = im.point(lambda i: i * scale + 0.5)
+        else:
+            im = Image.frombuffer('I;16B', (w * self.channels, h), buffer(self._buf),
+                'raw', 'I;16B', 0, 1)
+            im = im.convert('I').point(lambda i: i * scale + 0.5).convert('L')
+        if self.channels == 1:
+            return im
+        return Image.frombuffer(mode, self.size, im.tobytes(), 'raw', mode, 0, 1)
+
+
+def run_decoder(argv, fifo_fp, env=None, reader=None):
+    '''Run a decoder that writes its output to `fifo_fp` and collect it.
+
+    Args:
+        argv ([str]): the command, which must refer to fifo_fp.
+        fifo_fp (str): a FIFO, e.g. from FifoPool.acquire().
+        env (dict): the decoder's environment.
+        reader (BytesReader|PNMReader): what to do with the output; by
+            default it's collected as a str.
+    Returns:
+        reader.result()
+    Raises:
+        DecoderException: if the decoder exits non-zero.
+        IOError: if the reader can't make sense of the output.
+    '''
+    if reader is None:
+        reader = BytesReader()
+    logger.debug('Calling: %s' % (' '.join(argv),))
+    fifo_fd = os.open(fifo_fp, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        try:
+            fcntl.fcntl(fifo_fd, F_SETPIPE_SZ, BLOCK_SIZE)
+        except IOError:
+            pass # not Linux, or over /proc/sys/fs/pipe-max-size
+        with open(os.devnull, 'wb') as fnull:
+            proc = subprocess.Popen(argv, stdout=fnull, stderr=subprocess.PIPE,
+                env=env, close_fds=True)
+        with io.FileIO(fifo_fd, 'r', closefd=False) as f:
+            err = _collect(proc, f, reader)
+    finally:
+        os.close(fifo_fd)
+
+    if proc.returncode != 0:
+        raise DecoderException(argv, proc.returncode, err)
+    if err:
+        logger.warn('%s: %s' % (argv[0], err.strip()))
+    return reader.result()
+
+def _collect(proc, f, reader):
+    # Because we hold the FIFO open for writing too, reading it never sees
+    # EOF. stderr does, when the decoder exits, and that is what says it's
+    # done; whatever is still buffered in the FIFO is then drained.
+    err = []
+    fifo_fd = f.fileno()
+    err_fd = proc.stderr.fileno()
+    try:
+        while True:
+            try:
+                readable = select.select([fifo_fd, err_fd], [], [], POLL_INTERVAL)[0]
+            except select.error as se:
+                if se.args[0] == EINTR:
+                    continue
+                raise
+            if fifo_fd in readable:
+                reader.read_from(f)
+            if err_fd in readable:
+                chunk = os.read(err_fd, BLOCK_SIZE)
+                if not chunk:
+                    break
+                err.append(chunk)
+            elif not readable and proc.poll() is not None:
+                break # exited, but something it started holds stderr open
+        proc.wait()
+        reader.read_from(f)
+    except:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        raise
+    finally:
+        proc.stderr.close()
+    return ''.join(err)
@@ -0,0 +1,125 @@
+# decoded_cache.py
+# -*- coding: utf-8 -*-
+'''
+An in-process LRU of decoded source images, so that a burst of requests (e.g.
+tiles) against one TIFF, JPEG or PNG decodes it once rather than once per
+request.
+'''
+
+from collections import OrderedDict
+from logging import getLogger
+from os import path
+from threading import Lock
+
+logger = getLogger(__name__)
+
+def pixel_bytes(im):
+    '''Roughly how much memory a loaded PIL.Image's pixels take up. Pillow
+    keeps single band 8-bit images at one byte per pixel, 16-bit ones at two,
+    and everything else (including RGB) at four.
+    '''
+    w, h = im.size
+    if im.mode in ('1', 'L', 'P'):
+        return w * h
+    elif im.mode.startswith('I;16'):
+        return w * h * 2
+    else:
+        return w * h * 4
+
+class DecodedImageCache(object):
+    '''A thread-safe LRU of loaded PIL.Images, limited by pixel memory.
+
+    Entries are keyed on the source's path and mtime (so a replaced file is
+    decoded afresh) and optionally a variant, e.g. a reduced scale. Concurrent
+    misses on the same key wait for the first one to decode rather than all
+    decoding. Cached images are shared, so callers must not modify them in
+    place (crop(), resize(), convert() and so on all return new images), nor
+    save() them, which sets encoderinfo and encoderconfig on the image.
+
+    Slots:
+        max_bytes (int): the budget; images bigger than this aren't cached.
+        hits (int)
+        misses (int)
+        _bytes (int): what the cached images currently take up.
+        _dict (OrderedDict): key -> (PIL.Image, bytes), least recent first.
+        _loading ({key: Lock}): in-flight decodes.
+        _lock (Lock): guards everything else.
+    '''
+    __slots__ = ('max_bytes', 'hits', 'misses', '_bytes', '_dict', '_loading',
+        '_lock')
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._dict = OrderedDict()
+        self._loading = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._dict)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def get(self, src_fp, load, variant=None):
+        '''
+        Args:
+            src_fp (str): the source image.
+            load (callable): given src_fp, returns a PIL.Image; called on a miss.
+            variant (hashable): distinguishes different decodes of one file.
+        Returns:
+            PIL.Image, loaded.
+        '''
+        key = (src_fp, path.getmtime(src_fp), variant)
+        im = self._get(key)
+        if im is not None:
+            return im
+
+        with self._lock:
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = Lock()
+        try:
+            with loading:
+                im = self._get(key, count_miss=True)
+                if im is not None: # someone else just decoded it
+                    return im
+                im = load(src_fp)
+                im.load()
+                self._put(key, im)
+                return im
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def _get(self, key, count_miss=False):
+        with self._lock:
+            entry = self._dict.pop(key, None)
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._dict[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, im):
+        n_bytes = pixel_bytes(im)
+        if n_bytes > self.max_bytes:
+            logger.debug('%s is too big to cache (%d bytes)' % (key[0], n_bytes))
+            return
+        with self._lock:
+            old = self._dict.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._dict[key] = (im, n_bytes)
+            self._bytes += n_bytes
+            while self._bytes > self.max_bytes:
+                evicted_key, (_, evicted_bytes) = self._dict.popitem(last=False)
+                self._bytes -= evicted_bytes
+                logger.debug('Evicted %s from the decoded image cache' % (evicted_key[0],))
+        logger.debug('Decoded image cache: %d images, %d bytes, %d hits, %d misses'
+            % (len(self._dict), self._bytes, self.hits, self.misses))
@@ -1,11 +1,16 @@
 # img.py
 #-*-coding:utf-8-*-
 
+from bloom import BloomFilter
+import cache_layout
 from datetime import datetime
-from errno import EEXIST
+from errno import EEXIST, ENOENT
 from logging import getLogger
 from loris_exception import LorisException
-from os import path, sep, symlink, makedirs, unlink, error as os_error
+from lru import ShardedLRU
+from hashlib import md5
+from os import path, sep, fstat, stat, symlink, makedirs, rename, unlink, error as os_error
+from pack_store import PackStore
 from parameters import RegionParameter
 from parameters import RotationParameter
 from parameters import SizeParameter
@@ -15,6 +20,8 @@ from loris_exception import ImageException
 from urllib import unquote, quote_plus
 from werkzeug.http import generate_etag
 from urllib import unquote
+import sys
+import time
 
 logger = getLogger(__name__)
 
@@ -215,13 +222,99 @@ class ImageRequest(object):
 
 
 class ImageCache(dict):
+    '''Derivatives on the file system, under cache_root, at their canonical
+    paths, with symlinks from any other request for the same thing.
+
+    Finding one costs a realpath() (an lstat() per path component) and a
+    stat(), so each process keeps an index of what it has found, from the
+    request's path to the file's canonical path, size and mtime. A hit in the
+    index is checked with a single stat() of the canonical path, since other
+    processes (and cache cleaning) may have replaced or removed it; if it's
+    gone the entry is dropped and it's a miss.
+
+    Requests that turned out not to be in the cache go into a Bloom filter,
+    so that asking again (e.g. for an image that can't be made) costs no
+    syscalls at all. Another process may since have made the derivative, so
+    the filter is cleared every negative_ttl seconds (and when it's full),
+    and anything this process makes goes into the index, which is checked
+    first. A false miss only costs a trip through Loris#_make_image, which
+    finds the file already there and doesn't render it again.
+
+    Derivatives for an identifier are under its directory in `layout` (see
+    cache_layout.py). While a cache is being moved to a new layout (see
+    cache_migrate.py), any that aren't there yet are also looked for in
+    `previous_layout`, and served from where they are.
+
+    If there's a manager (see cache_manager.py), every hit and every new
+    derivative and symlink is recorded with it, so that it can keep the cache
+    under its byte budget.
+
+    With ram_bytes, small derivatives (up to ram_item_bytes; thumbnails and
+    the first zoom levels, mostly) that are asked for more than once are
+    also kept in memory, encoded, up to ram_bytes per process, least
+    recently used going first. The first time one is opened it only goes
+    into a Bloom filter, so that the many that are only ever asked for once
+    don't push out the few that are asked for all the time; the second time
+    it's read into memory, and from then on open() serves it from there. A
+    hit is still checked with the stat() in lookup(), which drops the copy
+    if the file has changed.
+
+    Slots:
+        cache_root (str)
+        negative_ttl (float): see above.
+        layout (str): 'flat' or 'sharded'.
+        previous_layout (str): or None.
+        manager (cache_manager.CacheManager): or None.
+        ram_item_bytes (int): see above.
+        _index (lru.ShardedLRU): as_path -> (canonical path, size, mtime)
+        _negative (bloom.BloomFilter)
+        _negative_since (float): when _negative was last cleared.
+        _ram (lru.ShardedLRU): canonical path -> (data, size, mtime), or
+            None if there's no RAM budget.
+        _seen (bloom.BloomFilter): canonical paths opened once.
     '''
-    '''
-    def __init__(self, cache_root):
+    __slots__ = ('cache_root', 'negative_ttl', 'layout', 'previous_layout',
+        'manager', 'ram_item_bytes', '_index', '_negative', '_negative_since',
+        '_ram', '_seen')
+
+    def __init__(self, cache_root, index_entries=100000, negative_entries=100000,
+            negative_ttl=10, manager=None, layout=cache_layout.FLAT,
+            previous_layout=None, ram_bytes=0, ram_item_bytes=64*1024):
+        '''
+        Args:
+            cache_root (str)
+            index_entries (int): entries in the index, per process.
+            negative_entries (int): what the Bloom filter is sized for.
+            negative_ttl (float): seconds a miss is remembered for.
+            manager (cache_manager.CacheManager)
+            layout (str)
+            previous_layout (str)
+            ram_bytes (int): derivatives kept in memory, per process; 0 for
+                none.
+            ram_item_bytes (int): the biggest derivative kept in memory.
+        '''
         self.cache_root = cache_root
+        self.negative_ttl = negative_ttl
+        self.manager = manager
+        self.layout = cache_layout.check(layout)
+        if previous_layout == layout:
+            previous_layout = None
+        self.previous_layout = previous_layout and cache_layout.check(previous_layout)
+        # Bounded by count; entries are all about the same size.
+        self._index = ShardedLRU(index_entries, sys.maxint)
+        self._negative = BloomFilter(negative_entries)
+        self._negative_since = time.time()
+        self.ram_item_bytes = ram_item_bytes
+        self._ram = None
+        self._seen = None
+        if ram_bytes > 0:
+            # one shard per 4 items, at least, so that any item fits in one
+            shards = max(1, min(16, ram_bytes // (ram_item_bytes * 4)))
+            self._ram = ShardedLRU(sys.maxint, ram_bytes, shards)
+            self._seen = BloomFilter(max(1000, 4 * ram_bytes // ram_item_bytes))
 
     def __contains__(self, image_request):
-        return path.exists(self.get_request_cache_path(image_request))
+        return self.lookup(image_request) is not None
 
     def __getitem__(self, image_request):
         fp = self.get(image_request)
@@ -229,6 +322,70 @@ class ImageCache(dict):
             raise KeyError
         return fp
 
+    def lookup(self, image_request):
+        '''
+        Returns:
+            (str, datetime, int): the path to the file, its mtime and size,
+            or None if it isn't in the cache.
+        '''
+        key = image_request.as_path
+        entry = self._index.get(key)
+        if entry is not None:
+            fp = entry[0]
+            st = _stat(fp)
+        else:
+            if self._known_missing(key):
+                return None
+            fp, st = self._find(image_request)
+        if st is None:
+            if entry is not None:
+                self._index.pop(key)
+            if self._ram is not None:
+                self._ram.pop(fp)
+            self._negative.add(key)
+            return None
+        if entry is None or entry[1:] != (st.st_size, st.st_mtime):
+            self._index.put(key, (fp, st.st_size, st.st_mtime))
+        if self._ram is not None:
+            held = self._ram.peek(fp)
+            if held is not None and held[1:] != (st.st_size, st.st_mtime):
+                self._ram.pop(fp)
+        if self.manager is not None:
+            self.manager.touch(fp, st.st_size)
+        return (fp, datetime.utcfromtimestamp(st.st_mtime), st.st_size)
+
+    def _find(self, image_request):
+        fp = self.get_request_cache_path(image_request)
+        st = _stat(fp)
+        if st is None and self.previous_layout is not None:
+            fp = self.get_request_cache_path(image_request, self.previous_layout)
+            st = _stat(fp)
+        return (fp, st)
+
+    def _known_missing(self, key):
+        now = time.time()
+        if self._negative.is_full() or now - self._negative_since > self.negative_ttl:
+            self._negative.clear()
+            self._negative_since = now
+            return False
+        return key in self._negative
+
+    def forget(self, image_request):
+        '''Drop what the index knows about image_request, e.g. because the
+        file went away between lookup() and opening it.
+        '''
+        self._index.pop(image_request.as_path)
+
+    def _remember(self, image_request, canonical_fp):
+        st = _stat(canonical_fp)
+        if st is None:
+            return
+        entry = (canonical_fp, st.st_size, st.st_mtime)
+        self._index.put(image_request.as_path, entry)
+        self._index.put(image_request.canonical_as_path, entry)
+        if self.manager is not None:
+            self.manager.touch(canonical_fp, st.st_size)
+
     @staticmethod
     def _link(source, link_name):
         if source == link_name:
@@ -239,7 +396,13 @@ class ImageCache(dict):
             makedirs(link_dp)
         if path.lexists(link_name): # shouldn't be the case, but helps debugging
             unlink(link_name)
-        symlink(source, link_name)
+        try:
+            symlink(source, link_name)
+        except os_error as ose:
+            # A concurrent request for the same derivative got here first.
+            if ose.errno == EEXIST:
+                return
+            raise
         logger.debug('Made symlink from %s to %s' % (link_name, source))
 
     def __setitem__(self, image_request, canonical_fp):
@@ -260,29 +423,109 @@ class ImageCache(dict):
         if not image_request.is_canonical:
             requested_fp = self.get_request_cache_path(image_request)
             ImageCache._link(canonical_fp, requested_fp)
+            if self.manager is not None:
+                self.manager.link(requested_fp, canonical_fp)
+        self._remember(image_request, canonical_fp)
 
     def __delitem__(self, image_request):
-        # if we ever decide to start cleaning our own cache...
+        # cleaning the cache is up to the manager; see cache_manager.py
         pass
 
+    def file_path(self, fp):
+        '''The file for what lookup() found, e.g. for X-Sendfile, or None if
+        it isn't a file.
+        '''
+        return fp
+
+    def canonical_request_path(self, image_request, fp):
+        '''image_request.canonical_request_path, for what lookup() found,
+        without image_request.info (so without resolving the identifier and
+        getting its info). fp is the canonical derivative, since lookup()
+        follows the symlink from any other request to it.
+        '''
+        return _canonical_request_path(image_request, fp)
+
+    def open(self, fp):
+        '''The response body for what lookup() found.
+
+        Raises:
+            IOError (ENOENT): if it has gone since.
+        '''
+        if self._ram is None:
+            return file(fp)
+        held = self._ram.get(fp)
+        if held is not None:
+            return [held[0]]
+        f = file(fp)
+        st = fstat(f.fileno())
+        if st.st_size > self.ram_item_bytes:
+            return f
+        if self._seen.is_full():
+            self._seen.clear()
+        if fp not in self._seen:
+            self._seen.add(fp)
+            return f
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self._ram.put(fp, (data, st.st_size, st.st_mtime), len(data))
+        return [data]
+
+    def ram_stats(self):
+        '''
+        Returns:
+            dict: see ShardedLRU.stats(), or None if nothing is kept in memory.
+        '''
+        if self._ram is None:
+            return None
+        return self._ram.stats()
+
+    def commit(self, image_request, tmp_fp, target_fp):
+        '''Put a finished derivative, rendered at tmp_fp, at target_fp (from
+        create_dir_and_return_file_path()).
+        '''
+        rename(tmp_fp, target_fp)
+
+    def is_made(self, image_request, target_fp):
+        return path.exists(target_fp)
+
+    def alias_canonical(self, image_request):
+        '''If the canonical derivative for image_request is here, make
+        image_request find it too.
+
+        Returns:
+            bool: whether it was.
+        '''
+        canonical_fp = self.get_canonical_cache_path(image_request)
+        if not path.exists(canonical_fp):
+            return False
+        self[image_request] = canonical_fp # just the symlink
+        return True
+
     def get(self, image_request):
-        '''Returns (str, ):
-            The path to the file or None if the file does not exist.
+        '''Returns (str, datetime):
+            The path to the file and its mtime, or None if the file does not
+            exist.
         '''
-        cache_fp = self.get_request_cache_path(image_request)
-        last_mod = datetime.utcfromtimestamp(path.getmtime(cache_fp))
-        if path.exists(cache_fp):
-            return (cache_fp, last_mod)
-        else:
+        found = self.lookup(image_request)
+        if found is None:
             return None
+        return found[:2]
+
+    def _root_for(self, image_request, layout):
+        return path.join(self.cache_root,
+            cache_layout.prefix(image_request.ident, layout or self.layout))
 
-    def get_request_cache_path(self, image_request):
+    def get_request_cache_path(self, image_request, layout=None):
         request_fp = image_request.as_path
-        return path.realpath(path.join(self.cache_root, unquote(request_fp)))
+        root = self._root_for(image_request, layout)
+        return path.realpath(path.join(root, unquote(request_fp)))
 
-    def get_canonical_cache_path(self, image_request):
+    def get_canonical_cache_path(self, image_request, layout=None):
         canonical_fp = image_request.canonical_as_path
-        return path.realpath(path.join(self.cache_root, unquote(canonical_fp)))
+        root = self._root_for(image_request, layout)
+        return path.realpath(path.join(root, unquote(canonical_fp)))
 
     def create_dir_and_return_file_path(self, image_request):
         target_fp = self.get_canonical_cache_path(image_request)
@@ -295,3 +538,223 @@ class ImageCache(dict):
             else:
                 raise
         return target_fp
+
+class BackendImageCache(object):
+    '''Derivatives in a backend (see cache_backend.py), keyed on their
+    canonical paths, with links from any other request for the same thing.
+    With an FSBackend on cache_root that is the tree ImageCache makes (in
+    the flat layout), but without its index, RAM tier and manager.
+
+    Derivatives are rendered to files in staging_dp first, and put into the
+    backend from there (see commit()).
+
+    Slots:
+        cache_root (str)
+        backend (cache_backend.Backend)
+        staging_dp (str)
+    '''
+    __slots__ = ('cache_root', 'backend', 'staging_dp')
+
+    manager = None # see ImageCache
+
+    def __init__(self, cache_root, backend, staging_dp=None):
+        '''
+        Args:
+            cache_root (str)
+            backend (cache_backend.Backend)
+            staging_dp (str): <cache_root>/.staging by default.
+        '''
+        self.cache_root = cache_root
+        self.backend = backend
+        self.staging_dp = staging_dp or path.join(cache_root, '.staging')
+
+    @staticmethod
+    def _key(image_request):
+        return unquote(image_request.as_path)
+
+    @staticmethod
+    def _canonical_key(image_request):
+        return unquote(image_request.canonical_as_path)
+
+    # What differs from one store to the next:
+
+    def _locate(self, key):
+        # (what open() needs, size, mtime), or None
+        st = self.backend.stat(key)
+        if st is None:
+            return None
+        return (key,) + tuple(st)
+
+    def _open(self, handle):
+        return self.backend.open(handle)
+
+    def _put(self, key, data, aliases):
+        self.backend.put(key, data)
+        for alias in aliases:
+            self.backend.link(alias, key)
+
+    def _alias(self, alias, key):
+        self.backend.link(alias, key)
+
+    def _delete(self, key):
+        self.backend.delete((key,))
+
+    def __contains__(self, image_request):
+        return self.lookup(image_request) is not None
+
+    def lookup(self, image_request):
+        '''
+        Returns:
+            (object, datetime, int): what open() takes, the mtime and size,
+            or None if it isn't in the cache.
+        '''
+        found = self._locate(self._key(image_request))
+        if found is None:
+            return None
+        handle, size, mtime = found
+        return (handle, datetime.utcfromtimestamp(mtime), size)
+
+    def get(self, image_request):
+        found = self.lookup(image_request)
+        if found is None:
+            return None
+        return found[:2]
+
+    def __getitem__(self, image_request):
+        found = self.get(image_request)
+        if found is None:
+            raise KeyError
+        return found
+
+    def open(self, handle):
+        return self._open(handle)
+
+    def file_path(self, handle):
+        return self.backend.file_path(handle)
+
+    def canonical_request_path(self, image_request, handle):
+        # see ImageCache
+        return _canonical_request_path(image_request, self._resolve(handle))
+
+    def _resolve(self, handle):
+        # the canonical key, for what _locate() found
+        return self.backend.resolve(handle)
+
+    def forget(self, image_request):
+        pass # nothing is kept in memory
+
+    def get_canonical_cache_path(self, image_request):
+        # Where a render is staged. Named for the request so that it can be
+        # the SingleFlight key.
+        fn = '%s.%s' % (md5(image_request.canonical_as_path).hexdigest(),
+            image_request.format)
+        return path.join(self.staging_dp, fn)
+
+    def create_dir_and_return_file_path(self, image_request):
+        try:
+            makedirs(self.staging_dp)
+        except os_error as ose:
+            if ose.errno != EEXIST:
+                raise
+        return self.get_canonical_cache_path(image_request)
+
+    def _put_file(self, image_request, fp):
+        with open(fp, 'rb') as f:
+            data = f.read()
+        aliases = () if image_request.is_canonical else (self._key(image_request),)
+        self._put(self._canonical_key(image_request), data, aliases)
+
+    def commit(self, image_request, tmp_fp, target_fp):
+        self._put_file(image_request, tmp_fp)
+        unlink(tmp_fp)
+
+    def is_made(self, image_request, target_fp):
+        return self._locate(self._canonical_key(image_request)) is not None
+
+    def alias_canonical(self, image_request):
+        if not self.is_made(image_request, None):
+            return False
+        self[image_request] = None
+        return True
+
+    def __setitem__(self, image_request, fp):
+        # fp is a file to move into the store (e.g. from pregen), or, if it
+        # was already put there by commit(), a file that has gone.
+        if fp is not None and path.exists(fp):
+            self._put_file(image_request, fp)
+            unlink(fp)
+        elif not image_request.is_canonical:
+            self._alias(self._key(image_request), self._canonical_key(image_request))
+
+    def __delitem__(self, image_request):
+        self._delete(self._canonical_key(image_request))
+
+
+class PackImageCache(BackendImageCache):
+    '''Derivatives appended to big segment files in a PackStore (see
+    pack_store.py), under <cache_root>/packs, rather than kept a file (and
+    maybe a symlink) each. They are stored under their canonical path, and
+    other requests for the same thing are aliases of it. Derivatives are
+    staged in <cache_root>/packs/staging.
+
+    Slots:
+        store (pack_store.PackStore)
+    '''
+    __slots__ = ('store',)
+
+    def __init__(self, cache_root, segment_bytes=256*1024*1024, max_bytes=0,
+            compact_below=0.5, compact_interval=0):
+        '''
+        Args:
+            cache_root (str)
+            segment_bytes (int): see PackStore.
+            max_bytes (int): likewise; 0 for no limit.
+            compact_below (float): likewise.
+            compact_interval (float): seconds between compactions, in a
+                background thread; 0 for none.
+        '''
+        self.store = PackStore(path.join(cache_root, 'packs'), segment_bytes,
+            max_bytes, compact_below)
+        super(PackImageCache, self).__init__(cache_root, None,
+            path.join(self.store.root, 'staging'))
+        if compact_interval:
+            self.store.start_compactor(compact_interval)
+
+    def _locate(self, key):
+        location = self.store.get(key)
+        if location is None:
+            return None
+        return (location, location[2], location[3])
+
+    def _open(self, location):
+        return self.store.open(location)
+
+    def file_path(self, location):
+        return None # it's part of a segment
+
+    def _resolve(self, location):
+        return location[4]
+
+    def _put(self, key, data, aliases):
+        self.store.put(key, data, aliases)
+
+    def _alias(self, alias, key):
+        self.store.alias(alias, key)
+
+    def _delete(self, key):
+        self.store.delete(key)
+
+
+def _canonical_request_path(image_request, canonical_path):
+    # The canonical region, size, rotation and quality.format are the last
+    # four components of where the canonical derivative is kept.
+    params = canonical_path.rsplit('/', 4)[1:]
+    return '/'.join([quote_plus(image_request.ident)] + params)
+
+def _stat(fp):
+    try:
+        return stat(fp)
+    except os_error as ose:
+        if ose.errno != ENOENT:
+            raise
+        return None
@@ -1,28 +1,29 @@
 # img_info.py
 
 from PIL import Image
-from collections import deque
+from cache_backend import FSBackend
+import cache_layout
 from constants import COMPLIANCE
 from constants import CONTEXT
 from constants import OPTIONAL_FEATURES
 from constants import PROTOCOL
 from datetime import datetime
+from jp2 import JP2Exception, parse as parse_jp2
 from logging import getLogger
 from loris_exception import ImageInfoException
+from lru import ShardedLRU
 from math import ceil
 from threading import Lock
-import errno
 import fnmatch
 import json
 import os
-import struct
+import zlib
 from urllib import unquote
 from sys import exit
-
 try:
-    from collections import OrderedDict
+    import brotli
 except ImportError:
-    from ordereddict import OrderedDict
+    brotli = None
 
 logger = getLogger(__name__)
 
@@ -42,6 +43,19 @@ PIL_MODES_TO_QUALITIES = {
     'F': ['default','color','gray','bitonal']
 }
 
+def _gzip(data):
+    # wbits=31 for a gzip header and trailer rather than zlib's
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+# Content-Encodings InfoCache.body() can make, most preferred first.
+if brotli is not None:
+    CONTENT_ENCODINGS = ('br', 'gzip', 'identity')
+    ENCODERS = {'br' : brotli.compress, 'gzip' : _gzip}
+else:
+    CONTENT_ENCODINGS = ('gzip', 'identity')
+    ENCODERS = {'gzip' : _gzip}
+
 class ImageInfo(object):
     '''Info about the image.
     See: <http://www-sul.stanford.edu/iiif/image-api/#info>
@@ -57,13 +71,18 @@ class ImageInfo(object):
         color_profile_bytes []: the emebedded color profile, if any
         sizes [(str)]: the optimal sizes of the image to request
         tiles: [{}]
+        jp2 (jp2.JP2): for JP2s, everything in the header boxes and the
+            codestream's main header (levels, layers, precincts, TLM...). Only
+            there when the info was read from the image, not from JSON.
     '''
     __slots__ = ('scaleFactors', 'width', 'tiles', 'height',
         'ident', 'profile', 'protocol', 'sizes',
-        'src_format', 'src_img_fp', 'color_profile_bytes')
+        'src_format', 'src_img_fp', 'color_profile_bytes', 'jp2')
 
     def __init__(self):
         self.protocol = PROTOCOL
+        self.src_img_fp = None
+        self.jp2 = None
 
     @staticmethod
     def from_image_file(uri, src_img_fp, src_format, formats=[], max_size_above_full=200):
@@ -111,10 +130,15 @@ class ImageInfo(object):
         Raises:
             Exception
         """
+        with open(path, 'r') as f:
+            return ImageInfo.from_json_str(f.read())
+
+    @staticmethod
+    def from_json_str(s):
+        """Likewise, from the JSON itself.
+        """
         new_inst = ImageInfo()
-        # try:
-        f = open(path, 'r')
-        j = json.load(f)
+        j = json.loads(s)
         new_inst.ident = j.get(u'@id')
         new_inst.width = j.get(u'width')
         new_inst.height = j.get(u'height')
@@ -123,8 +147,6 @@ class ImageInfo(object):
         new_inst.tiles = j.get(u'tiles')
         new_inst.sizes = j.get(u'sizes')
         new_inst.profile = j.get(u'profile')
-
-        f.close()
         return new_inst
 
     def _extract_with_pillow(self, fp):
@@ -142,27 +164,15 @@ class ImageInfo(object):
         logger.debug('Extracting info from JP2 file.')
         self.profile[1]['qualities'] = ['default', 'bitonal']
 
-        scaleFactors = []
-
-        #TODO use context manager so it's automatically closed
-        jp2 = open(fp, 'rb')
-
-        #check that this is a jp2 file
-        initial_bytes = jp2.read(24)
-        if (not initial_bytes[:12] == '\x00\x00\x00\x0cjP  \r\n\x87\n') or \
-            (not initial_bytes[16:] == 'ftypjp2 '):
-            jp2.close()
+        try:
+            self.jp2 = parse_jp2(fp)
+        except JP2Exception as e:
+            logger.warn('%s: %s' % (fp, e))
             raise ImageInfoException(http_status=500, message='Invalid JP2 file')
+        codestream = self.jp2.codestream
 
-        #grab width and height
-        window = deque([], 4)
-        b = jp2.read(1)
-        while ''.join(window) != 'ihdr':
-            b = jp2.read(1)
-            c = struct.unpack('c', b)[0]
-            window.append(c)
-        self.height = int(struct.unpack(">I", jp2.read(4))[0]) # height (pg. 136)
-        self.width = int(struct.unpack(">I", jp2.read(4))[0]) # width
+        self.width = self.jp2.width
+        self.height = self.jp2.height
         logger.debug("width: " + str(self.width))
         logger.debug("height: " + str(self.height))
 
@@ -170,24 +180,16 @@ class ImageInfo(object):
         # Depending color profiles; there's probably a better way (or more than
         # one, anyway.)
         # see: JP2 I.5.3.3 Colour Specification box
-        while ''.join(window) != 'colr':
-            b = jp2.read(1)
-            c = struct.unpack('c', b)[0]
-            window.append(c)
-
-        colr_meth = struct.unpack('B', jp2.read(1))[0]
-        logger.debug('colr METH: %d' % (colr_meth,))
-
-        # PREC and APPROX, 1 byte each
-        colr_prec = struct.unpack('b', jp2.read(1))[0]
-        colr_approx = struct.unpack('B', jp2.read(1))[0]
-        logger.debug('colr PREC: %d' % (colr_prec))
-        logger.debug('colr APPROX: %d' % (colr_approx))
+        colr_meth = self.jp2.colr_method
+        colr_prec = self.jp2.colr_precedence
+        colr_approx = self.jp2.colr_approx
+        logger.debug('colr METH: %s' % (colr_meth,))
+        logger.debug('colr PREC: %s' % (colr_prec,))
+        logger.debug('colr APPROX: %s' % (colr_approx,))
 
+        self.color_profile_bytes = None
         if colr_meth == 1: # Enumerated Colourspace
-            self.color_profile_bytes = None
-            enum_cs = int(struct.unpack(">HH", jp2.read(4))[1])
-            logger.debug('Image contains an enumerated colourspace: %d' % (enum_cs,))
+            enum_cs = self.jp2.enum_cs
             logger.debug('Enumerated colourspace: %d' % (enum_cs))
             if enum_cs == 16: # sRGB
                 self.profile[1]['qualities'] += ['gray', 'color']
@@ -202,54 +204,32 @@ class ImageInfo(object):
         elif colr_meth == 2:
             # (Restricted ICC profile).
             logger.debug('Image contains a restricted, embedded colour profile')
-            # see http://www.color.org/icc-1_1998-09.pdf, page 18.
-            self.assign_color_profile(jp2)
+            self.assign_color_profile(self.jp2.icc_profile)
         else:
             logger.warn('colr METH is neither "1" or "2". See jp2 spec pg. 139.')
 
             # colr METH 3 = Any ICC method, colr METH 4 = Vendor Colour method
             # See jp2 spec pg. 182 -  Table M.24 (Color spec box legal values)
             if colr_meth <= 4 and -128 <= colr_prec <= 127 and 1 <= colr_approx <= 4:
-                self.assign_color_profile(jp2)
+                self.assign_color_profile(self.jp2.icc_profile)
 
         logger.debug('qualities: ' + str(self.profile[1]['qualities']))
 
-        window =  deque(jp2.read(2), 2)
-        while map(ord, window) != [0xFF, 0x4F]: # (SOC - required, see pg 14)
-            window.append(jp2.read(1))
-        while map(ord, window) != [0xFF, 0x51]:  # (SIZ  - required, see pg 14)
-            window.append(jp2.read(1))
-        jp2.read(20) # through Lsiz (16), Rsiz (16), Xsiz (32), Ysiz (32), XOsiz (32), YOsiz (32)
-        tile_width = int(struct.unpack(">I", jp2.read(4))[0]) # XTsiz (32)
-        tile_height = int(struct.unpack(">I", jp2.read(4))[0]) # YTsiz (32)
+        tile_width, tile_height = codestream.tile_size
         logger.debug("tile width: " + str(tile_width))
         logger.debug("tile height: " + str(tile_height))
         self.tiles.append( { 'width' : tile_width } )
         if tile_width != tile_height:
             self.tiles[0]['height'] = tile_height
-        jp2.read(10) # XTOsiz (32), YTOsiz (32), Csiz (16)
 
-        window =  deque(jp2.read(2), 2)
-        # while (ord(b) != 0xFF): b = jp2.read(1)
-        # b = jp2.read(1) # 0x52: The COD marker segment
-        while map(ord, window) != [0xFF, 0x52]:  # (COD - required, see pg 14)
-            window.append(jp2.read(1))
-
-        jp2.read(7) # through Lcod (16), Scod (8), SGcod (32)
-        levels = int(struct.unpack(">B", jp2.read(1))[0])
+        levels = codestream.levels
         logger.debug("levels: " + str(levels))
         scaleFactors = [pow(2, l) for l in range(0,levels+1)]
         self.tiles[0]['scaleFactors'] = scaleFactors
-        jp2.read(4) # through code block stuff
-
-        # We may have precincts if Scod or Scoc = xxxx xxx0
-        # But we don't need to examine as this is the last variable in the
-        # COD segment. Instead check if the next byte == 0xFF. If it is,
-        # we don't have a Precint size parameter and we've moved on to either
-        # the COC (optional, marker = 0xFF53) or the QCD (required,
-        # marker = 0xFF5C)
-        b = jp2.read(1)
-        if ord(b) != 0xFF:
+
+        # We may have precincts if Scod = xxxx xxx0
+        precincts = codestream.cod.precincts
+        if precincts is not None:
             if self.tiles[0]['width'] == self.width \
                 and self.tiles[0].get('height') in (self.height, None):
                 # Clear what we got above in SIZ and prefer this. This could
@@ -257,32 +237,23 @@ class ImageInfo(object):
                 # Let's wait for that to come up....
                 self.tiles = []
 
-                for level in range(levels+1):
-                    i = int(bin(struct.unpack(">B", b)[0])[2:].zfill(8),2)
-                    x = i&15
-                    y = i >> 4
-                    w = 2**x
-                    h = 2**y
-                    b = jp2.read(1)
+                # In the order they are in COD, paired with scale factors
+                # from 1 up, as they always have been.
+                for level, (w, _) in enumerate(precincts):
                     try:
                         entry = next((i for i in self.tiles if i['width'] == w))
                         entry['scaleFactors'].append(pow(2, level))
                     except StopIteration:
                         self.tiles.append({'width':w, 'scaleFactors':[pow(2, level)]})
 
-        jp2.close()
-
         self.sizes = []
         [self.sizes.append( { 'width' : w, 'height' : h } )
             for w,h in self.sizes_for_scales(scaleFactors)]
         self.sizes.sort(key=lambda size: max([size['width'], size['height']]))
 
-    def assign_color_profile(self, jp2):
-        profile_size_bytes = jp2.read(4)
-        profile_size = int(struct.unpack(">I", profile_size_bytes)[0])
-
-        logger.debug('profile size: %d' % (profile_size))
-        self.color_profile_bytes = profile_size_bytes + jp2.read(profile_size-4)
+    def assign_color_profile(self, profile_bytes):
+        logger.debug('profile size: %d' % (len(profile_bytes)))
+        self.color_profile_bytes = profile_bytes
 
         # This is an assumption for now (i.e. that if you have a colour profile
         # embedded, you're probably working with color images.
@@ -296,11 +267,19 @@ class ImageInfo(object):
     def scale_dim(dim_len, scale):
         return int(ceil(dim_len * 1.0/scale))
 
-    def to_dict(self):
-        logger.debug('self.ident in to_dict: %s' % (self.ident,))
+    def to_dict(self, uri=None):
+        '''
+        Args:
+            uri (str): the @id, if not self.ident; the cache stores info
+                under the bare identifier, and it gets its URI (which depends
+                on how it was requested) when it's sent.
+        '''
+        if uri is None:
+            uri = self.ident
+        logger.debug('@id in to_dict: %s' % (uri,))
         d = {}
         d['@context'] = CONTEXT
-        d['@id'] = self.ident
+        d['@id'] = uri
         d['protocol'] = self.protocol
         d['profile'] = self.profile
         d['width'] = self.width
@@ -310,17 +289,20 @@ class ImageInfo(object):
         d['sizes'] = self.sizes
         return d
 
-    def to_json(self):
+    def to_json(self, uri=None):
         '''Serialize as json.
+        Args:
+            uri (str): see to_dict()
         Returns:
             str (json)
         '''
-        d = self.to_dict()
+        d = self.to_dict(uri)
         return json.dumps(d)
 
 class InfoCache(object):
-    """A dict-like cache for ImageInfo objects. The n most recently used are
-    also kept in memory; all entries are on the file system.
+    """A dict-like cache for ImageInfo objects, keyed on the identifier. The
+    most recently used are also kept in memory; all entries are on the file
+    system.
 
     One twist: you put in an ImageInfo object, but get back a two-tuple, the
     first member is the ImageInfo, the second member is the UTC date and time
@@ -330,143 +312,334 @@ class InfoCache(object):
     put (`instance[indent] = info`), membership, and length. There are no
     iterators, views, default, update, comparators, etc.
 
+    Entries don't depend on how the image was asked for (http or https, a
+    proxy path, a JSONP callback...): the ImageInfo's ident is the bare
+    identifier, and the @id is filled in when the response is made (see
+    ImageInfo.to_json). They live under <root>/info/<identifier>/. Entries
+    from when the cache was kept per scheme, under <root>/http/ and
+    <root>/https/, are moved there the first time they are asked for.
+    Within <root>/info/, an identifier's directory is where `layout` (see
+    cache_layout.py) puts it; while moving to a new layout, entries still
+    in `previous_layout` are moved the same way.
+
+    All of that is by way of a backend (see cache_backend.py), with those
+    paths, relative to <root>, as keys. It's the file system unless another
+    backend is given, in which case <root> is only used for the lock files
+    of SingleFlight.
+
+    In memory, entries are kept in a sharded LRU (see lru.py), bounded by
+    both count and bytes. Next to each info.json is a source.json recording
+    the path, mtime and size of the image the info was read from, and every
+    hit is checked against a stat() of that file: if the source has been
+    replaced (or is gone) the entry is dropped and it's a miss. For HTTP
+    resolvers that is the local copy of the source. Entries from before there
+    were source.json files can't be checked and are served as they are.
+
+    What's sent for an entry, i.e. the JSON with its @id and any
+    Content-Encoding (see body()), is kept in a second LRU, so that a hit
+    costs neither json.dumps nor compression.
+
     Slots:
-        http_root (str): See below
-        https_root (str): See below
+        root (str): See above.
+        http_root (str): Where entries used to be kept for http requests.
+        https_root (str): ...and for https.
         size (int): See below.
-        _dict (OrderedDict): The map.
-        _lock (Lock): The lock.
+        max_bytes (int): See below.
+        validate (bool): See below.
+        disk_hits (int): Entries read back from the file system.
+        migrated (int): Entries moved from http_root or https_root.
+        stale (int): Entries dropped because their source changed.
+        layout (str): 'flat' or 'sharded'.
+        previous_layout (str): or None.
+        backend (cache_backend.Backend)
+        _lru (lru.ShardedLRU): ident -> (ImageInfo, lastmod, source), where
+            source is (path, mtime, size) or None.
+        _bodies (lru.ShardedLRU): (ident, @id, encoding) -> (ImageInfo, str)
+        _lock (Lock): For the counters.
     """
-    __slots__ = ( 'http_root', 'https_root', 'size', '_dict', '_lock')
+    __slots__ = ('root', 'http_root', 'https_root', 'size', 'max_bytes',
+        'validate', 'disk_hits', 'migrated', 'stale', 'layout',
+        'previous_layout', 'backend', '_lru', '_bodies', '_lock')
 
-    def __init__(self, root, size=500):
+    def __init__(self, root, size=500, max_bytes=64*1024*1024, shards=16,
+            validate=True, max_body_bytes=16*1024*1024,
+            layout=cache_layout.FLAT, previous_layout=None, backend=None):
         """
         Args:
             root (str):
                 Path directory on the file system to be used for the cache.
             size (int):
-                Max entries before the we start popping (LRU).
+                Max entries in memory before the we start popping (LRU).
+            max_bytes (int):
+                Likewise, for what the entries (JSON and ICC profiles) add up
+                to.
+            shards (int):
+                The in-memory LRU is split this many ways, each part with its
+                own lock.
+            validate (bool):
+                Check entries against their source image on every hit.
+            max_body_bytes (int):
+                For the responses kept ready to send.
+            layout (str):
+                Where entries go under root.
+            previous_layout (str):
+                Where they may still be, during a move to a new layout.
+            backend (cache_backend.Backend):
+                Where entries are kept; an FSBackend on root by default.
         """
+        self.root = os.path.join(root, 'info')
         self.http_root = os.path.join(root, 'http')
         self.https_root = os.path.join(root, 'https')
         self.size = size
-        self._dict = OrderedDict(last=False) # keyed with the URL, so we don't
-                                             # need toseparate HTTP and HTTPS
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.disk_hits = 0
+        self.migrated = 0
+        self.stale = 0
+        self.layout = cache_layout.check(layout)
+        if previous_layout == layout:
+            previous_layout = None
+        self.previous_layout = previous_layout and cache_layout.check(previous_layout)
+        self.backend = backend or FSBackend(root)
+        self._lru = ShardedLRU(size, max_bytes, shards)
+        # a few per entry: every encoding, and maybe http and https
+        self._bodies = ShardedLRU(size * 4, max_body_bytes, shards)
         self._lock = Lock()
 
-    def _which_root(self, request):
-        if request.url.startswith('https'):
-            return self.https_root
-        else:
-            return self.http_root
+    def get_info_fp(self, ident, layout=None):
+        ident_dp = cache_layout.ident_dir(unquote(ident), layout or self.layout)
+        return os.path.join(self.root, ident_dp, 'info.json')
+
+    def _info_key(self, ident, layout=None):
+        ident_dp = cache_layout.ident_dir(ident, layout or self.layout)
+        return os.path.join('info', ident_dp, 'info.json')
 
     @staticmethod
-    def ident_from_request(request):
-        return '/'.join(request.path[1:].split('/')[:-1])
-
-    def _get_info_fp(self, request):
-        ident = InfoCache.ident_from_request(request)
-        cache_root = self._which_root(request)
-        path = os.path.join(cache_root, unquote(ident), 'info.json')
-        return path
-
-    def _get_color_profile_fp(self, request):
-        ident = InfoCache.ident_from_request(request)
-        cache_root = self._which_root(request)
-        path = os.path.join(cache_root, unquote(ident), 'profile.icc')
-        return path
-
-    def get(self, request):
+    def _sidecar_fps(info_fp):
+        # (or keys)
+        dp = os.path.dirname(info_fp)
+        return (os.path.join(dp, 'profile.icc'), os.path.join(dp, 'source.json'))
+
+    def get(self, ident):
         '''
+        Args:
+            ident (str): the identifier, quoted or not.
         Returns:
-            ImageInfo if it is in the cache, else None
+            (ImageInfo, datetime) if it is in the cache, else None
         '''
-        info_and_lastmod = None
+        key = unquote(ident)
+        entry = self._lru.get(key)
+        if entry is None:
+            info_key = self._info_key(key)
+            entry = self._load(info_key) or self._migrate(key, info_key)
+            if entry is None:
+                return None
+            logger.debug('Info for %s read from the backend' % (key,))
+            with self._lock:
+                self.disk_hits += 1
+            # into mem:
+            self._lru.put(key, entry, InfoCache._entry_bytes(entry[0]))
+
+        info, lastmod, source = entry
+        if self.validate and not InfoCache._is_current(source):
+            logger.info('Source of %s has changed; dropping its info' % (key,))
+            with self._lock:
+                self.stale += 1
+            self._lru.pop(key)
+            self._unlink(self._info_key(key), lastmod)
+            return None
+        return (info, lastmod)
+
+    def _load(self, info_key):
+        got = self.backend.get(info_key)
+        if got is None:
+            return None
+        info = ImageInfo.from_json_str(got[0])
+        lastmod = datetime.utcfromtimestamp(got[1])
+
+        icc_key, source_key = InfoCache._sidecar_fps(info_key)
+        icc = self.backend.get(icc_key)
+        info.color_profile_bytes = icc and icc[0]
+
+        source = None
+        got = self.backend.get(source_key)
+        if got is not None:
+            s = json.loads(got[0])
+            source = (s['fp'], s['mtime'], s['size'])
+            info.src_img_fp = source[0]
+        return (info, lastmod, source)
+
+    def _migrate(self, ident, info_key):
+        # Move an entry from the previous layout or the old per-scheme one,
+        # if there is one. Only the first copy found is kept; the rest only
+        # differed in @id.
+        legacy_keys = [os.path.join(scheme, ident, 'info.json')
+            for scheme in ('http', 'https')]
+        if self.previous_layout is not None:
+            legacy_keys.insert(0, self._info_key(ident, self.previous_layout))
+        entry = None
+        for legacy_key in legacy_keys:
+            if entry is None:
+                entry = self._load(legacy_key)
+        if entry is None:
+            return None
+        info, _, source = entry
+        info.ident = ident
+        mtime = self._write(info_key, info, source)
+        for legacy_key in legacy_keys:
+            self._unlink(legacy_key)
         with self._lock:
-            info_and_lastmod = self._dict.get(request.url)
-        if info_and_lastmod is None:
-            info_fp = self._get_info_fp(request)
-            if os.path.exists(info_fp):
-                # from fs
-                info = ImageInfo.from_json(info_fp)
-
-                icc_fp = self._get_color_profile_fp(request)
-                if os.path.exists(icc_fp):
-                    with open(icc_fp, "rb") as f:
-                        info.color_profile_bytes = f.read()
-                else:
-                    info.color_profile_bytes = None
-
-                lastmod = datetime.utcfromtimestamp(os.path.getmtime(info_fp))
-                info_and_lastmod = (info, lastmod)
-                logger.debug('Info for %s read from file system' % (request,))
-                # into mem:
-                self._dict[request.url] = info_and_lastmod
-
-        return info_and_lastmod
-
-    def has_key(self, request):
-        return os.path.exists(self._get_info_fp(request))
-
-    # def __len__(self):
-    #     w = os.walk
-    #     ff = fnmatch.filter
-    #     pat = STAR_DOT_JSON
-    #     return len([_ for fp in ff(fps, pat) for r,dps,fps in w(self.root)])
-
-    def __contains__(self, request):
-        return self.has_key(request)
-
-    def __getitem__(self, request):
-        info_lastmod = self.get(request)
+            self.migrated += 1
+        logger.info('Moved info for %s to %s' % (ident, info_key))
+        return (info, datetime.utcfromtimestamp(mtime), source)
+
+    @staticmethod
+    def _source_of(info):
+        if info.src_img_fp is None:
+            return None
+        try:
+            st = os.stat(info.src_img_fp)
+        except OSError:
+            return None
+        return (info.src_img_fp, st.st_mtime, st.st_size)
+
+    @staticmethod
+    def _is_current(source):
+        if source is None:
+            return True # can't tell
+        fp, mtime, size = source
+        try:
+            st = os.stat(fp)
+        except OSError:
+            return False
+        return st.st_mtime == mtime and st.st_size == size
+
+    @staticmethod
+    def _entry_bytes(info):
+        # Roughly: the JSON, the profile, and some for the objects.
+        n = 1024 + len(json.dumps(info.tiles)) + len(json.dumps(info.sizes))
+        if info.color_profile_bytes:
+            n += len(info.color_profile_bytes)
+        return n
+
+    def body(self, info, uri, encoding='identity'):
+        '''The info.json response for an entry, made once and then kept in
+        memory until it is pushed out or the entry is replaced.
+
+        Args:
+            info (ImageInfo): as from get().
+            uri (str): the @id.
+            encoding (str): one of CONTENT_ENCODINGS.
+        Returns:
+            str: the JSON, compressed if encoding isn't 'identity'.
+        '''
+        key = (info.ident, uri, encoding)
+        kept = self._bodies.get(key)
+        # Bodies are only good for the ImageInfo they were made from, not one
+        # that has since taken its place.
+        if kept is not None and kept[0] is info:
+            return kept[1]
+        if encoding == 'identity':
+            body = info.to_json(uri)
+        else:
+            body = ENCODERS[encoding](self.body(info, uri))
+        self._bodies.put(key, (info, body), len(body) + 256)
+        return body
+
+    def has_key(self, ident):
+        return self.get(ident) is not None
+
+    def __len__(self):
+        '''How many entries are in memory.
+        '''
+        return len(self._lru)
+
+    def stats(self):
+        '''
+        Returns:
+            dict: for the in-memory LRU, entries, bytes, hits, misses and
+            evictions, and also disk_hits, migrated and stale, and bodies,
+            the same as the first five for the responses kept by body().
+        '''
+        stats = self._lru.stats()
+        stats['bodies'] = self._bodies.stats()
+        with self._lock:
+            stats['disk_hits'] = self.disk_hits
+            stats['migrated'] = self.migrated
+            stats['stale'] = self.stale
+        return stats
+
+    def __contains__(self, ident):
+        return self.has_key(ident)
+
+    def __getitem__(self, ident):
+        info_lastmod = self.get(ident)
         if info_lastmod is None:
             raise KeyError
         else:
             return info_lastmod
 
-    def __setitem__(self, request, info):
-        # to fs
-        logger.debug('request passed to __setitem__: %s' % (request,))
-        info_fp = self._get_info_fp(request)
-        dp = os.path.dirname(info_fp)
-        if not os.path.isdir(dp):
-            try:
-                os.makedirs(dp)
-                logger.debug('Created %s' % (dp,))
-            except OSError as e: # this happens once and a while; not sure why
-                if e.errno == errno.EEXIST:
-                    pass
-                else:
-                    raise
-
-        with open(info_fp, 'w') as f:
-            f.write(info.to_json())
-            f.close()
-            logger.debug('Created %s' % (info_fp,))
-
+    def _write(self, info_key, info, source):
+        # The sidecars go first, and every put is atomic, so that anyone who
+        # sees info.json (see _load) can read all of it.
+        icc_key, source_key = InfoCache._sidecar_fps(info_key)
         if info.color_profile_bytes:
-            icc_fp = self._get_color_profile_fp(request)
-            with open(icc_fp, 'wb') as f:
-                f.write(info.color_profile_bytes)
-                f.close()
-                logger.debug('Created %s' % (icc_fp,))
+            self.backend.put(icc_key, info.color_profile_bytes)
+            logger.debug('Created %s' % (icc_key,))
+        if source is not None:
+            s = {'fp' : source[0], 'mtime' : source[1], 'size' : source[2]}
+            self.backend.put(source_key, json.dumps(s))
+
+        mtime = self.backend.put(info_key, info.to_json())
+        logger.debug('Created %s' % (info_key,))
+        return mtime
+
+    def __setitem__(self, ident, info):
+        key = unquote(ident)
+        mtime = self._put(key, info)
 
         # into mem
-        lastmod = datetime.utcfromtimestamp(os.path.getmtime(info_fp))
-        with self._lock:
-            while len(self._dict) >= self.size:
-                self._dict.popitem(last=False)
-            self._dict[request.url] = (info,lastmod)
+        lastmod = datetime.utcfromtimestamp(mtime)
+        entry = (info, lastmod, InfoCache._source_of(info))
+        self._lru.put(key, entry, InfoCache._entry_bytes(info))
 
-    def __delitem__(self, request):
-        with self._lock:
-            del self._dict[request]
+    def put(self, ident, info):
+        '''Write an entry to the backend only, e.g. for filling the cache in
+        bulk (the next get() will read it from there).
 
-        info_fp = self._get_info_fp(request)
-        os.unlink(info_fp)
+        Args:
+            ident (str): the identifier.
+            info (ImageInfo): its ident is set to the identifier.
+        Returns:
+            str: the path to info.json (for the file system backend)
+        '''
+        self._put(ident, info)
+        return self.get_info_fp(ident)
 
-        icc_fp = self._getcolor_profile_bytes(request)
-        if os.path.exists(icc_fp):
-            os.unlink(icc_fp)
+    def _put(self, ident, info):
+        ident = unquote(ident)
+        info.ident = ident
+        return self._write(self._info_key(ident), info, InfoCache._source_of(info))
 
-        os.removedirs(os.path.dirname(info_fp))
+    def modified(self, ident):
+        '''
+        Returns:
+            float: when the entry for ident was written, or None if there
+            isn't one (where it would be now; entries still in a previous
+            layout aren't looked for).
+        '''
+        st = self.backend.stat(self._info_key(unquote(ident)))
+        return st and st[1]
+
+    def _unlink(self, info_key, lastmod=None):
+        # Unless someone has since written a new one.
+        if lastmod is not None:
+            st = self.backend.stat(info_key)
+            if st is None or datetime.utcfromtimestamp(st[1]) != lastmod:
+                return
+        self.backend.delete((info_key,) + InfoCache._sidecar_fps(info_key))
+
+    def __delitem__(self, ident):
+        key = unquote(ident)
+        self._lru.pop(key)
+        self._unlink(self._info_key(key))
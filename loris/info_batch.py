@@ -0,0 +1,132 @@
+# info_batch.py
+# -*- coding: utf-8 -*-
+'''
+Extracts info.json for many images at once, in a pool of worker processes,
+and writes it (with any ICC profile) straight into the InfoCache's layout on
+the file system, so that newly ingested images don't each cost a cold
+info.json request.
+
+Entries that are already there and newer than their source are left alone,
+so an interrupted run can simply be started again.
+
+See bin/loris-info_batch for the command line.
+'''
+
+from img_info import ImageInfo
+from logging import getLogger
+from multiprocessing import Pool
+from os import path
+from pregen import idents_from_file, idents_from_root, _make_app
+import json
+import sys
+import time
+
+logger = getLogger(__name__)
+
+PROGRESS_EVERY = 1000
+
+class InfoExtractor(object):
+    '''
+    Slots:
+        app (webapp.Loris): for its resolver, transformers and info cache.
+        force (bool): extract even if the cache looks up to date.
+    '''
+    __slots__ = ('app', 'force')
+
+    def __init__(self, app, force=False):
+        self.app = app
+        self.force = force
+
+    def run(self, ident):
+        '''
+        Returns:
+            dict: ident, width, height and the info.json file written, or
+            skipped=True.
+        '''
+        start = time.time()
+        src_fp, src_format = self.app.resolver.resolve(ident)
+        info_cache = self.app.info_cache
+
+        if not self.force:
+            written = info_cache.modified(ident)
+            if written is not None and written >= path.getmtime(src_fp):
+                return {'ident' : ident, 'skipped' : True}
+
+        try:
+            formats = self.app.transformers[src_format].target_formats
+        except KeyError:
+            raise ValueError('unknown source format: %s' % (src_format,))
+        info = ImageInfo.from_image_file(ident, src_fp, src_format, formats,
+            self.app.max_size_above_full)
+        info_fp = info_cache.put(ident, info)
+        return {'ident' : ident, 'width' : info.width, 'height' : info.height,
+            'written' : info_fp, 'seconds' : round(time.time() - start, 3)}
+
+
+# One per worker process; see _init_worker
+_extractor = None
+
+def _init_worker(config_fp, force):
+    global _extractor
+    app = _make_app(config_fp)
+    if not app.enable_caching:
+        raise ValueError('Caching is off in the config, so there is no info cache')
+    _extractor = InfoExtractor(app, force)
+
+def _run_one(ident):
+    try:
+        return _extractor.run(ident)
+    except Exception as e:
+        logger.exception('Could not extract info for %s' % (ident,))
+        return {'ident' : ident, 'error' : '%s: %s' % (e.__class__.__name__, e)}
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Extract info.json for many images '
+        'into the info cache.')
+    parser.add_argument('--config', help='loris2.conf to use (default: the '
+        'dev config, as with create_app(debug=True))')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--ids', help='file with one identifier per line, or - for stdin')
+    source.add_argument('--root', help='make identifiers from the images under this directory')
+    parser.add_argument('--force', action='store_true',
+        help='re-extract even if the cached info is newer than the source')
+    parser.add_argument('--processes', type=int, default=None,
+        help='worker processes (default: one per CPU)')
+    args = parser.parse_args(argv)
+
+    if args.ids:
+        f = sys.stdin if args.ids == '-' else open(args.ids)
+        idents = idents_from_file(f)
+    else:
+        idents = idents_from_root(args.root)
+
+    pool = Pool(args.processes, initializer=_init_worker,
+        initargs=(args.config, args.force))
+    totals = {'images' : 0, 'extracted' : 0, 'skipped' : 0, 'errors' : 0}
+    start = time.time()
+    try:
+        # chunks keep the per-image IPC down when most images are small
+        for result in pool.imap_unordered(_run_one, idents, chunksize=16):
+            totals['images'] += 1
+            if 'error' in result:
+                totals['errors'] += 1
+            elif result.get('skipped'):
+                totals['skipped'] += 1
+            else:
+                totals['extracted'] += 1
+            sys.stdout.write(json.dumps(result) + '\n')
+            if totals['images'] % PROGRESS_EVERY == 0:
+                _report(totals, start)
+    finally:
+        pool.close()
+        pool.join()
+    sys.stdout.flush()
+    _report(totals, start)
+    return 1 if totals['errors'] else 0
+
+def _report(totals, start):
+    elapsed = max(time.time() - start, 0.001)
+    sys.stderr.write('%d images (%.1f/s): %d extracted, %d already there, '
+        '%d errors\n' % (totals['images'], totals['images'] / elapsed,
+        totals['extracted'], totals['skipped'], totals['errors']))
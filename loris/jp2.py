@@ -0,0 +1,385 @@
+# jp2.py
+# -*- coding: utf-8 -*-
+'''
+Reads the header boxes of a JP2 and the main header of its codestream.
+
+The file is memory-mapped and the top-level boxes are walked by their
+lengths, so nothing between the boxes we want (XML, UUIDs, and so on) is read.
+Codestream marker segments are likewise walked by their lengths, and reading
+stops at the first SOT (the end of the main header), however big the file is.
+
+References are to ITU-T T.800 (ISO/IEC 15444-1), 2002:
+    Annex A: codestream syntax
+    Annex I: the JP2 file format
+'''
+
+from logging import getLogger
+import mmap
+import struct
+
+logger = getLogger(__name__)
+
+JP2_SIGNATURE = '\x00\x00\x00\x0cjP  \r\n\x87\n'
+
+# Markers (A.2)
+SOC = 0xFF4F
+SOT = 0xFF90
+SIZ = 0xFF51
+COD = 0xFF52
+COC = 0xFF53
+TLM = 0xFF55
+QCD = 0xFF5C
+QCC = 0xFF5D
+
+# Progression orders (Table A.16)
+PROGRESSION_ORDERS = ('LRCP', 'RLCP', 'RPCL', 'PCRL', 'CPRL')
+
+class JP2Exception(Exception): pass
+
+
+class CodingStyle(object):
+    '''From a COD marker segment (A.6.1) or, for one component, a COC
+    (A.6.2); the COD values that a COC doesn't have are None in that case.
+
+    Slots:
+        progression (str): e.g. 'LRCP'
+        layers (int): quality layers
+        mct (int): 1 if a multiple component transform is used.
+        levels (int): decomposition levels; there are levels+1 resolutions.
+        cblk_size ((int,int)): code-block width and height.
+        cblk_style (int)
+        transform (int): 0 for the 9-7 irreversible filter, 1 for 5-3.
+        precincts ([(int,int)]): precinct width and height for each
+            resolution, lowest resolution first, or None if the default
+            (2^15) is used throughout.
+    '''
+    __slots__ = ('progression', 'layers', 'mct', 'levels', 'cblk_size',
+        'cblk_style', 'transform', 'precincts')
+
+    def __init__(self):
+        self.progression = None
+        self.layers = None
+        self.mct = None
+        self.precincts = None
+
+    def _read_sp(self, buf, offset, has_precincts):
+        # SPcod / SPcoc (Table A.15)
+        levels, xcb, ycb, style, transform = struct.unpack_from('>5B', buf, offset)
+        self.levels = levels
+        self.cblk_size = (1 << (xcb + 2), 1 << (ycb + 2))
+        self.cblk_style = style
+        self.transform = transform
+        if has_precincts:
+            pp = struct.unpack_from('>%dB' % (levels + 1,), buf, offset + 5)
+            self.precincts = [(1 << (b & 0x0F), 1 << (b >> 4)) for b in pp]
+
+
+class Quantization(object):
+    '''From a QCD marker segment (A.6.4) or, for one component, a QCC (A.6.5).
+
+    Slots:
+        style (int): 0 none, 1 scalar derived, 2 scalar expounded.
+        guard_bits (int)
+        step_sizes ([(int,int)]): (exponent, mantissa) per sub-band; the
+            mantissa is 0 when there is no quantization.
+    '''
+    __slots__ = ('style', 'guard_bits', 'step_sizes')
+
+    def __init__(self, buf, offset, end):
+        sq = ord(buf[offset])
+        self.style = sq & 0x1F
+        self.guard_bits = sq >> 5
+        offset += 1
+        if self.style == 0:
+            self.step_sizes = [(ord(b) >> 3, 0) for b in buf[offset:end]]
+        else:
+            n = (end - offset) // 2
+            values = struct.unpack_from('>%dH' % (n,), buf, offset)
+            self.step_sizes = [(v >> 11, v & 0x7FF) for v in values]
+
+
+class Codestream(object):
+    '''The main header of a JPEG 2000 codestream.
+
+    Slots:
+        width (int): Xsiz - XOsiz, the size of the image on the reference grid.
+        height (int): Ysiz - YOsiz
+        offset ((int,int)): XOsiz, YOsiz
+        tile_size ((int,int)): XTsiz, YTsiz
+        tile_offset ((int,int)): XTOsiz, YTOsiz
+        rsiz (int): capabilities
+        components ([(int,bool,int,int)]): precision, signed, and the
+            horizontal and vertical subsampling of each component.
+        cod (CodingStyle)
+        cocs ({int: CodingStyle}): by component.
+        qcd (Quantization)
+        qccs ({int: Quantization}): by component.
+        tlm ([(int,int)]): (tile index, tile-part length) for every tile-part,
+            in order, if there are TLM marker segments; else None.
+        header_length (int): bytes from SOC to the first SOT.
+    '''
+    __slots__ = ('width', 'height', 'offset', 'tile_size', 'tile_offset',
+        'rsiz', 'components', 'cod', 'cocs', 'qcd', 'qccs', 'tlm',
+        'header_length')
+
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.cod = None
+        self.cocs = {}
+        self.qcd = None
+        self.qccs = {}
+        self.tlm = None
+
+    @property
+    def levels(self):
+        return self.cod.levels
+
+    @property
+    def layers(self):
+        return self.cod.layers
+
+    @property
+    def tiles_across(self):
+        return -(-(self.offset[0] + self.width - self.tile_offset[0]) // self.tile_size[0])
+
+    @property
+    def tiles_down(self):
+        return -(-(self.offset[1] + self.height - self.tile_offset[1]) // self.tile_size[1])
+
+
+class JP2(object):
+    '''What's in a JP2's header boxes, and its codestream's main header.
+
+    Slots:
+        width (int): from ihdr
+        height (int): from ihdr
+        num_components (int): from ihdr
+        colr_method (int): METH of the first colr box: 1 enumerated, 2
+            restricted ICC; 3 and 4 are from JPX.
+        colr_precedence (int)
+        colr_approx (int)
+        enum_cs (int): for METH 1, e.g. 16 sRGB, 17 greyscale, 18 sYCC.
+        icc_profile (str): for the other methods, the embedded profile.
+        codestream (Codestream)
+    '''
+    __slots__ = ('width', 'height', 'num_components', 'colr_method',
+        'colr_precedence', 'colr_approx', 'enum_cs', 'icc_profile',
+        'codestream')
+
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.num_components = None
+        self.colr_method = None
+        self.colr_precedence = None
+        self.colr_approx = None
+        self.enum_cs = None
+        self.icc_profile = None
+        self.codestream = None
+
+
+def parse(fp):
+    '''
+    Args:
+        fp (str): path to a JP2.
+    Returns:
+        JP2
+    Raises:
+        JP2Exception: if it isn't a JP2, or is cut off before the end of the
+            codestream's main header.
+    '''
+    with open(fp, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty
+            raise JP2Exception('Invalid JP2 file (empty)')
+    try:
+        return parse_buffer(buf)
+    finally:
+        buf.close()
+
+def parse_buffer(buf):
+    '''Like parse(), for anything that can be sliced and used with
+    struct.unpack_from, e.g. an mmap or a str.
+    '''
+    try:
+        return _parse(buf)
+    except (struct.error, IndexError) as e: # a box or segment was cut off
+        raise JP2Exception('Invalid JP2 file (%s)' % (e,))
+
+def _parse(buf):
+    if buf[:12] != JP2_SIGNATURE:
+        raise JP2Exception('Invalid JP2 file (no signature box)')
+    jp2 = JP2()
+    seen_ftyp = False
+    for box_type, start, end in _boxes(buf, 12, len(buf)):
+        if box_type == 'ftyp':
+            if buf[start:start+4] != 'jp2 ' and \
+                'jp2 ' not in _compatibility(buf, start, end):
+                raise JP2Exception('Invalid JP2 file (not JP2 compatible)')
+            seen_ftyp = True
+        elif box_type == 'jp2h':
+            _read_jp2h(buf, start, end, jp2)
+        elif box_type == 'jp2c':
+            if not seen_ftyp:
+                raise JP2Exception('Invalid JP2 file (no file type box)')
+            jp2.codestream = parse_codestream(buf, start, end)
+            break
+    if jp2.codestream is None:
+        raise JP2Exception('Invalid JP2 file (no codestream)')
+    if jp2.width is None:
+        raise JP2Exception('Invalid JP2 file (no image header box)')
+    return jp2
+
+def _compatibility(buf, start, end):
+    # ftyp: BR (4), MinV (4), then CLi (4 each), I.5.2
+    return [buf[i:i+4] for i in range(start + 8, end, 4)]
+
+def _boxes(buf, offset, end):
+    '''(type, start of contents, end of contents) for each box from
+    `offset`, without reading the contents (I.4).
+    '''
+    while offset + 8 <= end:
+        length, box_type = struct.unpack_from('>I4s', buf, offset)
+        header = 8
+        if length == 1: # XLBox
+            if offset + 16 > end:
+                break
+            length = struct.unpack_from('>Q', buf, offset + 8)[0]
+            header = 16
+        elif length == 0: # to the end
+            length = end - offset
+        if length < header:
+            raise JP2Exception('Invalid JP2 file (bad %r box length)' % (box_type,))
+        yield box_type, offset + header, min(offset + length, end)
+        offset += length
+
+def _read_jp2h(buf, start, end, jp2):
+    for box_type, b_start, b_end in _boxes(buf, start, end):
+        if box_type == 'ihdr': # I.5.3.1
+            h, w, nc = struct.unpack_from('>IIH', buf, b_start)
+            jp2.height, jp2.width, jp2.num_components = h, w, nc
+        elif box_type == 'colr' and jp2.colr_method is None: # I.5.3.3
+            # Only the first colr box counts in a JP2
+            meth, prec, approx = struct.unpack_from('>BbB', buf, b_start)
+            jp2.colr_method, jp2.colr_precedence, jp2.colr_approx = meth, prec, approx
+            if meth == 1:
+                jp2.enum_cs = struct.unpack_from('>I', buf, b_start + 3)[0]
+            elif b_end > b_start + 3:
+                jp2.icc_profile = buf[b_start+3:b_end]
+
+def parse_codestream(buf, offset=0, end=None):
+    '''Read the main header of a codestream starting at `offset` in `buf`.
+
+    Returns:
+        Codestream
+    Raises:
+        JP2Exception
+    '''
+    if end is None:
+        end = len(buf)
+    start = offset
+    if offset + 2 > end or struct.unpack_from('>H', buf, offset)[0] != SOC:
+        raise JP2Exception('Invalid codestream (no SOC marker)')
+    offset += 2
+    cs = Codestream()
+    tlms = []
+    while True:
+        if offset + 4 > end:
+            raise JP2Exception('Codestream ends before its main header does')
+        marker, length = struct.unpack_from('>HH', buf, offset)
+        if marker == SOT:
+            break
+        if marker >> 8 != 0xFF:
+            raise JP2Exception('Invalid codestream (expected a marker at %d)' % (offset,))
+        seg_start = offset + 4 # after the marker and the length
+        seg_end = offset + 2 + length
+        if seg_end > end:
+            raise JP2Exception('Codestream ends inside a marker segment')
+        if marker == SIZ:
+            _read_siz(buf, seg_start, cs)
+        elif marker == COD:
+            cs.cod = _read_cod(buf, seg_start)
+        elif marker == COC:
+            c, coc = _read_coc(buf, seg_start, len(cs.components))
+            cs.cocs[c] = coc
+        elif marker == QCD:
+            cs.qcd = Quantization(buf, seg_start, seg_end)
+        elif marker == QCC:
+            c_len = 1 if len(cs.components) < 257 else 2
+            c = _read_component_index(buf, seg_start, c_len)
+            cs.qccs[c] = Quantization(buf, seg_start + c_len, seg_end)
+        elif marker == TLM:
+            tlms.append(_read_tlm(buf, seg_start, seg_end))
+        offset = seg_end
+
+    if cs.width is None or cs.cod is None or cs.qcd is None:
+        raise JP2Exception('Invalid codestream (SIZ, COD or QCD missing)')
+    cs.header_length = offset - start
+    if tlms:
+        cs.tlm = _merge_tlms(tlms)
+    return cs
+
+def _read_siz(buf, offset, cs):
+    # A.5.1
+    (cs.rsiz, xsiz, ysiz, xosiz, yosiz, xtsiz, ytsiz, xtosiz, ytosiz,
+        csiz) = struct.unpack_from('>H8IH', buf, offset)
+    cs.width, cs.height = xsiz - xosiz, ysiz - yosiz
+    cs.offset = (xosiz, yosiz)
+    cs.tile_size = (xtsiz, ytsiz)
+    cs.tile_offset = (xtosiz, ytosiz)
+    comps = struct.unpack_from('>%dB' % (csiz * 3,), buf, offset + 36)
+    cs.components = [((comps[i] & 0x7F) + 1, bool(comps[i] & 0x80),
+        comps[i+1], comps[i+2]) for i in range(0, len(comps), 3)]
+
+def _read_cod(buf, offset):
+    # A.6.1
+    scod, prog, layers, mct = struct.unpack_from('>BBHB', buf, offset)
+    cod = CodingStyle()
+    try:
+        cod.progression = PROGRESSION_ORDERS[prog]
+    except IndexError:
+        raise JP2Exception('Invalid codestream (progression order %d)' % (prog,))
+    cod.layers = layers
+    cod.mct = mct
+    cod._read_sp(buf, offset + 5, scod & 0x01)
+    return cod
+
+def _read_component_index(buf, offset, c_len):
+    return struct.unpack_from('>B' if c_len == 1 else '>H', buf, offset)[0]
+
+def _read_coc(buf, offset, num_components):
+    # A.6.2
+    c_len = 1 if num_components < 257 else 2
+    c = _read_component_index(buf, offset, c_len)
+    scoc = ord(buf[offset + c_len])
+    coc = CodingStyle()
+    coc._read_sp(buf, offset + c_len + 1, scoc & 0x01)
+    return c, coc
+
+def _read_tlm(buf, offset, end):
+    # A.7.1: Ztlm, Stlm, then (Ttlm, Ptlm) pairs
+    z, s = struct.unpack_from('>BB', buf, offset)
+    st = (s >> 4) & 0x03
+    sp = (s >> 6) & 0x01
+    t_fmt = {0: '', 1: 'B', 2: 'H'}[st]
+    entry_fmt = '>' + t_fmt + ('I' if sp else 'H')
+    entry_len = struct.calcsize(entry_fmt)
+    n = (end - offset - 2) // entry_len
+    entries = []
+    pos = offset + 2
+    for _ in range(n):
+        values = struct.unpack_from(entry_fmt, buf, pos)
+        entries.append(values if st else (None, values[0]))
+        pos += entry_len
+    return z, entries
+
+def _merge_tlms(tlms):
+    # Segments are numbered by Ztlm; without Ttlm, tile-parts are in tile
+    # order, one per tile (A.7.1).
+    merged = []
+    for _, entries in sorted(tlms, key=lambda t: t[0]):
+        merged.extend(entries)
+    return [(len_i if t is None else t, length)
+        for len_i, (t, length) in enumerate(merged)]
@@ -0,0 +1,166 @@
+# lru.py
+# -*- coding: utf-8 -*-
+'''
+A thread-safe, sharded LRU map bounded by entry count and by bytes.
+
+Every operation is O(1): each shard is an OrderedDict (a hash map threaded
+onto a doubly linked list), so a hit moves its entry to the end, and eviction
+pops from the front. Keys are spread over the shards by hash, each with its
+own lock, so that threads working on different keys rarely contend.
+'''
+
+from threading import Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+class _Shard(object):
+    '''
+    Slots:
+        max_entries (int)
+        max_bytes (int)
+        hits (int)
+        misses (int)
+        evictions (int)
+        bytes (int): what the entries currently add up to.
+        _dict (OrderedDict): key -> (value, bytes), least recent first.
+        _lock (Lock)
+    '''
+    __slots__ = ('max_entries', 'max_bytes', 'hits', 'misses', 'evictions',
+        'bytes', '_dict', '_lock')
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._dict = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._dict)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._dict.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._dict[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        with self._lock:
+            entry = self._dict.get(key)
+            return None if entry is None else entry[0]
+
+    def put(self, key, value, n_bytes):
+        if n_bytes > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._dict.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._dict[key] = (value, n_bytes)
+            self.bytes += n_bytes
+            while len(self._dict) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._dict.popitem(last=False)
+                self.bytes -= evicted_bytes
+                self.evictions += 1
+        return True
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._dict.pop(key, None)
+            if entry is None:
+                return None
+            self.bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._dict.clear()
+            self.bytes = 0
+
+
+class ShardedLRU(object):
+    '''
+    Args:
+        max_entries (int): for the whole map; each shard gets its share.
+        max_bytes (int): likewise. A value bigger than a shard's share of
+            this is never kept.
+        shards (int)
+
+    Values are sized by the caller (see put()), so this knows nothing about
+    what it holds. None can't be stored, as get() uses it to mean a miss.
+    '''
+    __slots__ = ('max_entries', 'max_bytes', '_shards')
+
+    def __init__(self, max_entries, max_bytes, shards=16):
+        shards = max(1, min(shards, max_entries))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        per_entries = max(1, max_entries // shards)
+        per_bytes = max(1, max_bytes // shards)
+        self._shards = [_Shard(per_entries, per_bytes) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def __len__(self):
+        return sum(len(s) for s in self._shards)
+
+    def __contains__(self, key):
+        return self._shard(key).peek(key) is not None
+
+    def get(self, key):
+        '''The value for key, now the most recently used, or None.
+        '''
+        return self._shard(key).get(key)
+
+    def peek(self, key):
+        '''Like get(), but leaves the order and the counters alone.
+        '''
+        return self._shard(key).peek(key)
+
+    def put(self, key, value, n_bytes=0):
+        '''
+        Returns:
+            bool: False if the value was too big to keep.
+        '''
+        return self._shard(key).put(key, value, n_bytes)
+
+    def pop(self, key):
+        '''Remove key, if it's there.
+
+        Returns:
+            the value, or None.
+        '''
+        return self._shard(key).pop(key)
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
+
+    @property
+    def size_bytes(self):
+        return sum(s.bytes for s in self._shards)
+
+    def stats(self):
+        '''
+        Returns:
+            dict: entries, bytes, hits, misses and evictions.
+        '''
+        stats = {'entries' : 0, 'bytes' : 0, 'hits' : 0, 'misses' : 0, 'evictions' : 0}
+        for s in self._shards:
+            stats['entries'] += len(s)
+            stats['bytes'] += s.bytes
+            stats['hits'] += s.hits
+            stats['misses'] += s.misses
+            stats['evictions'] += s.evictions
+        return stats
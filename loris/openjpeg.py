@@ -0,0 +1,296 @@
+# openjpeg.py
+# -*- coding: utf-8 -*-
+'''
+A ctypes binding to just enough of libopenjp2 (2.1) to decode a region of a
+JP2 at a given resolution level, in process.
+
+Sources are memory-mapped and kept in a small LRU (validated against the
+file's mtime and size), so repeated requests against the same image don't
+reopen the file and read the main header from the page cache. libopenjp2 2.1
+codecs are single use: once opj_decode() has run, the decode area can't be
+changed, so a fresh codec reads the (mapped) header for every request.
+'''
+
+from PIL import Image
+from collections import OrderedDict
+from ctypes import CDLL, CFUNCTYPE, POINTER, Structure, byref, memmove
+from ctypes import c_char, c_char_p, c_int, c_int32, c_int64, c_size_t
+from ctypes import c_ubyte, c_uint16, c_uint32, c_uint64, c_void_p, cast
+from ctypes.util import find_library
+from logging import getLogger
+from threading import Lock
+import mmap
+import os
+
+logger = getLogger(__name__)
+
+OPJ_PATH_LEN = 4096
+OPJ_CODEC_J2K = 0
+OPJ_CODEC_JP2 = 2
+OPJ_CLRSPC_SYCC = 3
+
+STREAM_CHUNK_SIZE = 1048576 # 1 MB, same as OPJ_J2K_STREAM_CHUNK_SIZE
+READ_EOF = c_size_t(-1).value
+
+class OpenJPEGException(Exception): pass
+
+class _ImageComp(Structure):
+    _fields_ = [
+        ('dx', c_uint32), ('dy', c_uint32), ('w', c_uint32), ('h', c_uint32),
+        ('x0', c_uint32), ('y0', c_uint32), ('prec', c_uint32),
+        ('bpp', c_uint32), ('sgnd', c_uint32), ('resno_decoded', c_uint32),
+        ('factor', c_uint32), ('data', POINTER(c_int32)), ('alpha', c_uint16)
+    ]
+
+class _Image(Structure):
+    _fields_ = [
+        ('x0', c_uint32), ('y0', c_uint32), ('x1', c_uint32), ('y1', c_uint32),
+        ('numcomps', c_uint32), ('color_space', c_int),
+        ('comps', POINTER(_ImageComp)),
+        ('icc_profile_buf', POINTER(c_ubyte)), ('icc_profile_len', c_uint32)
+    ]
+
+class _DParameters(Structure):
+    _fields_ = [
+        ('cp_reduce', c_uint32), ('cp_layer', c_uint32),
+        ('infile', c_char * OPJ_PATH_LEN), ('outfile', c_char * OPJ_PATH_LEN),
+        ('decod_format', c_int), ('cod_format', c_int),
+        ('DA_x0', c_uint32), ('DA_x1', c_uint32),
+        ('DA_y0', c_uint32), ('DA_y1', c_uint32),
+        ('m_verbose', c_int), ('tile_index', c_uint32),
+        ('nb_tile_to_decode', c_uint32), ('jpwl_correct', c_int),
+        ('jpwl_exp_comps', c_int), ('jpwl_max_tiles', c_int),
+        ('flags', c_uint32)
+    ]
+
+_MSG_CALLBACK = CFUNCTYPE(None, c_char_p, c_void_p)
+_READ_FN = CFUNCTYPE(c_size_t, c_void_p, c_size_t, c_void_p)
+_SKIP_FN = CFUNCTYPE(c_int64, c_int64, c_void_p)
+_SEEK_FN = CFUNCTYPE(c_int, c_int64, c_void_p)
+
+def load_libopenjp2(lib_fp=None):
+    '''
+    Args:
+        lib_fp (str): path to libopenjp2; if None the system's is used.
+    Returns:
+        ctypes.CDLL with argtypes and restypes set.
+    '''
+    if lib_fp is None:
+        lib_fp = find_library('openjp2')
+    if lib_fp is None:
+        raise OpenJPEGException('Could not find libopenjp2')
+    lib = CDLL(lib_fp)
+
+    lib.opj_version.restype = c_char_p
+    lib.opj_create_decompress.argtypes = [c_int]
+    lib.opj_create_decompress.restype = c_void_p
+    lib.opj_destroy_codec.argtypes = [c_void_p]
+    lib.opj_set_default_decoder_parameters.argtypes = [POINTER(_DParameters)]
+    lib.opj_setup_decoder.argtypes = [c_void_p, POINTER(_DParameters)]
+    lib.opj_setup_decoder.restype = c_int
+    for setter in (lib.opj_set_error_handler, lib.opj_set_warning_handler):
+        setter.argtypes = [c_void_p, _MSG_CALLBACK, c_void_p]
+        setter.restype = c_int
+    lib.opj_stream_create.argtypes = [c_size_t, c_int]
+    lib.opj_stream_create.restype = c_void_p
+    lib.opj_stream_destroy.argtypes = [c_void_p]
+    lib.opj_stream_set_read_function.argtypes = [c_void_p, _READ_FN]
+    lib.opj_stream_set_skip_function.argtypes = [c_void_p, _SKIP_FN]
+    lib.opj_stream_set_seek_function.argtypes = [c_void_p, _SEEK_FN]
+    lib.opj_stream_set_user_data_length.argtypes = [c_void_p, c_uint64]
+    lib.opj_read_header.argtypes = [c_void_p, c_void_p, POINTER(POINTER(_Image))]
+    lib.opj_read_header.restype = c_int
+    lib.opj_set_decode_area.argtypes = [c_void_p, POINTER(_Image),
+        c_int32, c_int32, c_int32, c_int32]
+    lib.opj_set_decode_area.restype = c_int
+    lib.opj_decode.argtypes = [c_void_p, c_void_p, POINTER(_Image)]
+    lib.opj_decode.restype = c_int
+    lib.opj_end_decompress.argtypes = [c_void_p, c_void_p]
+    lib.opj_end_decompress.restype = c_int
+    lib.opj_image_destroy.argtypes = [POINTER(_Image)]
+    logger.debug('Loaded %s (OpenJPEG %s)' % (lib_fp, lib.opj_version()))
+    return lib
+
+
+class MappedSource(object):
+    '''A memory-mapped JP2 (or raw codestream) and what we know about it.
+
+    Slots:
+        fp (str)
+        mtime (float)
+        size (int)
+        codec_format (int): OPJ_CODEC_JP2 or OPJ_CODEC_J2K
+        _map (mmap.mmap)
+    '''
+    __slots__ = ('fp', 'mtime', 'size', 'codec_format', '_map')
+
+    def __init__(self, fp, st):
+        self.fp = fp
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        with open(fp, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:4] == '\xff\x4f\xff\x51':
+            self.codec_format = OPJ_CODEC_J2K
+        else:
+            self.codec_format = OPJ_CODEC_JP2
+
+    def is_current(self, st):
+        return st.st_mtime == self.mtime and st.st_size == self.size
+
+    def stream_functions(self):
+        '''Read, skip and seek callbacks over the mapping, with their own
+        position. The caller must keep references to them for the life of the
+        stream.
+        '''
+        m = self._map
+        size = self.size
+        pos = [0]
+
+        def read(buf, n, _):
+            start = pos[0]
+            if start >= size:
+                return READ_EOF
+            chunk = m[start:start+n]
+            memmove(buf, chunk, len(chunk))
+            pos[0] = start + len(chunk)
+            return len(chunk)
+
+        def skip(n, _):
+            pos[0] += n
+            return n
+
+        def seek(n, _):
+            pos[0] = n
+            return 1
+
+        return (_READ_FN(read), _SKIP_FN(skip), _SEEK_FN(seek))
+
+
+class SourceCache(object):
+    '''A thread-safe LRU of MappedSource objects, keyed by path.
+
+    Entries are dropped, never closed: a decode in another thread may still
+    hold one, and the mapping goes away with the last reference.
+    '''
+    def __init__(self, size=32):
+        self.size = size
+        self._dict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, fp):
+        st = os.stat(fp)
+        with self._lock:
+            source = self._dict.pop(fp, None)
+            if source is not None and source.is_current(st):
+                self._dict[fp] = source
+                return source
+        source = MappedSource(fp, st)
+        with self._lock:
+            while len(self._dict) >= self.size:
+                self._dict.popitem(last=False)
+            self._dict[fp] = source
+        return source
+
+
+class Decoder(object):
+    '''Decodes regions of JP2s with libopenjp2.
+    '''
+    def __init__(self, lib_fp=None, source_cache_size=32):
+        self.lib = load_libopenjp2(lib_fp)
+        self.sources = SourceCache(source_cache_size)
+
+    def decode(self, fp, region=None, reduce_=0):
+        '''
+        Args:
+            fp (str): path to the JP2
+            region ((int,int,int,int)): x, y, w, h on the full resolution
+                reference grid, or None for the whole image.
+            reduce_ (int): the number of resolution levels to discard.
+        Returns:
+            PIL.Image
+        Raises:
+            OpenJPEGException
+        '''
+        lib = self.lib
+        source = self.sources.get(fp)
+        errors = []
+
+        def on_error(msg, _):
+            errors.append(msg.strip())
+        def on_warning(msg, _):
+            logger.warn('libopenjp2 (%s): %s' % (fp, msg.strip()))
+        callbacks = (_MSG_CALLBACK(on_error), _MSG_CALLBACK(on_warning))
+        stream_fns = source.stream_functions()
+
+        codec = lib.opj_create_decompress(source.codec_format)
+        stream = lib.opj_stream_create(STREAM_CHUNK_SIZE, 1)
+        image_p = POINTER(_Image)()
+        try:
+            lib.opj_set_error_handler(codec, callbacks[0], None)
+            lib.opj_set_warning_handler(codec, callbacks[1], None)
+
+            read_fn, skip_fn, seek_fn = stream_fns
+            lib.opj_stream_set_read_function(stream, read_fn)
+            lib.opj_stream_set_skip_function(stream, skip_fn)
+            lib.opj_stream_set_seek_function(stream, seek_fn)
+            lib.opj_stream_set_user_data_length(stream, source.size)
+
+            params = _DParameters()
+            lib.opj_set_default_decoder_parameters(byref(params))
+            params.cp_reduce = reduce_
+            self._check(lib.opj_setup_decoder(codec, byref(params)), fp, errors)
+            self._check(lib.opj_read_header(stream, codec, byref(image_p)), fp, errors)
+
+            if region is not None:
+                x, y, w, h = region
+                ok = lib.opj_set_decode_area(codec, image_p, x, y, x+w, y+h)
+                self._check(ok, fp, errors)
+
+            self._check(lib.opj_decode(codec, stream, image_p), fp, errors)
+            self._check(lib.opj_end_decompress(codec, stream), fp, errors)
+            return Decoder._to_pil(image_p.contents)
+        finally:
+            if image_p:
+                lib.opj_image_destroy(image_p)
+            lib.opj_stream_destroy(stream)
+            lib.opj_destroy_codec(codec)
+
+    @staticmethod
+    def _check(ok, fp, errors):
+        if not ok:
+            msg = '; '.join(errors) or 'unknown error'
+            raise OpenJPEGException('libopenjp2 could not decode %s: %s' % (fp, msg))
+
+    @staticmethod
+    def _to_pil(image):
+        numcomps = min(image.numcomps, 4)
+        comps = [image.comps[i] for i in range(numcomps)]
+        size = (comps[0].w, comps[0].h)
+        bands = [Decoder._band(c, size) for c in comps]
+
+        if numcomps >= 3 and image.color_space == OPJ_CLRSPC_SYCC:
+            rgb = Image.merge('YCbCr', bands[:3]).convert('RGB')
+            bands = list(rgb.split()) + bands[3:]
+
+        mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[numcomps]
+        if numcomps == 1:
+            return bands[0]
+        return Image.merge(mode, bands)
+
+    @staticmethod
+    def _band(comp, size):
+        # The decoded component is w*h OPJ_INT32s; wrap it (no copy) as a
+        # 32-bit PIL image and map it down to 8 bits, which copies it out
+        # before the opj_image_t is destroyed.
+        n_bytes = comp.w * comp.h * 4
+        buf = (c_char * n_bytes).from_address(cast(comp.data, c_void_p).value)
+        band = Image.frombuffer('I', (comp.w, comp.h), buf, 'raw', 'I', 0, 1)
+        offset = (1 << (comp.prec - 1)) if comp.sgnd else 0
+        if comp.prec != 8 or offset:
+            scale = 255.0 / ((1 << comp.prec) - 1)
+            band = band.point(lambda i: (i + offset) * scale)
+        band = band.convert('L')
+        if band.size != size: # subsampled (e.g. chroma) components
+            band = band.resize(size, resample=Image.BILINEAR)
+        return band
@@ -0,0 +1,442 @@
+# pack_store.py
+# -*- coding: utf-8 -*-
+'''
+A store for many small blobs (encoded derivatives), appended to large
+segment files rather than kept one file each, so that a 20 KB tile doesn't
+cost an inode, a directory entry and a partly used block, and cleaning up
+means deleting a few big files rather than walking a huge tree.
+
+Each record in a segment is a header (see HEADER), the key and the data,
+with a CRC32 of the key and data. An index in SQLite (next to the segments)
+maps a key to its segment, offset, length and mtime, and keeps the size of
+every segment and how much of it is still live. Other keys can be aliases
+of a key (e.g. a non-canonical request of a canonical one).
+
+Appends and everything else that moves data around hold an exclusive
+flock() on a lock file, so any number of processes can share a store. A
+record is written before it's indexed, in one transaction with the new
+size of its segment, so after a crash a segment can only be longer than
+the index says: the tail is scanned, whole records are indexed, and a torn
+last one is truncated (see _recover_segment). This is done for every
+segment when a store is opened, and before any append to a segment whose
+size isn't what the index says.
+
+Reads map the segment into memory (see open()) and slice the record out
+of it, so they cost no syscalls once a segment is mapped.
+
+Deleted and replaced records are dead space until compact() copies the live
+records out of segments that are mostly dead and deletes them. Over
+max_bytes, whole segments are dropped, oldest first. maintain() does both,
+and start_compactor() does that in a background thread.
+'''
+
+from contextlib import contextmanager
+from errno import ENOENT
+from fcntl import flock, LOCK_EX
+from logging import getLogger
+from os import path, getpid
+from threading import Lock, Thread, local
+import mmap
+import os
+import sqlite3
+import struct
+import time
+import zlib
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+logger = getLogger(__name__)
+
+MAGIC = 'LPK1'
+# magic, key length, data length, mtime, CRC32 of the key and data
+HEADER = struct.Struct('<4sHIdI')
+SEGMENT_SUFFIX = '.seg'
+# bytes per chunk of a response
+CHUNK = 64 * 1024
+# segments kept mapped, per process
+MAX_MAPS = 64
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_segment ON entries (segment);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT PRIMARY KEY,
+    key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS aliases_by_key ON aliases (key);
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    live INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE segments SET live = live + NEW.length WHERE id = NEW.segment;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE segments SET live = live - OLD.length WHERE id = OLD.segment;
+END;
+'''
+
+class PackStore(object):
+    '''
+    Slots:
+        root (str): where the segments and the index are.
+        segment_bytes (int): a new segment is started when the last one
+            would go over this.
+        max_bytes (int): what the segments may add up to; 0 for no limit.
+        compact_below (float): segments less live than this get compacted.
+        _lock (Lock): the flock is per process; this is per thread.
+        _local (threading.local): a connection per thread (and process).
+        _maps (OrderedDict): segment -> mmap, least recently used first.
+        _maps_lock (Lock)
+    '''
+    __slots__ = ('root', 'segment_bytes', 'max_bytes', 'compact_below',
+        '_lock', '_local', '_maps', '_maps_lock')
+
+    def __init__(self, root, segment_bytes=256*1024*1024, max_bytes=0,
+            compact_below=0.5):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.compact_below = compact_below
+        self._lock = Lock()
+        self._local = local()
+        self._maps = OrderedDict()
+        self._maps_lock = Lock()
+        if not path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not path.isdir(root):
+                    raise
+        self.recover()
+
+    @property
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != getpid():
+            conn = sqlite3.connect(path.join(self.root, 'index.sqlite'),
+                timeout=60, isolation_level=None)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = getpid()
+        return conn
+
+    @contextmanager
+    def _exclusive(self):
+        with self._lock:
+            fd = os.open(path.join(self.root, 'lock'), os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                flock(fd, LOCK_EX)
+                yield
+            finally:
+                os.close(fd) # and with it the flock
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def _segment_fp(self, segment):
+        return path.join(self.root, '%08d%s' % (segment, SEGMENT_SUFFIX))
+
+    def get(self, key):
+        '''
+        Args:
+            key (str): a key or an alias.
+        Returns:
+            (int, int, int, float, str): segment, offset, length, mtime and
+            key (the one it's an alias of, if it's an alias), or None.
+        '''
+        return self._db.execute('SELECT segment, offset, length, mtime, key FROM entries '
+            'WHERE key = COALESCE((SELECT key FROM aliases WHERE alias = ?), ?)',
+            (key, key)).fetchone()
+
+    def open(self, location):
+        '''
+        Args:
+            location (tuple): from get().
+        Returns:
+            iterator: the data, in chunks.
+        Raises:
+            IOError (ENOENT): if the segment has since been compacted or
+            dropped (get() again).
+        '''
+        segment, offset, length = location[:3]
+        return _chunks(self._map(segment, offset + length), offset, length)
+
+    def read(self, location):
+        '''Like open(), but all of it at once.
+        '''
+        segment, offset, length = location[:3]
+        return self._map(segment, offset + length)[offset:offset + length]
+
+    def _map(self, segment, end):
+        with self._maps_lock:
+            mm = self._maps.pop(segment, None)
+            if mm is None or len(mm) < end:
+                # Not mapped yet, or it's the last segment and has grown. An
+                # old map is left to whoever is still reading it.
+                fp = self._segment_fp(segment)
+                with open(fp, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size < end:
+                        raise IOError(ENOENT, 'Record is past the end of the segment', fp)
+                    mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._maps[segment] = mm
+            while len(self._maps) > MAX_MAPS:
+                self._maps.popitem(last=False)
+            return mm
+
+    def put(self, key, data, aliases=()):
+        '''Append data under key, replacing what was there.
+
+        Returns:
+            tuple: the location, as from get().
+        '''
+        with self._exclusive():
+            location = self._write(key, data, time.time())
+            if aliases:
+                with self._transaction() as db:
+                    db.executemany('INSERT OR REPLACE INTO aliases (alias, key) '
+                        'VALUES (?, ?)', ((a, key) for a in aliases))
+        return location
+
+    def alias(self, alias, key):
+        '''Make alias another key for key (which needn't be there yet).
+        '''
+        self._db.execute('INSERT OR REPLACE INTO aliases (alias, key) VALUES (?, ?)',
+            (alias, key))
+
+    def delete(self, key):
+        with self._exclusive():
+            with self._transaction() as db:
+                db.execute('DELETE FROM aliases WHERE key = ? OR alias = ?', (key, key))
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def _write(self, key, data, mtime):
+        # The caller holds _exclusive().
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        crc = zlib.crc32(data, zlib.crc32(key)) & 0xffffffff
+        record = HEADER.pack(MAGIC, len(key), len(data), mtime, crc) + key + data
+        segment, start = self._append(record)
+        location = (segment, start + HEADER.size + len(key), len(data), mtime)
+        with self._transaction() as db:
+            db.execute('UPDATE segments SET size = ? WHERE id = ?',
+                (start + len(record), segment))
+            db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            db.execute('INSERT INTO entries (key, segment, offset, length, mtime) '
+                'VALUES (?, ?, ?, ?, ?)', (key,) + location)
+        return location + (key,)
+
+    def _append(self, record):
+        db = self._db
+        row = db.execute('SELECT id, size FROM segments ORDER BY id DESC LIMIT 1').fetchone()
+        if row is None:
+            segment, size = self._new_segment(1), 0
+        else:
+            segment, size = row
+            if _file_size(self._segment_fp(segment)) != size:
+                size = self._recover_segment(segment, size)
+            if size and size + len(record) > self.segment_bytes:
+                segment, size = self._new_segment(segment + 1), 0
+        with open(self._segment_fp(segment), 'ab') as f:
+            f.write(record)
+        return (segment, size)
+
+    def _new_segment(self, segment):
+        self._db.execute('INSERT OR IGNORE INTO segments (id) VALUES (?)', (segment,))
+        open(self._segment_fp(segment), 'ab').close()
+        return segment
+
+    def recover(self):
+        '''Bring the index up to date with the segments: index records written
+        after the last indexed one, truncate torn ones, and forget segments
+        that are gone.
+        '''
+        with self._exclusive():
+            db = self._db
+            on_disk = set(int(fn[:-len(SEGMENT_SUFFIX)]) for fn in os.listdir(self.root)
+                if fn.endswith(SEGMENT_SUFFIX))
+            indexed = dict(db.execute('SELECT id, size FROM segments').fetchall())
+            for segment in sorted(on_disk):
+                if segment not in indexed:
+                    self._new_segment(segment)
+                size = indexed.get(segment, 0)
+                if _file_size(self._segment_fp(segment)) != size:
+                    self._recover_segment(segment, size)
+            for segment in set(indexed) - on_disk:
+                logger.warn('Segment %d of %s is gone; forgetting it' % (segment, self.root))
+                self._forget_segment(segment)
+
+    def _recover_segment(self, segment, size):
+        # Index what's past size in segment, up to the first record that
+        # isn't whole, and cut that off. The caller holds _exclusive().
+        fp = self._segment_fp(segment)
+        found = []
+        end = size
+        with open(fp, 'rb') as f:
+            f.seek(size)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                magic, key_len, data_len, mtime, crc = HEADER.unpack(header)
+                if magic != MAGIC:
+                    break
+                key = f.read(key_len)
+                data = f.read(data_len)
+                if len(data) < data_len or \
+                        zlib.crc32(data, zlib.crc32(key)) & 0xffffffff != crc:
+                    break
+                found.append((key, segment, end + HEADER.size + key_len, data_len, mtime))
+                end += HEADER.size + key_len + data_len
+        if _file_size(fp) > end:
+            with open(fp, 'r+b') as f:
+                f.truncate(end)
+            logger.warn('Truncated a torn record at %d in %s' % (end, fp))
+        with self._transaction() as db:
+            for entry in found:
+                # unless a newer copy was written meanwhile
+                row = db.execute('SELECT mtime FROM entries WHERE key = ?',
+                    (entry[0],)).fetchone()
+                if row is not None:
+                    if row[0] > entry[4]:
+                        continue
+                    db.execute('DELETE FROM entries WHERE key = ?', (entry[0],))
+                db.execute('INSERT INTO entries (key, segment, offset, length, mtime) '
+                    'VALUES (?, ?, ?, ?, ?)', entry)
+            db.execute('UPDATE segments SET size = ? WHERE id = ?', (end, segment))
+        if found:
+            logger.info('Recovered %d records in %s' % (len(found), fp))
+        return end
+
+    def _forget_segment(self, segment):
+        with self._transaction() as db:
+            db.execute('DELETE FROM aliases WHERE key IN '
+                '(SELECT key FROM entries WHERE segment = ?)', (segment,))
+            db.execute('DELETE FROM entries WHERE segment = ?', (segment,))
+            db.execute('DELETE FROM segments WHERE id = ?', (segment,))
+        with self._maps_lock:
+            self._maps.pop(segment, None)
+        try:
+            os.unlink(self._segment_fp(segment))
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+
+    def stats(self):
+        '''
+        Returns:
+            dict: segments, bytes (what they add up to), live (bytes), entries
+            and aliases.
+        '''
+        db = self._db
+        segments, n_bytes, live = db.execute('SELECT COUNT(*), '
+            'COALESCE(SUM(size), 0), COALESCE(SUM(live), 0) FROM segments').fetchone()
+        return {'segments' : segments, 'bytes' : n_bytes, 'live' : live,
+            'entries' : db.execute('SELECT COUNT(*) FROM entries').fetchone()[0],
+            'aliases' : db.execute('SELECT COUNT(*) FROM aliases').fetchone()[0]}
+
+    def _sealed_segments(self):
+        # All but the last, which is still being appended to.
+        return self._db.execute('SELECT id, size, live FROM segments WHERE id < '
+            '(SELECT MAX(id) FROM segments) ORDER BY id').fetchall()
+
+    def evict(self):
+        '''Drop whole segments, oldest first, until the store is within
+        max_bytes.
+
+        Returns:
+            int: segments dropped.
+        '''
+        if not self.max_bytes:
+            return 0
+        dropped = 0
+        with self._exclusive():
+            total = self.stats()['bytes']
+            for segment, size, _ in self._sealed_segments():
+                if total <= self.max_bytes:
+                    break
+                self._forget_segment(segment)
+                total -= size
+                dropped += 1
+        if dropped:
+            logger.info('Dropped %d segments from %s' % (dropped, self.root))
+        return dropped
+
+    def compact(self):
+        '''Copy the live records out of sealed segments that are less than
+        compact_below live, to the end of the store, and delete them.
+
+        Returns:
+            int: segments compacted.
+        '''
+        compacted = 0
+        for segment, size, live in self._sealed_segments():
+            if live >= size * self.compact_below:
+                continue
+            with self._exclusive():
+                rows = self._db.execute('SELECT key, offset, length, mtime FROM entries '
+                    'WHERE segment = ?', (segment,)).fetchall()
+                for key, offset, length, mtime in rows:
+                    data = self.read((segment, offset, length))
+                    self._write(key, data, mtime)
+                self._forget_segment(segment)
+            compacted += 1
+            logger.info('Compacted segment %d of %s (%d of %d bytes live)' %
+                (segment, self.root, live, size))
+        return compacted
+
+    def maintain(self):
+        return (self.evict(), self.compact())
+
+    def start_compactor(self, interval):
+        '''Call maintain() every interval seconds, in a daemon thread.
+        '''
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.maintain()
+                except Exception:
+                    logger.exception('Could not compact %s' % (self.root,))
+        t = Thread(target=run, name='PackStore compactor')
+        t.daemon = True
+        t.start()
+        return t
+
+
+def _chunks(mm, offset, length):
+    end = offset + length
+    while offset < end:
+        n = min(CHUNK, end - offset)
+        yield mm[offset:offset + n]
+        offset += n
+
+def _file_size(fp):
+    try:
+        return os.path.getsize(fp)
+    except OSError as e:
+        if e.errno != ENOENT:
+            raise
+        return 0
@@ -0,0 +1,365 @@
+# pregen.py
+# -*- coding: utf-8 -*-
+'''
+Pre-generates the tiles and sizes that an image's info.json advertises, either
+into the live ImageCache or into a static IIIF level 0 tree (with its own
+info.json), so that new collections can be warmed before they get traffic.
+
+Each resolution level is decoded once, through the same transformer that
+Loris#_make_image would use, and every tile at that level is cut from it.
+Anything that already exists is skipped, so an interrupted run can simply be
+started again.
+
+See bin/loris-pregen for the command line.
+'''
+
+from PIL import Image
+from img import ImageRequest
+from img_info import ImageInfo
+from logging import getLogger
+from multiprocessing import Pool
+from os import makedirs, path, rename, unlink, walk
+from urllib import unquote
+import errno
+import json
+import sys
+import time
+import uuid
+
+logger = getLogger(__name__)
+
+LEVEL0_COMPLIANCE = 'http://iiif.io/api/image/2/level0.json'
+SOURCE_EXTENSIONS = ('.jp2', '.jpg', '.jpeg', '.tif', '.tiff', '.png')
+
+class Derivative(object):
+    '''One tile or size to make from a decoded level.
+
+    Slots:
+        request (ImageRequest)
+        box ((int,int,int,int)): where to crop it from the level image.
+    '''
+    __slots__ = ('request', 'box')
+
+    def __init__(self, request, box):
+        self.request = request
+        self.box = box
+
+
+class Level(object):
+    '''A resolution level, and the tiles and sizes to cut from it.
+
+    Slots:
+        scale (int): the scale factor
+        size ((int,int)): the dimensions of the whole image at this scale
+        derivatives ([Derivative])
+    '''
+    __slots__ = ('scale', 'size', 'derivatives')
+
+    def __init__(self, scale, size):
+        self.scale = scale
+        self.size = size
+        self.derivatives = []
+
+
+def default_tiles(info, tile_size):
+    '''Tiles for sources that don't have any of their own (i.e. everything
+    but JP2s): powers of two down to where the whole image fits in one tile.
+    '''
+    scale_factors = [1]
+    while max(info.width, info.height) > tile_size * scale_factors[-1]:
+        scale_factors.append(scale_factors[-1] * 2)
+    return [{'width' : tile_size, 'scaleFactors' : scale_factors}]
+
+def pyramid(ident, info, fmt='jpg', tiles=None):
+    '''Work out every tile and size that a client may ask for, the way a
+    IIIF 2.0 client (e.g. OpenSeadragon) would ask for them.
+
+    Args:
+        ident (str)
+        info (ImageInfo)
+        fmt (str)
+        tiles ([dict]): the tiles entry from info.json; info.tiles by default.
+    Returns:
+        [Level], from the smallest to the largest.
+    '''
+    full_w, full_h = info.width, info.height
+    levels = {}
+    seen = set()
+
+    def level(scale):
+        if scale not in levels:
+            size = (ImageInfo.scale_dim(full_w, scale), ImageInfo.scale_dim(full_h, scale))
+            levels[scale] = Level(scale, size)
+        return levels[scale]
+
+    def add(lvl, region, size, box):
+        if (region, size) in seen: # e.g. a size that is also the top tile
+            return
+        seen.add((region, size))
+        request = ImageRequest(ident, region, size, '0', 'default', fmt)
+        request.info = info
+        lvl.derivatives.append(Derivative(request, box))
+
+    for tile in (info.tiles if tiles is None else tiles):
+        tile_w = tile['width']
+        tile_h = tile.get('height', tile_w)
+        for scale in tile['scaleFactors']:
+            lvl = level(scale)
+            level_w, level_h = lvl.size
+            if level_w <= tile_w and level_h <= tile_h:
+                add(lvl, 'full', '%d,' % (level_w,), (0, 0, level_w, level_h))
+                continue
+            for y in range(0, full_h, tile_h * scale):
+                for x in range(0, full_w, tile_w * scale):
+                    w = min(tile_w * scale, full_w - x)
+                    h = min(tile_h * scale, full_h - y)
+                    box_x, box_y = x // scale, y // scale
+                    box = (box_x, box_y,
+                        min(box_x + ImageInfo.scale_dim(w, scale), level_w),
+                        min(box_y + ImageInfo.scale_dim(h, scale), level_h))
+                    region = '%d,%d,%d,%d' % (x, y, w, h)
+                    add(lvl, region, '%d,' % (box[2] - box[0],), box)
+
+    for size in (info.sizes or []):
+        # cut from the smallest level that is at least this big
+        scale = 1
+        while ImageInfo.scale_dim(full_w, scale * 2) >= size['width'] and \
+            ImageInfo.scale_dim(full_h, scale * 2) >= size['height']:
+            scale *= 2
+        lvl = level(scale)
+        add(lvl, 'full', '%d,' % (size['width'],), (0, 0) + lvl.size)
+
+    return [levels[s] for s in sorted(levels, reverse=True)]
+
+
+class CacheOutput(object):
+    '''Puts derivatives in an ImageCache, just as Loris#_make_image would.
+    '''
+    def __init__(self, img_cache):
+        self.img_cache = img_cache
+
+    def exists(self, image_request):
+        if image_request in self.img_cache:
+            return True
+        return self.img_cache.alias_canonical(image_request)
+
+    def target_fp(self, image_request):
+        return self.img_cache.create_dir_and_return_file_path(image_request)
+
+    def done(self, image_request, target_fp):
+        self.img_cache[image_request] = target_fp
+
+    def finish(self, ident, info, tiles):
+        pass # the live info.json is the InfoCache's business
+
+
+class StaticOutput(object):
+    '''Writes a static IIIF level 0 tree: <root>/<ident>/<region>/<size>/0/
+    default.<fmt>, using the request syntax clients send rather than the
+    canonical one, plus <root>/<ident>/info.json.
+    '''
+    def __init__(self, root, base_uri):
+        self.root = root
+        self.base_uri = base_uri.rstrip('/')
+
+    def _fp(self, image_request):
+        return path.join(self.root, unquote(image_request.as_path))
+
+    def exists(self, image_request):
+        return path.exists(self._fp(image_request))
+
+    def target_fp(self, image_request):
+        fp = self._fp(image_request)
+        _makedirs(path.dirname(fp))
+        return fp
+
+    def done(self, image_request, target_fp):
+        pass
+
+    def finish(self, ident, info, tiles):
+        ident = unquote(ident)
+        d = info.to_dict()
+        d['@id'] = '%s/%s' % (self.base_uri, ident)
+        d['profile'] = [LEVEL0_COMPLIANCE]
+        d['tiles'] = tiles
+        d['sizes'] = info.sizes or []
+        info_fp = path.join(self.root, ident, 'info.json')
+        _makedirs(path.dirname(info_fp))
+        tmp_fp = '%s.%s' % (info_fp, uuid.uuid4().hex)
+        with open(tmp_fp, 'w') as f:
+            json.dump(d, f)
+        rename(tmp_fp, info_fp)
+
+
+class Pregenerator(object):
+    '''
+    Slots:
+        app (webapp.Loris): for its resolver and transformers.
+        output (CacheOutput|StaticOutput)
+        formats ([str]): target formats, e.g. ['jpg']
+        tile_size (int): for sources that don't have tiles of their own, or
+            None to only make their sizes (which they don't have either).
+    '''
+    __slots__ = ('app', 'output', 'formats', 'tile_size')
+
+    def __init__(self, app, output, formats=('jpg',), tile_size=256):
+        self.app = app
+        self.output = output
+        self.formats = list(formats)
+        self.tile_size = tile_size
+
+    def run(self, ident):
+        '''Make everything that's missing for one image.
+
+        Returns:
+            dict: ident, made, skipped and seconds.
+        '''
+        start = time.time()
+        src_fp, src_format = self.app.resolver.resolve(ident)
+        transformer = self.app.transformers[src_format]
+        info = ImageInfo.from_image_file(ident, src_fp, src_format,
+            transformer.target_formats, self.app.max_size_above_full)
+
+        tiles = info.tiles
+        if not tiles and self.tile_size:
+            tiles = default_tiles(info, self.tile_size)
+
+        made = skipped = 0
+        for fmt in self.formats:
+            for lvl in pyramid(ident, info, fmt, tiles):
+                todo = []
+                for derivative in lvl.derivatives:
+                    if self.output.exists(derivative.request):
+                        skipped += 1
+                    else:
+                        todo.append(derivative)
+                if todo:
+                    im = self._decode_level(transformer, src_fp, ident, info, lvl)
+                    for derivative in todo:
+                        self._derive(transformer, im, derivative)
+                    made += len(todo)
+
+        self.output.finish(ident, info, tiles)
+        return {'ident' : ident, 'made' : made, 'skipped' : skipped,
+            'seconds' : round(time.time() - start, 3)}
+
+    @staticmethod
+    def _decode_level(transformer, src_fp, ident, info, lvl):
+        level_w, level_h = lvl.size
+        request = ImageRequest(ident, 'full', '%d,' % (level_w,), '0', 'default', 'jpg')
+        request.info = info
+        logger.debug('Decoding %s at 1/%d (%dx%d)' % (ident, lvl.scale, level_w, level_h))
+        im = transformer.decode(src_fp, request)
+        if im.size != lvl.size:
+            im = im.resize(lvl.size, resample=Image.ANTIALIAS)
+        return im
+
+    def _derive(self, transformer, im, derivative):
+        request = derivative.request
+        target_fp = self.output.target_fp(request)
+        dp, fn = path.split(target_fp)
+        tmp_fp = path.join(dp, '.%s.%s' % (uuid.uuid4().hex, fn))
+        try:
+            transformer._derive_with_pil(im.crop(derivative.box), tmp_fp,
+                request, crop=False)
+            rename(tmp_fp, target_fp)
+        finally:
+            if path.exists(tmp_fp):
+                unlink(tmp_fp)
+        self.output.done(request, target_fp)
+
+
+def _makedirs(dp):
+    try:
+        makedirs(dp)
+    except OSError as ose:
+        if ose.errno != errno.EEXIST:
+            raise
+
+def idents_from_root(root):
+    '''Identifiers, relative to `root`, of the images under it.
+    '''
+    for dp, dns, fns in walk(root):
+        dns.sort()
+        for fn in sorted(fns):
+            if fn.lower().endswith(SOURCE_EXTENSIONS):
+                yield path.relpath(path.join(dp, fn), root)
+
+def idents_from_file(f):
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+# One per worker process; see _init_worker
+_pregenerator = None
+
+def _make_app(config_fp):
+    from webapp import create_app
+    if config_fp:
+        return create_app(config_file_path=config_fp)
+    return create_app(debug=True)
+
+def _init_worker(config_fp, static_root, base_uri, formats, tile_size):
+    global _pregenerator
+    app = _make_app(config_fp)
+    if static_root:
+        output = StaticOutput(static_root, base_uri)
+    elif app.enable_caching:
+        output = CacheOutput(app.img_cache)
+    else:
+        raise ValueError('Caching is off in the config; give --static instead')
+    _pregenerator = Pregenerator(app, output, formats, tile_size)
+
+def _run_one(ident):
+    try:
+        return _pregenerator.run(ident)
+    except Exception as e:
+        logger.exception('Could not pregenerate %s' % (ident,))
+        return {'ident' : ident, 'error' : '%s: %s' % (e.__class__.__name__, e)}
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Pre-generate IIIF tiles and sizes.')
+    parser.add_argument('--config', help='loris2.conf to use (default: the '
+        'dev config, as with create_app(debug=True))')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--ids', help='file with one identifier per line, or - for stdin')
+    source.add_argument('--root', help='make identifiers from the images under this directory')
+    parser.add_argument('--static', metavar='DIR', help='write a static level 0 '
+        'tree here instead of into the image cache')
+    parser.add_argument('--base-uri', default='http://localhost',
+        help='for @id in the static info.json files')
+    parser.add_argument('--formats', default='jpg', help='comma separated')
+    parser.add_argument('--tile-size', type=int, default=256,
+        help='for sources without tiles of their own; 0 for none')
+    parser.add_argument('--processes', type=int, default=None,
+        help='worker processes (default: one per CPU)')
+    args = parser.parse_args(argv)
+
+    if args.ids:
+        f = sys.stdin if args.ids == '-' else open(args.ids)
+        idents = list(idents_from_file(f))
+    else:
+        idents = list(idents_from_root(args.root))
+
+    initargs = (args.config, args.static, args.base_uri,
+        args.formats.split(','), args.tile_size or None)
+    pool = Pool(args.processes, initializer=_init_worker, initargs=initargs)
+    totals = {'images' : 0, 'made' : 0, 'skipped' : 0, 'errors' : 0}
+    try:
+        for result in pool.imap_unordered(_run_one, idents):
+            totals['images'] += 1
+            if 'error' in result:
+                totals['errors'] += 1
+            else:
+                totals['made'] += result['made']
+                totals['skipped'] += result['skipped']
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    sys.stderr.write('%(images)d images: %(made)d made, %(skipped)d already '
+        'there, %(errors)d errors\n' % totals)
+    return 1 if totals['errors'] else 0
@@ -11,17 +11,98 @@ from os import makedirs, rename, remove
 from shutil import copy
 import tempfile
 from urllib import unquote, quote_plus
-from contextlib import closing
-from collections import defaultdict
+from lru import ShardedLRU
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from threading import BoundedSemaphore, Lock
+from urlparse import urlparse
 
 import constants
 import hashlib
 import glob
 import requests
 import re
+import sys
+import time
 
 logger = getLogger(__name__)
 
+# the suffix of the CIIM Solr fields with each size's media location
+MEDIA_LOCATION = 'MediaLocation'
+
+# how much of what's left of a response is read to keep its connection
+DRAIN_BYTES = 64 * 1024
+
+
+class _Remembered(object):
+    '''What was found out about keys (including that there was nothing to
+    find), for a while.
+
+    Slots:
+        _lru (lru.ShardedLRU): key -> (expiry, value)
+    '''
+    __slots__ = ('_lru',)
+
+    def __init__(self, entries):
+        self._lru = ShardedLRU(entries, sys.maxint)
+
+    def get(self, key):
+        '''
+        Returns:
+            (bool, object): (True, value) if key is remembered and hasn't
+            expired, else (False, None).
+        '''
+        entry = self._lru.get(key)
+        if entry is None or entry[0] <= time.time():
+            return (False, None)
+        return (True, entry[1])
+
+    def put(self, key, value, ttl):
+        self._lru.put(key, (time.time() + ttl, value))
+
+
+class _Origin(object):
+    '''A server that source images come from (or, for TemplateHTTPResolver,
+    a template): a session, which keeps up to pool_size connections to it
+    open and tries again (with backoff) when one can't be made, and a cap on
+    how many images are fetched from it at once.
+
+    Slots:
+        session (requests.Session)
+        timeout (float): seconds.
+        fetches (threading.BoundedSemaphore): max_fetches of them.
+    '''
+    __slots__ = ('session', 'timeout', 'fetches')
+
+    def __init__(self, pool_size, timeout, retries, backoff, max_fetches):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=backoff))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = timeout
+        self.fetches = BoundedSemaphore(max_fetches)
+
+    def head(self, url, **options):
+        return self.session.head(url, timeout=self.timeout, **options)
+
+    def get(self, url, **options):
+        return self.session.get(url, timeout=self.timeout, **options)
+
+
+def _release(response):
+    # Give a streamed response's connection back to the pool, once the body
+    # has been read; closing it with the body unread would leave the rest
+    # for whoever uses the connection next. If more than DRAIN_BYTES are
+    # left (e.g. all of an image, from a server that ignored Range) the
+    # connection is dropped instead.
+    if not response.raw.closed:
+        response.raw.read(DRAIN_BYTES)
+        if not response.raw.closed:
+            response.raw.close()
+            return
+    response.close()
+
 
 class _AbstractResolver(object):
 
@@ -146,6 +227,16 @@ class SimpleHTTPResolver(_AbstractResolver):
      self-signed certificate.
      * `cert`, path to an SSL client certificate to use for authentication. If `cert` and `key` are both present, they take precedence over `user` and `pw` for authetication.
      * `key`, path to an SSL client key to use for authentication.
+     * `timeout`, seconds to wait for the server to connect or send (default
+       10).
+     * `pool_size`, connections kept open to each server (default 10).
+     * `retries`, times a request that couldn't connect (or was cut off
+       before the response) is tried again (default 2), waiting `backoff`
+       (default 0.2) seconds, then twice that, and so on.
+     * `max_fetches`, source images fetched from each server at once, per
+       process (default `pool_size`).
+     * `probe_ttl`, seconds what is_resolvable() found out (or that an image
+       isn't there) is remembered for (default 60).
     '''
     def __init__(self, config):
         super(SimpleHTTPResolver, self).__init__(config)
@@ -172,6 +263,25 @@ class SimpleHTTPResolver(_AbstractResolver):
 
         self.ident_regex = self.config.get('ident_regex', False)
 
+        self.timeout = float(self.config.get('timeout', 10))
+
+        self.pool_size = int(self.config.get('pool_size', 10))
+
+        self.retries = int(self.config.get('retries', 2))
+
+        self.backoff = float(self.config.get('backoff', 0.2))
+
+        self.max_fetches = int(self.config.get('max_fetches', self.pool_size))
+
+        self.probe_ttl = float(self.config.get('probe_ttl', 60))
+
+        # ident -> whether it's there
+        self._probes = _Remembered(int(self.config.get('probe_entries', 100000)))
+
+        self._origins = {}
+
+        self._origins_lock = Lock()
+
         if 'cache_root' in self.config:
             self.cache_root = self.config['cache_root']
         else:
@@ -195,6 +305,26 @@ class SimpleHTTPResolver(_AbstractResolver):
         options['verify'] = self.ssl_check
         return options
 
+    def _origin(self, key, conf):
+        # The _Origin for key, made with any settings in conf (e.g. a
+        # template's) in place of the resolver's.
+        origin = self._origins.get(key)
+        if origin is None:
+            with self._origins_lock:
+                origin = self._origins.get(key)
+                if origin is None:
+                    origin = _Origin(int(conf.get('pool_size', self.pool_size)),
+                        float(conf.get('timeout', self.timeout)),
+                        int(conf.get('retries', self.retries)),
+                        float(conf.get('backoff', self.backoff)),
+                        int(conf.get('max_fetches', self.max_fetches)))
+                    self._origins[key] = origin
+        return origin
+
+    def _origin_for(self, ident, url):
+        # one per scheme and host
+        return self._origin(urlparse(url)[:2], {})
+
     def is_resolvable(self, ident):
         ident = unquote(ident)
 
@@ -206,20 +336,26 @@ class SimpleHTTPResolver(_AbstractResolver):
         fp = join(self.cache_root, SimpleHTTPResolver._cache_subroot(ident))
         if exists(fp):
             return True
-        else:
-            (url, options) = self._web_request_url(ident)
 
-            if self.head_resolvable:
-                response = requests.head(url, **options)
-                if response.ok:
-                    return True
+        known, found = self._probes.get(ident)
+        if known:
+            return found
 
-            else:
-                with closing(requests.get(url, stream=True, **options)) as response:
-                    if response.ok:
-                        return True
-
-        return False
+        (url, options) = self._web_request_url(ident)
+        origin = self._origin_for(ident, url)
+        if self.head_resolvable:
+            response = origin.head(url, **options)
+        else:
+            # just the first byte, from servers that will
+            response = origin.get(url, stream=True, headers={'Range' : 'bytes=0-0'},
+                **options)
+        try:
+            found = response.ok
+        finally:
+            _release(response)
+        if response.status_code < 500:
+            self._probes.put(ident, found, self.probe_ttl)
+        return found
 
     def get_format(self, ident, potential_format):
         if self.default_format is not None:
@@ -314,34 +450,48 @@ class SimpleHTTPResolver(_AbstractResolver):
 
     def copy_to_cache(self, ident):
         ident = unquote(ident)
+        known, found = self._probes.get(ident)
+        if known and not found:
+            self.raise_404_for_ident(ident)
         cache_dir = self.cache_dir_path(ident)
         self._create_cache_dir(cache_dir)
 
         #get source image and write to temporary file
         (source_url, options) = self._web_request_url(ident)
-        with closing(requests.get(source_url, stream=True, **options)) as response:
-            if not response.ok:
-                public_message = 'Source image not found for identifier: %s. Status code returned: %s' % (ident,response.status_code)
-                log_message = 'Source image not found at %s for identifier: %s. Status code returned: %s' % (source_url,ident,response.status_code)
-                logger.warn(log_message)
-                raise ResolverException(404, public_message)
-
-            extension = self.cache_file_extension(ident, response)
-            local_fp = join(cache_dir, "loris_cache." + extension)
-
-            with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tmp_file:
-                for chunk in response.iter_content(2048):
-                    tmp_file.write(chunk)
-                tmp_file.flush()
-
-            #now rename the tmp file to the desired file name if it still doesn't exist
-            #   (another process could have created it)
-            if exists(local_fp):
-                logger.info('another process downloaded src image %s' % local_fp)
-                remove(tmp_file.name)
-            else:
-                rename(tmp_file.name, local_fp)
-                logger.info("Copied %s to %s" % (source_url, local_fp))
+        origin = self._origin_for(ident, source_url)
+        with origin.fetches:
+            response = origin.get(source_url, stream=True, **options)
+            try:
+                local_fp = self._save(ident, source_url, response, cache_dir)
+            finally:
+                _release(response)
+        return local_fp
+
+    def _save(self, ident, source_url, response, cache_dir):
+        if not response.ok:
+            if response.status_code < 500:
+                self._probes.put(ident, False, self.probe_ttl)
+            public_message = 'Source image not found for identifier: %s. Status code returned: %s' % (ident,response.status_code)
+            log_message = 'Source image not found at %s for identifier: %s. Status code returned: %s' % (source_url,ident,response.status_code)
+            logger.warn(log_message)
+            raise ResolverException(404, public_message)
+
+        extension = self.cache_file_extension(ident, response)
+        local_fp = join(cache_dir, "loris_cache." + extension)
+
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tmp_file:
+            for chunk in response.iter_content(2048):
+                tmp_file.write(chunk)
+            tmp_file.flush()
+
+        #now rename the tmp file to the desired file name if it still doesn't exist
+        #   (another process could have created it)
+        if exists(local_fp):
+            logger.info('another process downloaded src image %s' % local_fp)
+            remove(tmp_file.name)
+        else:
+            rename(tmp_file.name, local_fp)
+            logger.info("Copied %s to %s" % (source_url, local_fp))
 
         return local_fp
 
@@ -371,7 +521,9 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
        url='http://example.edu/images/%s/master'. It MAY also contain other keys
        from the SimpleHTTPResolver configuration to provide a per-template
        override of these options. Overridable keys are `user`, `pw`,
-       `ssl_check`, `cert`, and `key`.
+       `ssl_check`, `cert`, and `key`, and `timeout`, `pool_size`, `retries`,
+       `backoff` and `max_fetches`, which are then for that template alone
+       (each template has its own connections, and its own cap on fetches).
 
     Note that if a template is listed but has no pattern configured, the
     resolver will warn but not fail.
@@ -439,6 +591,11 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
                 options['verify'] = conf['ssl_check']
             return (url, options)
 
+    def _origin_for(self, ident, url):
+        # one per template, with its settings
+        prefix = ident.split(':', 1)[0]
+        return self._origin(('template', prefix), self.templates.get(prefix, {}))
+
 
 class SourceImageCachingResolver(_AbstractResolver):
     '''
@@ -506,52 +663,65 @@ object-12345/media-12345/large
 object-98765432/media-987654/mid
 """
 class IwmFSResolver(SimpleFSResolver):
-    def __init__(self, config):
-        super(SimpleFSResolver, self).__init__(config)
-        if 'src_img_roots' in self.config:
-            self.source_roots = self.config['src_img_roots']
-        else:
-            self.source_roots = [self.config['src_img_root']]
+    '''
+    Looks identifiers up in the CIIM Solr index, which has where each size
+    of each media file is, relative to the source roots.
 
-    """
-    Raises 404 exception if the identifier is
-    not resolvable
+    One query gets every size (`*MediaLocation`) of a media file, and they
+    are remembered together, so the other sizes of it don't need another.
+    Where an identifier resolved to, or that it didn't, is remembered too,
+    and shared by is_resolvable() and resolve(). Queries go through a
+    session, so connections to Solr are kept open and reused.
 
-    @param self IwmFSResolver
-    @param ident string
-    """
-    def raise_404_for_ident(self, ident):
-        message = 'Source image not found for identifier: %s.' % (ident,)
-        logger.warn(message)
-        raise ResolverException(404, message)
+    The config dictionary MUST contain
+     * `ciim_url`, the URL of the Solr select handler.
+     * `src_img_root` or `src_img_roots`.
+
+    The config dictionary MAY contain
+     * `solr_timeout`, seconds to wait for Solr (default 5).
+     * `solr_pool_size`, connections to Solr kept open (default 10).
+     * `resolved_ttl`, seconds a resolved identifier is remembered (default
+       300).
+     * `missing_ttl`, seconds one that didn't resolve is remembered (default
+       30).
+     * `resolved_entries`, the most identifiers remembered (default 100000).
+    '''
+    def __init__(self, config):
+        super(IwmFSResolver, self).__init__(config)
+        self.ciim_url = self.config.get('ciim_url')
+        self.solr_timeout = float(self.config.get('solr_timeout', 5))
+        self.resolved_ttl = float(self.config.get('resolved_ttl', 300))
+        self.missing_ttl = float(self.config.get('missing_ttl', 30))
+        entries = int(self.config.get('resolved_entries', 100000))
+        # ident -> fp or None
+        self._resolved = _Remembered(entries)
+        # (object_id, media_id) -> {size: location}
+        self._locations = _Remembered(entries)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=int(self.config.get('solr_pool_size', 10)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     """
-    Parses the json value and returns the path
-    to the media file
+    Parses the json value and returns the path to every size of the media
+    file, relative to the source roots
 
     @param self IwmFSResolver
-    @param json_val list
-    @param image_size_id string
+    @param json_val dict
     @param media_id string
 
-    @return string | None
+    @return dict
     """
-    def parse_json_val(self, json_val, image_size_id, media_id):
-        num_found = json_val['response']['numFound']
-
-        if num_found > 0:
-            docs = json_val['response']['docs']
-            media_location = defaultdict(list)
-
-            for el in docs:
-                media_reference = el['mediaReference']
-                media_locations = el[image_size_id]
-
-                for counter, reference in enumerate(media_reference):
-                    if reference == media_id:
-                        return media_locations[counter]
-        else:
-            return None
+    def parse_json_val(self, json_val, media_id):
+        locations = {}
+        for el in json_val['response']['docs']:
+            for counter, reference in enumerate(el['mediaReference']):
+                if reference != media_id:
+                    continue
+                for field, values in el.iteritems():
+                    if field.endswith(MEDIA_LOCATION) and counter < len(values):
+                        locations.setdefault(field[:-len(MEDIA_LOCATION)], values[counter])
+        return locations
 
     """
     Checks whether an identifier is resolvable or not.
@@ -577,8 +747,31 @@ class IwmFSResolver(SimpleFSResolver):
         return source_fp.split('.')[-1]
 
     """
-    Queries the SOLR server and returns
-    the file path for a given identifier
+    Queries the SOLR server (unless it was asked recently) and returns the
+    path to every size of a media file, relative to the source roots
+
+    @param self IwmFSResolver
+    @param object_id string
+    @param media_id string
+
+    @return dict
+    """
+    def media_locations(self, object_id, media_id):
+        key = (object_id, media_id)
+        known, locations = self._locations.get(key)
+        if known:
+            return locations
+        data = {'q':'identifier:'+object_id+' AND mediaReference:'+media_id,
+            'fl':'*'+MEDIA_LOCATION+',mediaReference', 'wt':'json'}
+        # A timeout or an error from Solr raises, and isn't remembered.
+        r = self.session.get(self.ciim_url, params=data, timeout=self.solr_timeout)
+        r.raise_for_status()
+        locations = self.parse_json_val(r.json(), media_id)
+        self._remember(self._locations, key, locations)
+        return locations
+
+    """
+    Returns the file path for a given identifier, or None
 
     @param self IwmFSResolver
     @param ident string
@@ -588,24 +781,29 @@ class IwmFSResolver(SimpleFSResolver):
     def source_file_path(self, ident):
         # URL decode the identifier
         ident = unquote(ident) # = object-123456/media-654321/large
+        known, fp = self._resolved.get(ident)
+        # (a file that has gone since is looked for again)
+        if known and (fp is None or exists(fp)):
+            return fp
 
         # Split the ident string by forward slashes
         # This should have 3 values
-        object_id, media_id, size = ident.split('/')
-
-        image_size_id = size+'MediaLocation'
-        request_url = self.config['ciim_url']
-        data = {'q':'identifier:'+object_id+' AND mediaReference:'+media_id, 'fl':image_size_id+',mediaReference', 'wt':'json'}
-
-        r = requests.get(request_url, params=data)
-
-        fpath = self.parse_json_val(r.json(), image_size_id, media_id)
-
-        if not fpath is None:
-            for directory in self.source_roots:
-                fp = join(directory, fpath)
-                if exists(fp):
-                    return fp
+        parts = ident.split('/')
+        fp = None
+        if len(parts) == 3:
+            object_id, media_id, size = parts
+            fpath = self.media_locations(object_id, media_id).get(size)
+            if not fpath is None:
+                for directory in self.source_roots:
+                    if exists(join(directory, fpath)):
+                        fp = join(directory, fpath)
+                        break
+        self._remember(self._resolved, ident, fp)
+        return fp
+
+    def _remember(self, remembered, key, value):
+        ttl = self.resolved_ttl if value else self.missing_ttl
+        remembered.put(key, value, ttl)
 
     """
     Main method of this class which gets
@@ -618,10 +816,9 @@ class IwmFSResolver(SimpleFSResolver):
     """
     def resolve(self, ident):
         # ident = object-123456/media-654321/large
-        if not self.is_resolvable(ident):
-            self.raise_404_for_ident(ident)
-
         source_fp = self.source_file_path(ident)
+        if source_fp is None:
+            self.raise_404_for_ident(ident)
         format = self.format_from_source_fp(source_fp)
 
         return (source_fp, format)
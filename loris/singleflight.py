@@ -0,0 +1,152 @@
+# singleflight.py
+#-*-coding:utf-8-*-
+'''
+Coalesces concurrent, identical pieces of work (derivative renders, info
+extraction) so that only one of them actually runs.
+
+Within a process, callers share a threading.Event per key. Across processes,
+the first caller creates a lock file next to the target (`<key>.lock`) with
+O_CREAT|O_EXCL; everyone else polls for the lock file to go away.
+'''
+
+from errno import EEXIST, ENOENT
+from logging import getLogger
+from os import path, makedirs, getpid, unlink
+from threading import Event, Lock
+import os
+import time
+
+logger = getLogger(__name__)
+
+LOCK_SUFFIX = '.lock'
+
+class SingleFlight(object):
+    '''Runs at most one of any number of concurrent calls with the same key.
+
+    Slots:
+        timeout (float):
+            Seconds a follower waits for the leader before it gives up and
+            does the work itself. This is also the age after which a lock file
+            is considered to have been abandoned by a dead process.
+        poll_interval (float):
+            Seconds between checks for the lock file of another process.
+        _flights ({str: Event}): in-process flights, keyed like the lock files.
+        _lock (Lock): guards _flights.
+    '''
+    __slots__ = ('timeout', 'poll_interval', '_flights', '_lock')
+
+    def __init__(self, timeout=30, poll_interval=0.05):
+        self.timeout = float(timeout)
+        self.poll_interval = float(poll_interval)
+        self._flights = {}
+        self._lock = Lock()
+
+    def run(self, key, work, is_done):
+        '''Do `work` unless someone else is already doing it.
+
+        Args:
+            key (str):
+                The absolute path of the thing being made; `<key>.lock` is
+                used as the lock file.
+            work (callable):
+                Makes the thing. Its return value is ignored.
+            is_done (callable):
+                Returns True if the thing already exists. It is checked before
+                doing anything, after acquiring the lock (the previous holder
+                may have just finished), and after waiting.
+        Returns:
+            bool: True if this call did the work, False if someone else did.
+        '''
+        if is_done():
+            return False
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Event()
+                self._flights[key] = flight
+
+        if not leader:
+            logger.debug('Waiting on in-process flight for %s' % (key,))
+            flight.wait(self.timeout)
+            if is_done():
+                return False
+            logger.warn('Gave up waiting on %s; doing it ourselves' % (key,))
+            work()
+            return True
+
+        try:
+            return self._run_as_leader(key, work, is_done)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.set()
+
+    def _run_as_leader(self, key, work, is_done):
+        lock_fp = key + LOCK_SUFFIX
+        if self._acquire(lock_fp):
+            try:
+                if is_done():
+                    return False
+                work()
+                return True
+            finally:
+                self._release(lock_fp)
+        else:
+            logger.debug('Waiting on %s' % (lock_fp,))
+            self._wait_for_release(lock_fp)
+            if is_done():
+                return False
+            logger.warn('Gave up waiting on %s; doing it ourselves' % (lock_fp,))
+            work()
+            return True
+
+    def _acquire(self, lock_fp):
+        for attempt in (0, 1):
+            try:
+                fd = os.open(lock_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError as ose:
+                if ose.errno == ENOENT:
+                    SingleFlight._make_parent(lock_fp)
+                    continue
+                if ose.errno != EEXIST:
+                    raise
+                if attempt == 0 and self._is_stale(lock_fp):
+                    logger.warn('Removing stale lock %s' % (lock_fp,))
+                    self._release(lock_fp)
+                    continue
+                return False
+            else:
+                os.write(fd, str(getpid()))
+                os.close(fd)
+                return True
+        return False
+
+    @staticmethod
+    def _make_parent(lock_fp):
+        try:
+            makedirs(path.dirname(lock_fp))
+        except OSError as ose:
+            if ose.errno != EEXIST:
+                raise
+
+    @staticmethod
+    def _release(lock_fp):
+        try:
+            unlink(lock_fp)
+        except OSError as ose:
+            if ose.errno != ENOENT:
+                raise
+
+    def _is_stale(self, lock_fp):
+        try:
+            age = time.time() - path.getmtime(lock_fp)
+        except OSError:
+            return False
+        return age > self.timeout
+
+    def _wait_for_release(self, lock_fp):
+        deadline = time.time() + self.timeout
+        while path.exists(lock_fp) and time.time() < deadline:
+            time.sleep(self.poll_interval)
@@ -2,18 +2,17 @@
 # -*- coding: utf-8 -*-
 
 from PIL import Image
-from PIL.ImageFile import Parser
 from PIL.ImageOps import mirror
 from logging import getLogger
 from loris_exception import LorisException
+from loris_exception import ImageException
+from decoded_cache import DecodedImageCache
+from decode_pipe import DecoderException, FifoPool, PNMReader, run_decoder
+from openjpeg import Decoder, OpenJPEGException
 from math import ceil, log
-from os import makedirs, path, unlink, devnull
-from parameters import FULL_MODE
+from os import makedirs, path
 import cStringIO
 import platform
-import random
-import string
-import subprocess
 import sys
 try:
     from PIL.ImageCms import profileToProfile # Pillow
@@ -36,8 +35,22 @@ class _AbstractTransformer(object):
             target_fp (str)
             image (ImageRequest)
         '''
-        e = self.__class__.__name__
-        raise NotImplementedError('transform() not implemented for %s' % (cn,))
+        im = self.decode(src_fp, image_request)
+        self._derive_with_pil(im, target_fp, image_request, crop=False)
+
+    def decode(self, src_fp, image_request):
+        '''Get the requested region of the source. Implementations may reduce
+        it on the way (e.g. a JP2 resolution level) as long as it is still at
+        least the requested size; _derive_with_pil() takes it from there.
+
+        Args:
+            src_fp (str)
+            image_request (ImageRequest)
+        Returns:
+            PIL.Image
+        '''
+        cn = self.__class__.__name__
+        raise NotImplementedError('decode() not implemented for %s' % (cn,))
 
     def _derive_with_pil(self, im, target_fp, image_request, rotate=True, crop=True):
         '''
@@ -70,11 +83,13 @@ class _AbstractTransformer(object):
             logger.debug('cropping to: %s' % (repr(box),))
             im = im.crop(box)
 
-        # resize
+        # resize (unless the decoder already took care of it, e.g. a JP2
+        # region decoded at a reduced resolution level)
         if image_request.size_param.canonical_uri_value != 'full':
-            wh = [int(image_request.size_param.w),int(image_request.size_param.h)]
-            logger.debug('Resizing to: %s' % (repr(wh),) )
-            im = im.resize(wh, resample=Image.ANTIALIAS)
+            wh = (int(image_request.size_param.w),int(image_request.size_param.h))
+            if im.size != wh:
+                logger.debug('Resizing to: %s' % (repr(wh),) )
+                im = im.resize(wh, resample=Image.ANTIALIAS)
 
 
         if image_request.rotation_param.mirror:
@@ -125,16 +140,116 @@ class _AbstractTransformer(object):
          
 
 class _PillowTransformer(_AbstractTransformer):
+    '''
+    Decoded sources are kept in a DecodedImageCache of `decoded_cache_mb` MB
+    (per process) if that is set to more than 0.
+    '''
     def __init__(self, config):
+        cache_mb = float(config.get('decoded_cache_mb', 0))
+        if cache_mb > 0:
+            self.decoded_cache = DecodedImageCache(int(cache_mb * 1048576))
+        else:
+            self.decoded_cache = None
         super(_PillowTransformer, self).__init__(config)
 
-    def transform(self, src_fp, target_fp, image_request):
-        im = Image.open(src_fp)
-        self._derive_with_pil(im, target_fp, image_request)
+    def decode(self, src_fp, image_request):
+        if self.decoded_cache is not None:
+            im = self.decoded_cache.get(src_fp, Image.open)
+            return self._crop_shared(im, image_request)
+        return self._crop(Image.open(src_fp), image_request)
+
+    def _crop_shared(self, im, image_request):
+        '''_crop() an image from the decoded cache. Other requests have it
+        too, and save() sets encoderinfo and encoderconfig on the image it is
+        called on, so if _crop() leaves it as it is (a full region) this makes
+        a copy.
+        '''
+        cropped = self._crop(im, image_request)
+        if cropped is im:
+            cropped = im.copy()
+        return cropped
+
+    def _crop(self, im, image_request):
+        '''Crop a decoded source, which may be smaller than the source itself,
+        to the requested region.
+        '''
+        region = image_request.region_param
+        if region.canonical_uri_value == 'full':
+            return im
+        full_w, full_h = image_request.info.width, image_request.info.height
+        if im.size == (full_w, full_h):
+            # For PIL: "The box is a 4-tuple defining the left, upper, right,
+            # and lower pixel coordinate."
+            box = (region.pixel_x, region.pixel_y,
+                region.pixel_x + region.pixel_w, region.pixel_y + region.pixel_h)
+        else:
+            # libjpeg rounds reduced dimensions up, so the actual scale is
+            # the ratio of the sizes.
+            sx = float(im.size[0]) / full_w
+            sy = float(im.size[1]) / full_h
+            box = (
+                int(region.pixel_x * sx),
+                int(region.pixel_y * sy),
+                min(int(ceil((region.pixel_x + region.pixel_w) * sx)), im.size[0]),
+                min(int(ceil((region.pixel_y + region.pixel_h) * sy)), im.size[1])
+            )
+        logger.debug('cropping (%s) to: %s' % (im.size, repr(box)))
+        return im.crop(box)
 
 class JPG_Transformer(_PillowTransformer):
+    '''
+    Uses libjpeg's DCT scaling (Pillow's draft()) to decode at 1/2, 1/4 or 1/8
+    of the full size when the requested size allows it, and only the luma
+    channel for gray and bitonal requests.
+    '''
+    DRAFT_SCALES = (8, 4, 2)
+
     def __init__(self, config): super(JPG_Transformer, self).__init__(config)
 
+    def _draft_scale(self, image_request):
+        '''
+        Returns (int): the largest of DRAFT_SCALES at which the region is
+            still at least as big as the requested size, or 1.
+        '''
+        if image_request.size_param.canonical_uri_value == 'full':
+            return 1
+        region_w = image_request.region_param.pixel_w
+        region_h = image_request.region_param.pixel_h
+        size_w = int(image_request.size_param.w)
+        size_h = int(image_request.size_param.h)
+        for scale in JPG_Transformer.DRAFT_SCALES:
+            if region_w // scale >= size_w and region_h // scale >= size_h:
+                return scale
+        return 1
+
+    @staticmethod
+    def _draft_mode(image_request):
+        if image_request.quality in ('gray', 'bitonal'):
+            return 'L'
+        return None
+
+    @staticmethod
+    def _open_draft(src_fp, scale, mode):
+        im = Image.open(src_fp)
+        draft_size = (im.size[0] // scale, im.size[1] // scale) if scale > 1 else None
+        if mode != im.mode or draft_size:
+            # draft() only takes 'L' from RGB (YCbCr) JPEGs; otherwise it
+            # keeps the source's mode.
+            im.draft(mode or im.mode, draft_size)
+        return im
+
+    def decode(self, src_fp, image_request):
+        scale = self._draft_scale(image_request)
+        mode = JPG_Transformer._draft_mode(image_request)
+        if scale == 1 and mode is None:
+            return super(JPG_Transformer, self).decode(src_fp, image_request)
+
+        load = lambda fp: JPG_Transformer._open_draft(fp, scale, mode)
+        if self.decoded_cache is not None:
+            im = self.decoded_cache.get(src_fp, load, variant=(scale, mode))
+            return self._crop_shared(im, image_request)
+        return self._crop(load(src_fp), image_request)
+
 class TIF_Transformer(_PillowTransformer):
     def __init__(self, config): super(TIF_Transformer, self).__init__(config)
 
@@ -149,7 +264,6 @@ class _AbstractJP2Transformer(_AbstractTransformer):
     '''
     def __init__(self, config):
         self.map_profile_to_srgb = bool(config['map_profile_to_srgb'])
-        self.mkfifo = config['mkfifo']
         self.tmp_dp = config['tmp_dp']
 
         if self.map_profile_to_srgb and \
@@ -172,11 +286,49 @@ class _AbstractJP2Transformer(_AbstractTransformer):
             logger.fatal('Exiting')
             exit(77)
 
+        self.fifos = FifoPool(self.tmp_dp)
         super(_AbstractJP2Transformer, self).__init__(config)
 
-    def _make_tmp_fp(self, fmt='bmp'):
-        n = ''.join(random.choice(string.ascii_lowercase) for x in range(5))
-        return '%s.%s' % (path.join(self.tmp_dp, n), fmt)
+    def _run_decoder(self, make_argv, env, image_request):
+        '''Run a decoder that writes a PGM or PPM to a FIFO and read back what
+        it made.
+
+        Args:
+            make_argv (callable): given the FIFO's path, returns the command.
+            env (dict): the decoder's environment.
+            image_request (ImageRequest)
+        Returns:
+            PIL.Image
+        Raises:
+            ImageException: if the decoder fails.
+        '''
+        fmt = self._pnm_format(image_request)
+        fifo_fp = self.fifos.acquire(fmt)
+        ok = False
+        try:
+            im = run_decoder(make_argv(fifo_fp), fifo_fp, env, PNMReader())
+            ok = True
+        except (DecoderException, IOError) as e:
+            logger.error(str(e))
+            raise ImageException(500, str(e))
+        finally:
+            self.fifos.release(fifo_fp, reuse=ok)
+        return im
+
+    def _map_profile(self, im, image_request):
+        if self.map_profile_to_srgb and image_request.info.color_profile_bytes:  # i.e. is not None
+            emb_profile = cStringIO.StringIO(image_request.info.color_profile_bytes)
+            im = profileToProfile(im, emb_profile, self.srgb_profile_fp)
+        return im
+
+    def _pnm_format(self, image_request):
+        '''Gray sources are decoded to a single channel (PGM); anything else
+        to a PPM, which _derive_with_pil() converts if gray or bitonal was
+        requested.
+        '''
+        if 'color' in image_request.info.profile[1]['qualities']:
+            return 'ppm'
+        return 'pgm'
 
     def _scale_dim(self, dim, scale):
         return int(ceil(dim/float(scale)))
@@ -190,17 +342,32 @@ class _AbstractJP2Transformer(_AbstractTransformer):
                     self._scale_dim(full_h,s) >= req_h])
 
     def _scales_to_reduce_arg(self, image_request):
-        # Scales from from JP2 levels, so even though these are from the tiles
-        # info.json, it's easier than using the sizes from info.json
-        scales = [s for t in image_request.info.tiles for s in t['scaleFactors']]
-        is_full_region = image_request.region_param.mode == FULL_MODE
+        '''
+        The number of resolution levels to discard: the largest one at which
+        the requested region is still at least as big as the requested size.
+        This applies to any region (not just 'full'), e.g. deep zoom tiles at
+        low zoom levels. Both decoders take the region in full resolution
+        coordinates (kdu as fractions, opj on the reference grid), so only the
+        output size changes.
+
+        Returns (str): e.g. '2', or None if the image has no levels.
+        '''
+        info = image_request.info
+        if info.jp2 is not None:
+            levels = info.jp2.codestream.levels
+            scales = [pow(2, l) for l in range(levels + 1)]
+        else:
+            # Info from the cache (JSON) doesn't have the codestream header.
+            # Scales from from JP2 levels, so even though these are from the
+            # tiles info.json, it's easier than using the sizes from info.json
+            scales = [s for t in info.tiles for s in t['scaleFactors']]
         arg = None
-        if scales and is_full_region:
-            full_w = image_request.info.width
-            full_h = image_request.info.height
+        if scales:
+            region_w = image_request.region_param.pixel_w
+            region_h = image_request.region_param.pixel_h
             req_w = image_request.size_param.w
             req_h = image_request.size_param.h
-            closest_scale = self._get_closest_scale(req_w, req_h, full_w, full_h, scales)
+            closest_scale = self._get_closest_scale(req_w, req_h, region_w, region_h, scales)
             reduce_arg = int(log(closest_scale, 2))
             arg = str(reduce_arg)
         return arg
@@ -261,58 +428,53 @@ class OPJ_JP2Transformer(_AbstractJP2Transformer):
         logger.debug('opj region parameter: %s' % (arg,))
         return arg
 
-    def transform(self, src_fp, target_fp, image_request):
-        # opj writes to this:
-        fifo_fp = self._make_tmp_fp()
-
-        # make the named pipe
-        mkfifo_call = '%s %s' % (self.mkfifo, fifo_fp)
-        logger.debug('Calling %s' % (mkfifo_call,))
-        resp = subprocess.check_call(mkfifo_call, shell=True)
-        if resp != 0:
-            logger.error('Problem with mkfifo')
-        # how to handle CalledProcessError; would have to be a 500?
-
-        # opj_decompress command
-        i = '-i "%s"' % (src_fp,)
-        o = '-o %s' % (fifo_fp,)
+    def decode(self, src_fp, image_request):
+        opts = []
         region_arg = self._region_to_opj_arg(image_request.region_param)
-        reg = '-d %s' % (region_arg,) if region_arg else ''
+        if region_arg:
+            opts += ['-d', region_arg]
         reduce_arg = self._scales_to_reduce_arg(image_request)
-        red = '-r %s' % (reduce_arg,) if reduce_arg else ''
+        if reduce_arg:
+            opts += ['-r', reduce_arg]
 
-        opj_cmd = ' '.join((self.opj_decompress,i,reg,red,o))
+        make_argv = lambda fifo_fp: \
+            [self.opj_decompress, '-i', src_fp] + opts + ['-o', fifo_fp]
+        im = self._run_decoder(make_argv, self.env, image_request)
 
-        logger.debug('Calling: %s' % (opj_cmd,))
+        return self._map_profile(im, image_request)
 
-        # Start the shellout. Blocks until the pipe is empty
-        with open(devnull, 'w') as fnull:
-            opj_decompress_proc = subprocess.Popen(opj_cmd, shell=True, bufsize=-1,
-                stderr=fnull, stdout=fnull, env=self.env)
-
-        f = open(fifo_fp, 'rb')
-        logger.debug('Opened %s' % fifo_fp)
+class OPJ_LibJP2Transformer(_AbstractJP2Transformer):
+    '''Decodes in process with libopenjp2 (see openjpeg.py) rather than
+    shelling out to opj_decompress and reading its output back from a pipe.
+    '''
+    def __init__(self, config):
+        self.decoder = Decoder(config.get('libopenjp2'),
+            int(config.get('source_cache_size', 32)))
+        super(OPJ_LibJP2Transformer, self).__init__(config)
 
-        # read from the named pipe
-        p = Parser()
-        while True:
-            s = f.read(1024)
-            if not s:
-                break
-            p.feed(s)
-        im = p.close() # a PIL.Image
+    def _region_to_decode_area(self, region_param):
+        '''
+        Args:
+            region_param (params.RegionParam)
 
-        # finish opj
-        opj_exit = opj_decompress_proc.wait()
-        if opj_exit != 0:
-            map(logger.error, opj_decompress_proc.stderr)
-        unlink(fifo_fp)
+        Returns ((int,int,int,int)): x, y, w, h, or None for the full region.
+        '''
+        if region_param.mode == 'full':
+            return None
+        return (region_param.pixel_x, region_param.pixel_y,
+            region_param.pixel_w, region_param.pixel_h)
 
-        if self.map_profile_to_srgb and image_request.info.color_profile_bytes:  # i.e. is not None
-            emb_profile = cStringIO.StringIO(image_request.info.color_profile_bytes)
-            im = profileToProfile(im, emb_profile, self.srgb_profile_fp)
+    def decode(self, src_fp, image_request):
+        area = self._region_to_decode_area(image_request.region_param)
+        reduce_arg = self._scales_to_reduce_arg(image_request)
+        reduce_ = int(reduce_arg) if reduce_arg else 0
+        logger.debug('Decoding %s, area: %s, reduce: %d' % (src_fp, area, reduce_))
+        try:
+            im = self.decoder.decode(src_fp, area, reduce_)
+        except OpenJPEGException as oe:
+            raise ImageException(500, str(oe))
 
-        self._derive_with_pil(im, target_fp, image_request, crop=False)
+        return self._map_profile(im, image_request)
 
 class KakaduJP2Transformer(_AbstractJP2Transformer):
     def __init__(self, config):
@@ -360,7 +522,7 @@ class KakaduJP2Transformer(_AbstractJP2Transformer):
         Args:
             region_param (params.RegionParam)
 
-        Returns (str): e.g. '\{0.5,0.5\},\{0.5,0.5\}'
+        Returns (str): e.g. '{0.5,0.5},{0.5,0.5}'
         '''
         arg = None
         if region_param.mode != 'full':
@@ -369,64 +531,21 @@ class KakaduJP2Transformer(_AbstractJP2Transformer):
             height = region_param.decimal_h
             width = region_param.decimal_w
 
-            arg = '\{%s,%s\},\{%s,%s\}' % (top, left, height, width)
+            arg = '{%s,%s},{%s,%s}' % (top, left, height, width)
         logger.debug('kdu region parameter: %s' % (arg,))
         return arg
 
-    def transform(self, src_fp, target_fp, image_request):
-
-        # kdu writes to this:
-        fifo_fp = self._make_tmp_fp()
-
-        # kdu command
-        q = '-quiet'
-        t = '-num_threads %s' % (self.num_threads,)
-        i = '-i "%s"' % (src_fp,)
-        o = '-o %s' % (fifo_fp,)
-        reduce_arg = self._scales_to_reduce_arg(image_request)
-        red = '-reduce %s' % (reduce_arg,) if reduce_arg else ''
+    def decode(self, src_fp, image_request):
+        opts = ['-quiet', '-num_threads', str(self.num_threads)]
         region_arg = self._region_to_kdu_arg(image_request.region_param)
-        reg = '-region %s' % (region_arg,) if region_arg else ''
-
-        kdu_cmd = ' '.join((self.kdu_expand,q,i,t,reg,red,o))
+        if region_arg:
+            opts += ['-region', region_arg]
+        reduce_arg = self._scales_to_reduce_arg(image_request)
+        if reduce_arg:
+            opts += ['-reduce', reduce_arg]
 
-        # make the named pipe
-        mkfifo_call = '%s %s' % (self.mkfifo, fifo_fp)
-        logger.debug('Calling %s' % (mkfifo_call,))
-        resp = subprocess.check_call(mkfifo_call, shell=True)
+        make_argv = lambda fifo_fp: \
+            [self.kdu_expand, '-i', src_fp] + opts + ['-o', fifo_fp]
+        im = self._run_decoder(make_argv, self.env, image_request)
 
-        try:
-            # Start the kdu shellout. Blocks until the pipe is empty
-            logger.debug('Calling: %s' % (kdu_cmd,))
-            kdu_expand_proc = subprocess.Popen(kdu_cmd, shell=True, bufsize=-1,
-                stderr=subprocess.PIPE, env=self.env)
-
-            f = open(fifo_fp, 'rb')
-            logger.debug('Opened %s' % fifo_fp)
-
-             # read from the named pipe
-            p = Parser()
-            while True:
-                s = f.read(1024)
-                if not s:
-                    break
-                p.feed(s)
-            im = p.close() # a PIL.Image
-
-            # finish kdu
-            kdu_exit = kdu_expand_proc.wait()
-            if kdu_exit != 0:
-                map(logger.error, kdu_expand_proc.stderr)
-
-            if self.map_profile_to_srgb and image_request.info.color_profile_bytes:  # i.e. is not None
-                emb_profile = cStringIO.StringIO(image_request.info.color_profile_bytes)
-                im = profileToProfile(im, emb_profile, self.srgb_profile_fp)
-
-            self._derive_with_pil(im, target_fp, image_request, crop=False)
-        except:
-            raise
-        finally:
-            kdu_exit = kdu_expand_proc.wait()
-            if kdu_exit != 0:
-                map(logger.error, map(string.strip, kdu_expand_proc.stderr))
-            unlink(fifo_fp)
+        return self._map_profile(im, image_request)
@@ -9,6 +9,7 @@ Implements IIIF 2.0 <http://iiif.io/api/image/2.0/> level 2
 from configobj import ConfigObj
 from datetime import datetime
 from decimal import getcontext
+from img_info import CONTENT_ENCODINGS, ENCODERS
 from img_info import ImageInfo
 from img_info import ImageInfoException
 from img_info import InfoCache
@@ -19,11 +20,17 @@ from loris_exception import SyntaxException
 from loris_exception import ImageException
 from loris_exception import ResolverException
 from os import path, makedirs, unlink, removedirs, symlink
+from singleflight import SingleFlight
 from subprocess import CalledProcessError
-from urllib import unquote, quote_plus
+from urllib import quote, unquote, quote_plus
 from werkzeug.http import parse_date, parse_accept_header, http_date
 from werkzeug.wrappers import Request, Response, BaseResponse, CommonResponseDescriptorsMixin
+from werkzeug.wrappers import ETagResponseMixin
+from werkzeug.wsgi import wrap_file
+import cache_backend
+import cache_manager
 import constants
+import errno
 import img
 import logging
 import random
@@ -31,6 +38,8 @@ import re
 import string
 import transforms
 import os
+import uuid
+import zlib
 
 getcontext().prec = 25 # Decimal precision. This should be plenty.
 
@@ -62,6 +71,11 @@ def create_app(debug=False, debug_jp2_transformer='kdu', config_file_path=''):
             config['transforms']['jp2']['opj_decompress'] = path.join(project_dp, opj_decompress)
             libopenjp2_dir = OPJ_JP2Transformer.local_libopenjp2_dir()
             config['transforms']['jp2']['opj_libs'] = path.join(project_dp, libopenjp2_dir)
+        elif debug_jp2_transformer == 'opjlib':
+            from transforms import OPJ_JP2Transformer
+            libopenjp2 = OPJ_JP2Transformer.local_libopenjp2_path()
+            config['transforms']['jp2']['impl'] = 'OPJ_LibJP2Transformer'
+            config['transforms']['jp2']['libopenjp2'] = path.join(project_dp, libopenjp2)
         else: # kdu
             from transforms import KakaduJP2Transformer
             kdu_expand = KakaduJP2Transformer.local_kdu_expand_path()
@@ -156,11 +170,10 @@ class StdOutFilter(logging.Filter):
     def filter(self,record):
         return 1 if record.levelno <= 20 else 0
 
-class LorisResponse(BaseResponse, CommonResponseDescriptorsMixin):
+class LorisResponse(BaseResponse, CommonResponseDescriptorsMixin, ETagResponseMixin):
     '''Similar to Response, but IIIF Compliance Link and
     Access-Control-Allow-Origin Headers are added and none of the
-    ETagResponseMixin, ResponseStreamMixin, or WWWAuthenticateMixin
-    capabilities are included.
+    ResponseStreamMixin or WWWAuthenticateMixin capabilities are included.
     See: http://werkzeug.pocoo.org/docs/wrappers/#werkzeug.wrappers.Response
     '''
     def __init__(self, response=None, status=None, content_type=None):
@@ -175,6 +188,71 @@ class LorisResponse(BaseResponse, CommonResponseDescriptorsMixin):
             self.headers['Access-Control-Allow-Origin'] = "*"
 
 
+_EPOCH = datetime.utcfromtimestamp(0)
+
+def _make_etag(last_mod, *parts):
+    '''A strong ETag for something cached, from what is already at hand: its
+    mtime, to the microsecond, which changes whenever it's written again,
+    and whatever else tells its representations apart (parts, str).
+    '''
+    d = last_mod - _EPOCH
+    usecs = (d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+    return '-'.join(('%x' % (usecs,),) + parts)
+
+# bytes per read of a file, when it isn't left to wsgi.file_wrapper
+FILE_BUFFER = 64 * 1024
+
+# for the offload option of [img.ImageCache]
+OFFLOAD_HEADERS = (None, 'X-Sendfile', 'X-Accel-Redirect')
+
+def _requested_range(request, etag, last_mod, size):
+    '''
+    Returns:
+        (int, int): the start and stop (exclusive) of the one range asked for
+        with Range, or None for all of it: if there's no Range, or more than
+        one range, or one that can't be satisfied, or an If-Range that no
+        longer holds.
+    '''
+    rng = request.range
+    if rng is None:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date != last_mod:
+        return None
+    return rng.range_for_length(size)
+
+def _read_range(f, length):
+    try:
+        while length > 0:
+            data = f.read(min(FILE_BUFFER, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+def _slice_chunks(chunks, start, stop):
+    offset = 0
+    for chunk in chunks:
+        end = offset + len(chunk)
+        if end > start and offset < stop:
+            yield chunk[max(start - offset, 0):stop - offset]
+        offset = end
+        if offset >= stop:
+            return
+
+def _not_modified(request, etag, last_mod):
+    # If-None-Match, when there is one, trumps If-Modified-Since (RFC 7232
+    # section 6). last_mod is rounded to seconds (see get_img).
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains(etag)
+    ims = parse_date(request.headers.get('If-Modified-Since'))
+    return bool(ims and last_mod and ims >= last_mod)
+
+
 class BadRequestResponse(LorisResponse):
     def __init__(self, message=None):
         if message is None:
@@ -292,11 +370,52 @@ class Loris(object):
         self.transformers = self._load_transformers()
         self.resolver = self._load_resolver()
         self.max_size_above_full = _loris_config.get('max_size_above_full', 200)
+        self.single_flight = SingleFlight(_loris_config.get('coalesce_timeout', 30))
 
+        self.offload = None
         if self.enable_caching:
-            self.info_cache = InfoCache(self.app_configs['img_info.InfoCache']['cache_dp'])
-            cache_dp = self.app_configs['img.ImageCache']['cache_dp']
-            self.img_cache = img.ImageCache(cache_dp)
+            info_cache_config = self.app_configs['img_info.InfoCache']
+            self.info_cache = InfoCache(info_cache_config['cache_dp'],
+                int(info_cache_config.get('max_entries', 500)),
+                int(info_cache_config.get('max_mb', 64)) * 1024 * 1024,
+                int(info_cache_config.get('shards', 16)),
+                info_cache_config.get('validate', True),
+                int(info_cache_config.get('max_body_mb', 16)) * 1024 * 1024,
+                info_cache_config.get('layout', 'flat'),
+                info_cache_config.get('previous_layout'),
+                cache_backend.from_config(info_cache_config,
+                    info_cache_config['cache_dp'], 'info'))
+            img_cache_config = self.app_configs['img.ImageCache']
+            self.img_cache = self._load_img_cache(img_cache_config)
+            self.offload = img_cache_config.get('offload')
+            if self.offload not in OFFLOAD_HEADERS:
+                raise ValueError('offload must be one of %s, not %r' %
+                    (OFFLOAD_HEADERS, self.offload))
+            # what cache_dp is mapped to, for X-Accel-Redirect
+            self.offload_prefix = img_cache_config.get('offload_prefix', '/loris-cache/')
+            self.offload_root = path.realpath(img_cache_config['cache_dp'])
+
+    def _load_img_cache(self, img_cache_config):
+        impl = img_cache_config.get('impl', 'ImageCache')
+        if impl == 'PackImageCache':
+            return img.PackImageCache(img_cache_config['cache_dp'],
+                int(img_cache_config.get('segment_mb', 256)) * 1024 * 1024,
+                int(img_cache_config.get('max_mb', 0)) * 1024 * 1024,
+                float(img_cache_config.get('compact_below', 0.5)),
+                float(img_cache_config.get('compact_interval', 300)))
+        if 'backend' in img_cache_config:
+            return img.BackendImageCache(img_cache_config['cache_dp'],
+                cache_backend.from_config(img_cache_config,
+                    img_cache_config['cache_dp'], 'images'))
+        return img.ImageCache(img_cache_config['cache_dp'],
+            int(img_cache_config.get('index_entries', 100000)),
+            int(img_cache_config.get('negative_entries', 100000)),
+            float(img_cache_config.get('negative_ttl', 10)),
+            cache_manager.from_config(img_cache_config['cache_dp'], img_cache_config),
+            img_cache_config.get('layout', 'flat'),
+            img_cache_config.get('previous_layout'),
+            int(img_cache_config.get('ram_mb', 0)) * 1024 * 1024,
+            int(img_cache_config.get('ram_item_kb', 64)) * 1024)
 
     def _load_transformers(self):
         tforms = self.app_configs['transforms']
@@ -418,21 +537,31 @@ class Loris(object):
 
         r = LorisResponse()
         r.set_acao(request, self.cors_regex)
-        ims_hdr = request.headers.get('If-Modified-Since')
-
-        ims = parse_date(ims_hdr)
-        last_mod = parse_date(http_date(last_mod)) # see note under get_img
-
-        if ims and ims >= last_mod:
+        callback = request.args.get('callback', None)
+        encoding = 'identity'
+        if not callback:
+            r.vary.add('Accept-Encoding')
+            # identity is acceptable unless it's refused, and even then it
+            # beats a 406
+            encoding = request.accept_encodings.best_match(CONTENT_ENCODINGS) or 'identity'
+
+        etag = None
+        if last_mod:
+            # the body depends on the @id and the callback too
+            uri_crc = zlib.crc32('%s %s' % (base_uri, callback or '')) & 0xffffffff
+            etag = _make_etag(last_mod, '%08x' % (uri_crc,), encoding)
+            r.set_etag(etag)
+            last_mod = parse_date(http_date(last_mod)) # see note under get_img
+
+        if _not_modified(request, etag, last_mod):
             self.logger.debug('Sent 304 for %s ' % (ident,))
             r.status_code = 304
         else:
             if last_mod:
                 r.last_modified = last_mod
-            callback = request.args.get('callback', None)
             if callback:
                 r.mimetype = 'application/javascript'
-                r.data = '%s(%s);' % (callback, info.to_json())
+                r.data = '%s(%s);' % (callback, self._info_body(info, base_uri))
             else:
                 if request.headers.get('accept') == 'application/ld+json':
                     r.content_type = 'application/ld+json'
@@ -440,17 +569,29 @@ class Loris(object):
                     r.content_type = 'application/json'
                     l = '<http://iiif.io/api/image/2/context.json>;rel="http://www.w3.org/ns/json-ld#context";type="application/ld+json"'
                     r.headers['Link'] = '%s,%s' % (r.headers['Link'], l)
-                r.data = info.to_json()
+                r.data = self._info_body(info, base_uri, encoding)
+                if encoding != 'identity':
+                    r.content_encoding = encoding
         return r
 
+    def _info_body(self, info, base_uri, encoding='identity'):
+        if self.enable_caching:
+            return self.info_cache.body(info, base_uri, encoding)
+        body = info.to_json(base_uri)
+        if encoding != 'identity':
+            body = ENCODERS[encoding](body)
+        return body
+
     def _get_info(self,ident,request,base_uri,src_fp=None,src_format=None):
+        # Info is the same however it was asked for; base_uri is only for the
+        # @id, which get_info fills in.
         if self.enable_caching:
-            in_cache = request in self.info_cache
+            info_and_lastmod = self.info_cache.get(ident)
         else:
-            in_cache = False
+            info_and_lastmod = None
 
-        if in_cache:
-            return self.info_cache[request]
+        if info_and_lastmod is not None:
+            return info_and_lastmod
         else:
             if not all((src_fp, src_format)):
                 # get_img can pass in src_fp, src_format because it needs them
@@ -467,16 +608,21 @@ class Loris(object):
             self.logger.debug('Identifier: %s' % (ident,))
             self.logger.debug('Base URI: %s' % (base_uri,))
 
-            # get the info
-            info = ImageInfo.from_image_file(base_uri, src_fp, src_format, formats, self.max_size_above_full)
-
-            # store
             if self.enable_caching:
-                self.logger.debug('ident used to store %s: %s' % (ident,ident))
-                self.info_cache[request] = info
+                # Concurrent requests for the same uncached info wait for one
+                # extraction rather than each reading the source.
+                def extract():
+                    self.logger.debug('ident used to store %s: %s' % (ident,ident))
+                    self.info_cache[ident] = ImageInfo.from_image_file(unquote(ident),
+                        src_fp, src_format, formats, self.max_size_above_full)
+                info_fp = self.info_cache.get_info_fp(ident)
+                is_done = lambda: ident in self.info_cache
+                self.single_flight.run(info_fp, extract, is_done)
                 # pick up the timestamp... :()
-                info,last_mod = self.info_cache[request]
+                info,last_mod = self.info_cache[ident]
             else:
+                info = ImageInfo.from_image_file(unquote(ident), src_fp, src_format,
+                    formats, self.max_size_above_full)
                 last_mod = None
 
             return (info,last_mod)
@@ -502,21 +648,21 @@ class Loris(object):
         self.logger.debug('Image Request Path: %s' % (image_request.request_path,))
 
         if self.enable_caching:
-            in_cache = image_request in self.img_cache
+            in_cache = self.img_cache.lookup(image_request)
         else:
-            in_cache = False
+            in_cache = None
 
-        if in_cache:
-            fp, img_last_mod = self.img_cache[image_request]
-            ims_hdr = request.headers.get('If-Modified-Since')
+        if in_cache is not None:
+            fp, img_last_mod, img_size = in_cache
+            # Every request for the same derivative gets the same one.
+            etag = _make_etag(img_last_mod, '%x' % (img_size,))
+            r.set_etag(etag)
             # The stamp from the FS needs to be rounded using the same precision
             # as when went sent it, so for an accurate comparison turn it into
             # an http date and then parse it again :-( :
             img_last_mod = parse_date(http_date(img_last_mod))
             self.logger.debug("Time from FS (default, rounded): " + str(img_last_mod))
-            self.logger.debug("Time from IMS Header (parsed): " + str(parse_date(ims_hdr)))
-            # ims_hdr = parse_date(ims_hdr) # catch parsing errors?
-            if ims_hdr and parse_date(ims_hdr) >= img_last_mod:
+            if _not_modified(request, etag, img_last_mod):
                 self.logger.debug('Sent 304 for %s ' % (fp,))
                 r.status_code = 304
                 return r
@@ -524,20 +670,25 @@ class Loris(object):
                 r.content_type = constants.FORMATS_BY_EXTENSION[target_fmt]
                 r.status_code = 200
                 r.last_modified = img_last_mod
-                r.headers['Content-Length'] = path.getsize(fp)
-                r.response = file(fp)
-
-                # resolve the identifier
-                src_fp, src_format = self.resolver.resolve(ident)
-                # hand the Image object its info
-                info = self._get_info(ident, request, base_uri, src_fp, src_format)[0]
-                image_request.info = info
-                # we need to do the above to set the canonical link header
-
-                canonical_uri = '%s%s' % (request.url_root, image_request.canonical_request_path)
-                r.headers['Link'] = '%s,<%s>;rel="canonical"' % (r.headers['Link'], canonical_uri,)
-                return r
-        else:
+                try:
+                    self._send_derivative(request, r, fp, img_last_mod, img_size, etag)
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # evicted since the lookup; make it again, below
+                    self.img_cache.forget(image_request)
+                    in_cache = None
+                    r = LorisResponse()
+                    r.set_acao(request, self.cors_regex)
+                else:
+                    # The cache knows the canonical path, so there's no need to
+                    # resolve the identifier or get its info.
+                    canonical_uri = '%s%s' % (request.url_root,
+                        self.img_cache.canonical_request_path(image_request, fp))
+                    r.headers['Link'] = '%s,<%s>;rel="canonical"' % (r.headers['Link'], canonical_uri,)
+                    return r
+
+        if in_cache is None:
             try:
 
                 # 1. Resolve the identifier
@@ -572,8 +723,11 @@ class Loris(object):
                 return BadRequestResponse(e.message)
             except (ImageException,ImageInfoException) as ie:
                 # 500s!
-                # ImageException is only raised in when ImageRequest.info
-                # isn't set and is a developer error. It should never happen!
+                # ImageException is raised when ImageRequest.info isn't set,
+                # which is a developer error. It should never happen! The JP2
+                # transformers also raise it, with a 500, when the decoder
+                # can't decode the source (OPJ_LibJP2Transformer when
+                # libopenjp2 reports an error).
                 #
                 # ImageInfoException is only raised when
                 # ImageInfo.from_image_file() can't  determine the format of the
@@ -590,17 +744,90 @@ possible that there was a problem with the source file
                 return ServerSideErrorResponse(msg)
         r.content_type = constants.FORMATS_BY_EXTENSION[target_fmt]
         r.status_code = 200
-        r.last_modified = datetime.utcfromtimestamp(path.getctime(fp))
-        r.headers['Content-Length'] = path.getsize(fp)
         canonical_uri = '%s%s' % (request.url_root, image_request.canonical_request_path)
         r.headers['Link'] = '%s,<%s>;rel="canonical"' % (r.headers['Link'], canonical_uri,)
-        r.response = file(fp)
-
-        if not self.enable_caching:
+        if self.enable_caching:
+            for remake in (False, True):
+                if remake:
+                    # evicted already; make it again, once
+                    self.img_cache.forget(image_request)
+                    self._make_image(image_request, src_fp, src_format)
+                in_cache = self.img_cache.lookup(image_request)
+                if in_cache is None:
+                    continue
+                fp, img_last_mod, img_size = in_cache
+                etag = _make_etag(img_last_mod, '%x' % (img_size,))
+                try:
+                    self._send_derivative(request, r, fp,
+                        parse_date(http_date(img_last_mod)), img_size, etag)
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                r.set_etag(etag)
+                r.last_modified = img_last_mod
+                break
+            else:
+                msg = '%s is evicted as soon as it is made; the cache may be too small for it.'
+                return ServerSideErrorResponse(msg % (image_request.request_path,))
+        else:
+            r.last_modified = datetime.utcfromtimestamp(path.getctime(fp))
+            r.headers['Content-Length'] = path.getsize(fp)
+            r.response = file(fp)
             r.call_on_close(unlink(fp))
 
         return r
 
+    def _send_derivative(self, request, r, handle, last_mod, size, etag):
+        '''Make r's body a cached derivative (as found by img_cache.lookup()),
+        or the range of it asked for. A file is handed to the server's
+        wsgi.file_wrapper (which can sendfile() it) rather than read here.
+
+        Args:
+            last_mod (datetime): rounded to seconds, as sent.
+        Raises:
+            IOError (ENOENT): if it has gone since the lookup.
+        '''
+        if self.offload is not None and self._offload(r, handle):
+            return
+        body = self.img_cache.open(handle)
+        r.headers['Accept-Ranges'] = 'bytes'
+        rng = _requested_range(request, etag, last_mod, size)
+        if rng is None:
+            start, stop = 0, size
+        else:
+            start, stop = rng
+            r.status_code = 206
+            r.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        r.headers['Content-Length'] = stop - start
+        if isinstance(body, file):
+            if rng is None:
+                r.response = wrap_file(request.environ, body, FILE_BUFFER)
+            else:
+                body.seek(start)
+                r.response = _read_range(body, stop - start)
+            r.direct_passthrough = True
+        elif rng is None:
+            r.response = body
+        else:
+            r.response = _slice_chunks(body, start, stop)
+
+    def _offload(self, r, handle):
+        # Leave sending the file (and any Range) to the proxy in front, if
+        # there is a file.
+        fp = self.img_cache.file_path(handle)
+        if fp is None:
+            return False
+        if self.offload == 'X-Accel-Redirect':
+            rel = path.relpath(fp, self.offload_root)
+            if rel.startswith(os.pardir):
+                return False
+            r.headers['X-Accel-Redirect'] = '%s/%s' % (self.offload_prefix.rstrip('/'),
+                quote(rel))
+        else:
+            r.headers['X-Sendfile'] = fp
+        return True
+
     def _make_image(self, image_request, src_fp, src_format):
         '''
         Args:
@@ -610,22 +837,35 @@ possible that there was a problem with the source file
         Returns:
             (str) the fp of the new image
         '''
-        # figure out paths, make dirs
+        transformer = self.transformers[src_format]
+
         if self.enable_caching:
             target_fp = self.img_cache.create_dir_and_return_file_path(image_request)
+
+            # Concurrent requests for the same derivative wait for a single
+            # render. It is written beside the target and moved into place
+            # so that a partial file is never served from the cache.
+            def render():
+                dp, fn = path.split(target_fp)
+                tmp_fp = path.join(dp, '.%s.%s' % (uuid.uuid4().hex, fn))
+                try:
+                    transformer.transform(src_fp, tmp_fp, image_request)
+                    self.img_cache.commit(image_request, tmp_fp, target_fp)
+                finally:
+                    if path.exists(tmp_fp):
+                        unlink(tmp_fp)
+            is_done = lambda: self.img_cache.is_made(image_request, target_fp)
+            self.single_flight.run(target_fp, render, is_done)
+
+            self.img_cache[image_request] = target_fp
         else:
             # random str
             n = ''.join(random.choice(string.ascii_lowercase) for x in range(10))
             target_fp = '%s.%s' % (path.join(self.tmp_dp, n), image_request.format)
+            transformer.transform(src_fp, target_fp, image_request)
 
-        transformer = self.transformers[src_format]
-
-        transformer.transform(src_fp, target_fp, image_request)
-        if self.enable_caching:
-            self.img_cache[image_request] = target_fp
         return target_fp
 
-
 if __name__ == '__main__':
     from werkzeug.serving import run_simple
     import sys
@@ -637,7 +877,7 @@ if __name__ == '__main__':
 
     sys.path.append(path.join(project_dp)) # to find any local resolvers
 
-    app = create_app(debug=True) # or 'opj'
+    app = create_app(debug=True) # or 'opj', 'opjlib'
 
     run_simple('localhost', 5004, app, use_debugger=True, use_reloader=True,
         extra_files=extra_files)
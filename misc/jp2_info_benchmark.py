@@ -0,0 +1,115 @@
+# Times ImageInfo's JP2 header parsing (loris/jp2.py) against the byte at a
+# time scanner it replaced, which is copied below.
+#
+# The fixtures in tests/img are timed as they are, and also with a box of
+# metadata (e.g. XMP or GeoJP2 in a uuid box) before the header, and as a
+# multi-GB (sparse) file.
+#
+# Run from the /loris (not /loris/loris) directory:
+#
+# $ python misc/jp2_info_benchmark.py
+
+from collections import deque
+from os import path, unlink
+from tempfile import mkstemp
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from loris import jp2
+
+FIXTURES = ('tests/img/01/02/gray.jp2', 'tests/img/47102787.jp2')
+METADATA_BYTES = 4 * 1024 * 1024
+SPARSE_BYTES = 4 * 1024 * 1024 * 1024
+RUNS = 20
+
+def legacy_parse(fp):
+    '''What ImageInfo._from_jp2 used to do, less the logging and ImageInfo.
+    Returns width, height, tile size, levels and the colr box's METH.
+    '''
+    jp2f = open(fp, 'rb')
+    jp2f.read(24)
+    window = deque([], 4)
+    while ''.join(window) != 'ihdr':
+        window.append(struct.unpack('c', jp2f.read(1))[0])
+    height = int(struct.unpack(">I", jp2f.read(4))[0])
+    width = int(struct.unpack(">I", jp2f.read(4))[0])
+    while ''.join(window) != 'colr':
+        window.append(struct.unpack('c', jp2f.read(1))[0])
+    colr_meth = struct.unpack('B', jp2f.read(1))[0]
+    jp2f.read(2)
+    if colr_meth == 1:
+        jp2f.read(4)
+    else:
+        profile_size = int(struct.unpack(">I", jp2f.read(4))[0])
+        jp2f.read(profile_size - 4)
+    window = deque(jp2f.read(2), 2)
+    while map(ord, window) != [0xFF, 0x4F]:
+        window.append(jp2f.read(1))
+    while map(ord, window) != [0xFF, 0x51]:
+        window.append(jp2f.read(1))
+    jp2f.read(20)
+    tile_width = int(struct.unpack(">I", jp2f.read(4))[0])
+    tile_height = int(struct.unpack(">I", jp2f.read(4))[0])
+    jp2f.read(10)
+    window = deque(jp2f.read(2), 2)
+    while map(ord, window) != [0xFF, 0x52]:
+        window.append(jp2f.read(1))
+    jp2f.read(7)
+    levels = int(struct.unpack(">B", jp2f.read(1))[0])
+    jp2f.close()
+    return width, height, (tile_width, tile_height), levels, colr_meth
+
+def parse(fp):
+    j = jp2.parse(fp)
+    cs = j.codestream
+    return j.width, j.height, cs.tile_size, cs.levels, j.colr_method
+
+def with_metadata(src_fp):
+    # signature and ftyp, then a uuid box of zeros, then the rest
+    with open(src_fp, 'rb') as f:
+        data = f.read()
+    ftyp_len = struct.unpack('>I', data[12:16])[0]
+    head = data[:12 + ftyp_len]
+    box = struct.pack('>I4s', 8 + 16 + METADATA_BYTES, 'uuid') + '\0' * (16 + METADATA_BYTES)
+    fd, fp = mkstemp(suffix='.jp2')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(head + box + data[len(head):])
+    return fp
+
+def sparse(src_fp):
+    # a free box with a hole in it after the codestream
+    with open(src_fp, 'rb') as f:
+        data = f.read()
+    fd, fp = mkstemp(suffix='.jp2')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.write(struct.pack('>I4sQ', 1, 'free', 16 + SPARSE_BYTES))
+        f.truncate(len(data) + 16 + SPARSE_BYTES)
+    return fp
+
+def time_it(fn, fp):
+    start = time.time()
+    for _ in range(RUNS):
+        result = fn(fp)
+    return (time.time() - start) / RUNS * 1000, result
+
+def main():
+    print '%-45s %12s %12s' % ('', 'legacy (ms)', 'jp2.py (ms)')
+    for src_fp in FIXTURES:
+        for label, make in (('', None), (' + 4MB uuid', with_metadata), (' + 4GB free', sparse)):
+            fp = make(src_fp) if make else src_fp
+            try:
+                legacy_ms, legacy = time_it(legacy_parse, fp)
+                new_ms, new = time_it(parse, fp)
+                assert legacy == new, (legacy, new)
+                print '%-45s %12.3f %12.3f' % (path.basename(src_fp) + label, legacy_ms, new_ms)
+            finally:
+                if make:
+                    unlink(fp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Times JPG_Transformer with and without draft() (DCT-scaled) decoding
+# against the JPEGs in tests/img.
+#
+# Run from the /loris (not /loris/loris) directory:
+#
+# $ python misc/jpeg_draft_benchmark.py
+
+from os import path, walk
+from shutil import rmtree
+from tempfile import mkdtemp
+import sys
+import time
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from loris import img, img_info
+from loris.transforms import JPG_Transformer
+
+ROOT = 'tests/img'
+REQUESTS = (
+    ('full', '150,'),         # thumbnail
+    ('full', '600,'),
+    ('full', 'pct:50'),
+    ('0,0,1024,1024', '256,'), # deep zoom tile at 1/4
+    ('0,0,512,512', '256,'),   # deep zoom tile at 1/2
+    ('full', 'full')           # no change expected
+)
+RUNS = 5
+
+def jpegs():
+    for dp, _, fns in walk(ROOT):
+        for fn in sorted(fns):
+            if fn.lower().endswith(('.jpg', '.jpeg')):
+                yield path.join(dp, fn)
+
+def image_request(fp, region, size):
+    ident = path.relpath(fp, ROOT)
+    info = img_info.ImageInfo.from_image_file('http://localhost/%s' % (ident,), fp, 'jpg')
+    request = img.ImageRequest(ident, region, size, '0', 'default', 'jpg')
+    request.info = info
+    return request
+
+def time_transform(transformer, fp, request, tmp_dp):
+    target_fp = path.join(tmp_dp, 'out.jpg')
+    start = time.time()
+    for _ in range(RUNS):
+        transformer.transform(fp, target_fp, request)
+    return (time.time() - start) / RUNS * 1000
+
+if __name__ == '__main__':
+    config = {
+        'target_formats' : ['jpg'],
+        'dither_bitonal_images' : False,
+        'decoded_cache_mb' : 0
+    }
+    transformer = JPG_Transformer(config)
+    draft_scales = JPG_Transformer.DRAFT_SCALES
+    tmp_dp = mkdtemp()
+    try:
+        print '%-28s %-18s %-8s %10s %10s %6s' % ('source', 'region', 'size',
+            'full (ms)', 'draft (ms)', 'scale')
+        for fp in jpegs():
+            for region, size in REQUESTS:
+                request = image_request(fp, region, size)
+                scale = transformer._draft_scale(request)
+                JPG_Transformer.DRAFT_SCALES = ()
+                full_ms = time_transform(transformer, fp, request, tmp_dp)
+                JPG_Transformer.DRAFT_SCALES = draft_scales
+                draft_ms = time_transform(transformer, fp, request, tmp_dp)
+                print '%-28s %-18s %-8s %10.1f %10.1f %6s' % (fp, region, size,
+                    full_ms, draft_ms, '1/%d' % (scale,))
+    finally:
+        rmtree(tmp_dp)
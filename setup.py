@@ -250,7 +250,7 @@ setup(
 # Installation was successful. Here's where things are:
 
 #  * Loris configuration: %(config)s
-#  * Cache cleaner Simple cron: %(cache_clean)s
+#  * Cache manager: %(cache_manager)s
 #  * Cache cleaner HTTP cron: %(cache_http_clean)s
 #  * JP2 executable: %(jptoo_exe)s (kdu_expand or opj_decompress)
 #  * JP2 libraries: %(jptoo_lib)s (libkdu or libopenjp2)
@@ -268,11 +268,12 @@ setup(
 #  1. Make sure that the Python Imaging Library is installed and working. See
 #   notes about this in doc/dependencies.md.
 
-#  2. Configure the cron job that manages the cache (bin/loris-cache_clean.sh,
-#   now at %(cache_clean)s, or bin/loris-http_cache_clean.sh,
-#   now at %(cache_http_clean)s). Make sure the
-#   constants match how you have Loris configured, and then set up the cron
-#   (e.g. `crontab -e -u %(user_n)s`).
+#  2. Set max_mb in [img.ImageCache] and run bin/loris-cache_manager (now at
+#   %(cache_manager)s) once with --sweep, and if you like as a daemon. For
+#   SimpleHTTPResolver, configure the cron job that manages its cache
+#   (bin/loris-http_cache_clean.sh, now at %(cache_http_clean)s). Make sure
+#   the constants match how you have Loris configured, and then set up the
+#   cron (e.g. `crontab -e -u %(user_n)s`).
 
 #  3. Have a look at the WSGI file in %(www_dp)s. It should be fine as-is, but
 #   there's always a chance that it isn't. The first thing to try is explictly
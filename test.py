@@ -10,6 +10,18 @@ from tests import img_t
 from tests import simple_fs_resolver_ut
 from tests import simple_http_resolver_ut
 from tests import source_image_caching_resolver_ut
+from tests import singleflight_t
+from tests import decode_pipe_t
+from tests import decoded_cache_t
+from tests import pregen_t
+from tests import info_batch_t
+from tests import jp2_t
+from tests import lru_t
+from tests import bloom_t
+from tests import cache_manager_t
+from tests import cache_migrate_t
+from tests import pack_store_t
+from tests import cache_backend_t
 from unittest import TestSuite, TextTestRunner
 
 test_suite = TestSuite()
@@ -22,6 +34,18 @@ test_suite.addTest(img_t.suite())
 test_suite.addTest(simple_fs_resolver_ut.suite())
 test_suite.addTest(simple_http_resolver_ut.suite())
 test_suite.addTest(source_image_caching_resolver_ut.suite())
+test_suite.addTest(singleflight_t.suite())
+test_suite.addTest(decode_pipe_t.suite())
+test_suite.addTest(decoded_cache_t.suite())
+test_suite.addTest(pregen_t.suite())
+test_suite.addTest(info_batch_t.suite())
+test_suite.addTest(jp2_t.suite())
+test_suite.addTest(lru_t.suite())
+test_suite.addTest(bloom_t.suite())
+test_suite.addTest(cache_manager_t.suite())
+test_suite.addTest(cache_migrate_t.suite())
+test_suite.addTest(pack_store_t.suite())
+test_suite.addTest(cache_backend_t.suite())
 
 runner = TextTestRunner(verbosity=3)
 ret = not runner.run(test_suite).wasSuccessful()
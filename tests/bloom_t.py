@@ -0,0 +1,46 @@
+#-*- coding: utf-8 -*-
+
+from loris.bloom import BloomFilter
+import unittest
+
+
+"""
+Bloom filter tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.bloom_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_BloomFilter(unittest.TestCase):
+
+    def test_members_are_found(self):
+        bloom = BloomFilter(1000)
+        keys = ['id%d/full/full/0/default.jpg' % (n,) for n in range(1000)]
+        for k in keys:
+            bloom.add(k)
+        self.assertTrue(all(k in bloom for k in keys))
+        self.assertTrue(bloom.is_full())
+        bloom.add(u'\xe9t\xe9/full/full/0/default.jpg')
+        self.assertTrue(u'\xe9t\xe9/full/full/0/default.jpg' in bloom)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add('in%d' % (n,))
+        false_positives = sum(1 for n in range(10000) if 'out%d' % (n,) in bloom)
+        self.assertTrue(false_positives < 200, false_positives)
+
+    def test_clear(self):
+        bloom = BloomFilter(10)
+        bloom.add('a')
+        bloom.clear()
+        self.assertFalse('a' in bloom)
+        self.assertEqual(bloom.count, 0)
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_BloomFilter, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
@@ -0,0 +1,160 @@
+#-*- coding: utf-8 -*-
+
+from loris import cache_backend, img, img_info
+from loris.cache_backend import NOT_MODIFIED
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import loris_t
+import unittest
+
+
+"""
+Cache backend tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.cache_backend_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class _BackendTests(object):
+    # Mixed into a TestCase per backend, with _make().
+
+    def setUp(self):
+        self.tmp_dp = mkdtemp()
+        self.backend = self._make()
+
+    def tearDown(self):
+        rmtree(self.tmp_dp)
+
+    def test_put_and_get(self):
+        mtime = self.backend.put('a/b/c.jpg', 'abc')
+        self.assertEqual(self.backend.get('a/b/c.jpg'), ('abc', mtime))
+        self.assertEqual(self.backend.stat('a/b/c.jpg'), (3, mtime))
+        self.assertEqual(''.join(self.backend.open('a/b/c.jpg')), 'abc')
+        self.assertEqual(self.backend.get('a/b/d.jpg'), None)
+        self.assertEqual(self.backend.stat('a/b/d.jpg'), None)
+        self.assertRaises(IOError, self.backend.open, 'a/b/d.jpg')
+
+    def test_conditional_get(self):
+        mtime = self.backend.put('a', 'abc')
+        self.assertTrue(self.backend.get('a', since=mtime) is NOT_MODIFIED)
+        self.assertEqual(self.backend.get('a', since=mtime - 1), ('abc', mtime))
+        self.assertEqual(self.backend.get('b', since=mtime), None)
+
+    def test_replace(self):
+        self.backend.put('a', 'abc')
+        self.backend.put('a', 'de')
+        self.assertEqual(self.backend.get('a')[0], 'de')
+        self.assertEqual(self.backend.stats()['entries'], 1)
+
+    def test_links(self):
+        self.backend.link('x/y', 'a/b')
+        self.assertEqual(self.backend.get('x/y'), None)
+        self.backend.put('a/b', 'abc')
+        self.assertEqual(self.backend.get('x/y')[0], 'abc')
+        self.assertEqual(self.backend.stats()['links'], 1)
+        self.assertEqual(self.backend.resolve('x/y'), 'a/b')
+        self.assertEqual(self.backend.resolve('a/b'), 'a/b')
+        self.assertEqual(self.backend.resolve('a/c'), 'a/c')
+        self.assertEqual(self.backend.delete(('a/b', 'a/c')), 1)
+        self.assertEqual(self.backend.get('x/y'), None)
+
+    def test_delete_prefix(self):
+        for key in ('a/1', 'a/2/3', 'ab/1', 'b/1'):
+            self.backend.put(key, key)
+        self.assertEqual(self.backend.delete_prefix('a'), 2)
+        self.assertEqual(self.backend.get('a/2/3'), None)
+        self.assertEqual(self.backend.get('ab/1')[0], 'ab/1')
+        stats = self.backend.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['bytes'], 7)
+
+
+class Test_FSBackend(_BackendTests, unittest.TestCase):
+
+    def _make(self):
+        return cache_backend.FSBackend(self.tmp_dp)
+
+    def test_keys_stay_under_root(self):
+        self.assertRaises(ValueError, self.backend.put, '../a', 'abc')
+
+    def test_empty_dirs_are_removed(self):
+        self.backend.put('a/b/c', 'abc')
+        self.backend.delete(('a/b/c',))
+        self.assertFalse(path.exists(path.join(self.tmp_dp, 'a')))
+        self.assertTrue(path.exists(self.tmp_dp))
+
+
+class Test_MemoryBackend(_BackendTests, unittest.TestCase):
+
+    def _make(self):
+        return cache_backend.MemoryBackend()
+
+
+class Test_SQLiteBackend(_BackendTests, unittest.TestCase):
+
+    def _make(self):
+        return cache_backend.SQLiteBackend(path.join(self.tmp_dp, 'cache.sqlite'))
+
+    def test_shared_between_backends(self):
+        other = self._make()
+        self.backend.put(u'caf\xe9'.encode('utf-8'), '\x00\xff')
+        self.assertEqual(other.get(u'caf\xe9'.encode('utf-8'))[0], '\x00\xff')
+
+
+class Test_from_config(unittest.TestCase):
+
+    def test_kinds(self):
+        self.assertTrue(isinstance(cache_backend.from_config({}, '/tmp', 'info'),
+            cache_backend.FSBackend))
+        backend = cache_backend.from_config({'backend' : 'sqlite'}, '/tmp', 'info')
+        self.assertEqual(backend.db_fp, '/tmp/info.sqlite')
+        self.assertRaises(ValueError, cache_backend.from_config,
+            {'backend' : 'lmdb'}, '/tmp', 'info')
+
+
+class Test_CachesOnBackends(loris_t.LorisTest):
+
+    def test_info_cache_on_sqlite(self):
+        tmp_dp = mkdtemp()
+        self.addCleanup(rmtree, tmp_dp)
+        backend = cache_backend.SQLiteBackend(path.join(tmp_dp, 'info.sqlite'))
+        self.app.info_cache = img_info.InfoCache(path.dirname(self.app.info_cache.root),
+            backend=backend)
+        request_path = '/%s/info.json' % (self.test_jp2_with_embedded_profile_id,)
+        first = self.client.get(request_path)
+        self.assertEqual(first.status_code, 200)
+        # info.json, profile.icc and source.json
+        self.assertEqual(backend.stats()['entries'], 3)
+
+        self.app.info_cache._lru.clear()
+        self.app.info_cache._bodies.clear()
+        second = self.client.get(request_path)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(self.app.info_cache.stats()['disk_hits'], 1)
+        info, _ = self.app.info_cache[self.test_jp2_with_embedded_profile_id]
+        self.assertTrue(info.color_profile_bytes)
+
+    def test_image_cache_in_memory(self):
+        self.app.img_cache = img.BackendImageCache(self.app.img_cache.cache_root,
+            cache_backend.MemoryBackend())
+        request_path = '/%s/full/pct:50/0/default.jpg' % (self.test_tiff_id,)
+        made = self.client.get(request_path)
+        self.assertEqual(made.status_code, 200)
+        # the same derivative by its canonical name
+        hit = self.client.get(self.canonical_path(made, self.test_tiff_id))
+        self.assertEqual(hit.data, made.data)
+        self.assertEqual(int(hit.headers['Content-Length']), len(made.data))
+        self.assertEqual(self.app.img_cache.backend.stats()['entries'], 1)
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_FSBackend, 'test'))
+    test_suites.append(unittest.makeSuite(Test_MemoryBackend, 'test'))
+    test_suites.append(unittest.makeSuite(Test_SQLiteBackend, 'test'))
+    test_suites.append(unittest.makeSuite(Test_from_config, 'test'))
+    test_suites.append(unittest.makeSuite(Test_CachesOnBackends, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
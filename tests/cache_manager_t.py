@@ -0,0 +1,144 @@
+#-*- coding: utf-8 -*-
+
+from loris.cache_manager import CacheManager
+from os import path, makedirs, symlink
+from shutil import rmtree
+from tempfile import mkdtemp
+import loris_t
+import os
+import unittest
+
+
+"""
+Cache manager tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.cache_manager_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_CacheManager(unittest.TestCase):
+
+    def setUp(self):
+        self.root = path.realpath(mkdtemp())
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def _derivative(self, rel, size):
+        fp = path.join(self.root, rel)
+        if not path.exists(path.dirname(fp)):
+            makedirs(path.dirname(fp))
+        with open(fp, 'wb') as f:
+            f.write('x' * size)
+        return fp
+
+    def test_keeps_totals(self):
+        manager = CacheManager(self.root, 1000)
+        a = self._derivative('a/full/full/0/default.jpg', 100)
+        b = self._derivative('b/full/full/0/default.jpg', 50)
+        manager.touch(a, 100)
+        manager.touch(b, 50)
+        manager.touch(a, 100)
+        manager.flush()
+        self.assertEqual(manager.usage(), (150, 2))
+        # replaced with something bigger
+        manager.touch(b, 70)
+        manager.flush()
+        self.assertEqual(manager.usage(), (170, 2))
+
+    def test_evicts_least_recently_used_to_low_water(self):
+        manager = CacheManager(self.root, 400, high_water=0.75, low_water=0.5)
+        fps = [self._derivative('%d/full/full/0/default.jpg' % (i,), 100) for i in range(4)]
+        for i, fp in enumerate(fps):
+            manager.touch(fp, 100, now=1000 + i)
+        manager.touch(fps[0], 100, now=2000) # now 1 is the oldest
+        self.assertTrue(manager.maintain(force=True))
+        self.assertEqual(manager.usage(), (200, 2))
+        self.assertEqual([path.exists(fp) for fp in fps], [True, False, False, True])
+
+    def test_evicts_least_frequently_used(self):
+        manager = CacheManager(self.root, 300, high_water=0.5, low_water=0.5,
+            policy='lfu')
+        fps = [self._derivative('%d/full/full/0/default.jpg' % (i,), 100) for i in range(3)]
+        for fp, hits in zip(fps, (3, 1, 2)):
+            for _ in range(hits):
+                manager.touch(fp, 100, now=1000)
+        manager.maintain(force=True)
+        self.assertEqual([path.exists(fp) for fp in fps], [True, False, False])
+
+    def test_leaves_eviction_to_daemon(self):
+        manager = CacheManager(self.root, 100, evict=False)
+        fp = self._derivative('a/full/full/0/default.jpg', 200)
+        manager.touch(fp, 200)
+        manager.maintain(force=True)
+        self.assertTrue(path.exists(fp))
+        self.assertEqual(manager.evict_to(0), (1, 200))
+        self.assertFalse(path.exists(fp))
+
+    def test_deletes_links_with_their_target(self):
+        manager = CacheManager(self.root, 100, high_water=0.5, low_water=0.5)
+        fp = self._derivative('a/full/full/0/default.jpg', 200)
+        link_fp = path.join(self.root, 'a', 'full', '100,', '0', 'default.jpg')
+        makedirs(path.dirname(link_fp))
+        symlink(fp, link_fp)
+        manager.link(link_fp, fp)
+        manager.touch(fp, 200)
+        manager.maintain(force=True)
+        self.assertFalse(path.lexists(link_fp))
+        self.assertFalse(path.exists(fp))
+
+    def test_sweep(self):
+        manager = CacheManager(self.root, 1000)
+        kept = self._derivative('a/full/full/0/default.jpg', 10)
+        gone = self._derivative('b/full/full/0/default.jpg', 20)
+        manager.touch(gone, 20, now=1000)
+        manager.flush()
+        os.unlink(gone)
+        self._derivative('a/info.json', 5) # not a derivative
+        dangling = path.join(self.root, 'b', 'full', '5,', '0', 'default.jpg')
+        makedirs(path.dirname(dangling))
+        symlink(gone, dangling)
+
+        stats = manager.sweep(min_dir_age=-1)
+        self.assertEqual((stats['files'], stats['added'], stats['forgotten']), (1, 1, 1))
+        self.assertEqual(stats['dangling'], 1)
+        self.assertFalse(path.lexists(dangling))
+        self.assertFalse(path.exists(path.join(self.root, 'b')))
+        self.assertTrue(path.exists(kept))
+        self.assertEqual(manager.usage(), (10, 1))
+
+    def test_shared_between_managers(self):
+        # e.g. two Loris processes
+        one = CacheManager(self.root, 1000)
+        two = CacheManager(self.root, 1000)
+        one.touch(self._derivative('a/full/full/0/default.jpg', 10), 10)
+        two.touch(self._derivative('b/full/full/0/default.jpg', 20), 20)
+        one.flush()
+        two.flush()
+        self.assertEqual(one.usage(), (30, 2))
+
+
+class Test_ImageCacheManaged(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_ImageCacheManaged, self).setUp()
+        self.manager = CacheManager(self.app.img_cache.cache_root, 1024 ** 3)
+        self.app.img_cache.manager = self.manager
+
+    def test_records_derivatives_and_hits(self):
+        url = '/%s/full/full/0/default.jpg' % (self.test_jp2_color_id,)
+        self.client.get(url)
+        self.client.get(url)
+        self.manager.flush()
+        n_bytes, n_files = self.manager.usage()
+        self.assertEqual(n_files, 1)
+        self.assertTrue(n_bytes > 0)
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_CacheManager, 'test'))
+    test_suites.append(unittest.makeSuite(Test_ImageCacheManaged, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
@@ -0,0 +1,80 @@
+#-*- coding: utf-8 -*-
+
+from loris import cache_layout, img
+from loris.cache_migrate import Migrator
+from os import path, readlink
+from urllib import unquote
+import loris_t
+import unittest
+
+
+"""
+Cache layout and migration tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.cache_migrate_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_cache_layout(unittest.TestCase):
+
+    def test_round_trip(self):
+        for ident in ('0001.jp2', '01/02/0001.jp2', u'caf\xe9.jpg'):
+            for layout in cache_layout.LAYOUTS:
+                ident_dp = cache_layout.ident_dir(ident, layout)
+                self.assertEqual(cache_layout.ident_of(ident_dp, layout), ident)
+
+    def test_sharded(self):
+        ident_dp = cache_layout.ident_dir('01/02/0001.jp2', 'sharded')
+        parts = ident_dp.split('/')
+        self.assertEqual([len(p) for p in parts[:2]], [2, 3])
+        self.assertEqual('/'.join(parts[2:]), '01/02/0001.jp2')
+        # neither is taken for the other
+        self.assertEqual(cache_layout.ident_of(ident_dp, 'flat'), None)
+        self.assertEqual(cache_layout.ident_of('01/02/0001.jp2', 'sharded'), None)
+
+    def test_unknown_layout(self):
+        self.assertRaises(ValueError, cache_layout.check, 'deep')
+
+
+class Test_Migrator(loris_t.LorisTest):
+
+    def test_flat_to_sharded(self):
+        ident = self.test_jp2_color_id
+        self.client.get('/%s/full/pct:10/0/default.jpg' % (ident,))
+        self.client.get('/%s/info.json' % (ident,))
+        image_request = img.ImageRequest(ident, 'full', 'pct:10', '0', 'default', 'jpg')
+        flat_fp = self.app.img_cache.lookup(image_request)[0]
+
+        migrator = Migrator('flat', 'sharded')
+        migrator.migrate_images(self.app.img_cache.cache_root)
+        migrator.migrate_info(self.app.info_cache.root)
+        self.assertEqual(migrator.stats, {'files' : 1, 'links' : 1, 'info' : 1})
+        self.assertFalse(path.exists(flat_fp))
+        self.assertFalse(path.exists(path.join(self.app.img_cache.cache_root,
+            unquote(ident).split('/')[0])))
+
+        cache = img.ImageCache(self.app.img_cache.cache_root, layout='sharded')
+        fp = cache.lookup(image_request)[0]
+        self.assertEqual(readlink(path.join(self.app.img_cache.cache_root,
+            cache_layout.ident_dir(unquote(ident), 'sharded'), 'full', 'pct:10',
+            '0', 'default.jpg')), fp)
+
+        self.app.info_cache.layout = 'sharded'
+        self.app.info_cache._lru.clear()
+        self.assertTrue(ident in self.app.info_cache)
+        self.assertEqual(self.app.info_cache.stats()['migrated'], 0)
+
+        # and again does nothing
+        again = Migrator('flat', 'sharded')
+        again.migrate_images(self.app.img_cache.cache_root)
+        again.migrate_info(self.app.info_cache.root)
+        self.assertEqual(again.stats, {'files' : 0, 'links' : 0, 'info' : 0})
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_cache_layout, 'test'))
+    test_suites.append(unittest.makeSuite(Test_Migrator, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
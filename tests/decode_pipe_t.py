@@ -0,0 +1,212 @@
+#-*- coding: utf-8 -*-
+
+from PIL import Image
+from loris.decode_pipe import DecoderException, FifoPool, PNMReader, run_decoder
+import io
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import stat
+import os
+import sys
+import unittest
+
+
+"""
+decode_pipe tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.decode_pipe_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+def writer(code):
+    '''A stand-in decoder: python writing to the FIFO given as argv[1].
+    '''
+    return lambda fifo_fp: [sys.executable, '-c', code, fifo_fp]
+
+class Test_FifoPool(unittest.TestCase):
+
+    def setUp(self):
+        self.dp = mkdtemp()
+        self.pool = FifoPool(self.dp, size=2)
+
+    def tearDown(self):
+        rmtree(self.dp)
+
+    def test_makes_fifos(self):
+        fifo_fp = self.pool.acquire('bmp')
+        self.assertTrue(stat.S_ISFIFO(os.stat(fifo_fp).st_mode))
+        self.assertTrue(fifo_fp.endswith('.bmp'))
+        self.assertTrue(path.basename(fifo_fp).startswith('%d-' % (os.getpid(),)))
+
+    def test_names_are_unique(self):
+        fps = set(self.pool.acquire('bmp') for _ in range(100))
+        self.assertEqual(len(fps), 100)
+
+    def test_reuses_fifos(self):
+        fifo_fp = self.pool.acquire('bmp')
+        self.pool.release(fifo_fp)
+        self.assertEqual(self.pool.acquire('bmp'), fifo_fp)
+        self.assertNotEqual(self.pool.acquire('bmp'), fifo_fp)
+
+    def test_keeps_fifos_per_extension(self):
+        fifo_fp = self.pool.acquire('bmp')
+        self.pool.release(fifo_fp)
+        self.assertNotEqual(self.pool.acquire('ppm'), fifo_fp)
+
+    def test_does_not_reuse_after_failure(self):
+        fifo_fp = self.pool.acquire('bmp')
+        self.pool.release(fifo_fp, reuse=False)
+        self.assertFalse(path.exists(fifo_fp))
+
+    def test_keeps_at_most_size(self):
+        fps = [self.pool.acquire('bmp') for _ in range(3)]
+        map(self.pool.release, fps)
+        self.assertEqual(len(os.listdir(self.dp)), 2)
+
+    def test_close_removes_fifos(self):
+        self.pool.release(self.pool.acquire('bmp'))
+        self.pool.close()
+        self.assertEqual(os.listdir(self.dp), [])
+
+    def test_forked_child_gets_its_own(self):
+        fifo_fp = self.pool.acquire('bmp')
+        self.pool.release(fifo_fp)
+        self.pool._pid = -1 # as if we'd forked
+        self.assertNotEqual(self.pool.acquire('bmp'), fifo_fp)
+
+class Trickle(object):
+    '''A non-blocking file that has `n` bytes available at a time.
+    '''
+    def __init__(self, data, n):
+        self.f = io.BytesIO(data)
+        self.n = n
+        self.blocked = False
+
+    def read(self, size):
+        if self.blocked:
+            return None
+        self.blocked = True
+        return self.f.read(min(size, self.n))
+
+    def readinto(self, b):
+        if self.blocked:
+            return None
+        self.blocked = True
+        data = self.f.read(min(len(b), self.n))
+        b[:len(data)] = data
+        return len(data)
+
+class Test_PNMReader(unittest.TestCase):
+
+    def _read(self, data, n=None):
+        reader = PNMReader()
+        if n is None:
+            reader.read_from(io.BytesIO(data))
+        else:
+            f = Trickle(data, n)
+            while f.f.tell() < len(data):
+                f.blocked = False
+                reader.read_from(f)
+        return reader.result()
+
+    def test_gray(self):
+        im = self._read('P5\n3 2\n255\n' + '\x00\x01\x02\x03\x04\xff')
+        self.assertEqual(im.mode, 'L')
+        self.assertEqual(im.size, (3, 2))
+        self.assertEqual(list(im.getdata()), [0, 1, 2, 3, 4, 255])
+
+    def test_rgb(self):
+        im = self._read('P6 2 1 255\n' + '\x01\x02\x03\x04\x05\x06')
+        self.assertEqual(im.mode, 'RGB')
+        self.assertEqual(list(im.getdata()), [(1, 2, 3), (4, 5, 6)])
+
+    def test_comments(self):
+        im = self._read('P5\n# made by kdu\n1 1\n# really\n255\n\x07')
+        self.assertEqual(list(im.getdata()), [7])
+
+    def test_arrives_in_pieces(self):
+        src = Image.new('RGB', (40, 30), (10, 200, 30))
+        b = io.BytesIO()
+        src.save(b, 'PPM')
+        im = self._read(b.getvalue(), n=7)
+        self.assertEqual(im.tobytes(), src.tobytes())
+
+    def test_16_bit(self):
+        data = 'P5 2 1 65535\n' + '\xff\xff\x80\x00'
+        self.assertEqual(list(self._read(data).getdata()), [255, 128])
+
+    def test_12_bit(self):
+        data = 'P6 1 1 4095\n' + '\x0f\xff\x00\x00\x08\x00'
+        self.assertEqual(list(self._read(data).getdata()), [(255, 0, 128)])
+
+    def test_7_bit(self):
+        data = 'P5 2 1 127\n' + '\x7f\x00'
+        self.assertEqual(list(self._read(data).getdata()), [255, 0])
+
+    def test_truncated(self):
+        self.assertRaises(IOError, self._read, 'P5 2 2 255\n\x00\x00')
+
+    def test_not_a_pnm(self):
+        self.assertRaises(IOError, self._read, 'BM\x00\x00\x00\x00')
+
+class Test_run_decoder(unittest.TestCase):
+
+    def setUp(self):
+        self.dp = mkdtemp()
+        self.pool = FifoPool(self.dp)
+
+    def tearDown(self):
+        rmtree(self.dp)
+
+    def _run(self, make_argv):
+        fifo_fp = self.pool.acquire('bmp')
+        try:
+            return run_decoder(make_argv(fifo_fp), fifo_fp)
+        finally:
+            self.pool.release(fifo_fp)
+
+    def test_collects_output(self):
+        out = self._run(writer("import sys; open(sys.argv[1], 'wb').write('abc')"))
+        self.assertEqual(out, 'abc')
+
+    def test_collects_more_than_a_pipe_holds(self):
+        code = "import sys; open(sys.argv[1], 'wb').write('x' * (5 * 1048576))"
+        out = self._run(writer(code))
+        self.assertEqual(len(out), 5 * 1048576)
+
+    def test_fifo_can_be_reused(self):
+        make_argv = writer("import sys; open(sys.argv[1], 'wb').write('abc')")
+        self.assertEqual(self._run(make_argv), 'abc')
+        self.assertEqual(self._run(make_argv), 'abc')
+
+    def test_failure_raises_with_stderr(self):
+        code = "import sys; sys.stderr.write('no such file'); sys.exit(2)"
+        try:
+            self._run(writer(code))
+        except DecoderException as de:
+            self.assertEqual(de.returncode, 2)
+            self.assertTrue('no such file' in str(de))
+        else:
+            self.fail('DecoderException not raised')
+
+    def test_reads_a_pnm(self):
+        code = "import sys; open(sys.argv[1], 'wb').write('P5 1000 1000 255\\n' + 'x' * 1000000)"
+        fifo_fp = self.pool.acquire('pgm')
+        im = run_decoder(writer(code)(fifo_fp), fifo_fp, reader=PNMReader())
+        self.assertEqual(im.size, (1000, 1000))
+        self.assertEqual(im.getpixel((999, 999)), ord('x'))
+
+    def test_decoder_that_never_opens_the_fifo_does_not_hang(self):
+        out = self._run(writer("pass"))
+        self.assertEqual(out, '')
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_FifoPool, 'test'))
+    test_suites.append(unittest.makeSuite(Test_PNMReader, 'test'))
+    test_suites.append(unittest.makeSuite(Test_run_decoder, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
@@ -0,0 +1,102 @@
+#-*- coding: utf-8 -*-
+
+from PIL import Image
+from loris.decoded_cache import DecodedImageCache, pixel_bytes
+from os import path, utime
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+import time
+import unittest
+
+
+"""
+DecodedImageCache tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.decoded_cache_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_DecodedImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dp = mkdtemp()
+        self.fps = []
+        for i in range(3):
+            fp = path.join(self.dp, '%d.png' % (i,))
+            Image.new('L', (100, 100), i).save(fp)
+            self.fps.append(fp)
+        self.loads = []
+
+    def tearDown(self):
+        rmtree(self.dp)
+
+    def _load(self, fp):
+        self.loads.append(fp)
+        return Image.open(fp)
+
+    def test_pixel_bytes(self):
+        self.assertEqual(pixel_bytes(Image.new('L', (10, 10))), 100)
+        self.assertEqual(pixel_bytes(Image.new('RGB', (10, 10))), 400)
+        self.assertEqual(pixel_bytes(Image.new('I;16', (10, 10))), 200)
+
+    def test_decodes_once(self):
+        cache = DecodedImageCache(100000)
+        first = cache.get(self.fps[0], self._load)
+        second = cache.get(self.fps[0], self._load)
+        self.assertIs(first, second)
+        self.assertEqual(self.loads, [self.fps[0]])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = DecodedImageCache(25000) # room for two
+        cache.get(self.fps[0], self._load)
+        cache.get(self.fps[1], self._load)
+        cache.get(self.fps[0], self._load)
+        cache.get(self.fps[2], self._load) # evicts 1
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size_bytes, 20000)
+        cache.get(self.fps[0], self._load)
+        cache.get(self.fps[1], self._load)
+        self.assertEqual(self.loads, [self.fps[0], self.fps[1], self.fps[2], self.fps[1]])
+
+    def test_too_big_is_not_cached(self):
+        cache = DecodedImageCache(9999)
+        cache.get(self.fps[0], self._load)
+        cache.get(self.fps[0], self._load)
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual(len(cache), 0)
+
+    def test_changed_file_is_decoded_again(self):
+        cache = DecodedImageCache(100000)
+        cache.get(self.fps[0], self._load)
+        later = time.time() + 10
+        utime(self.fps[0], (later, later))
+        cache.get(self.fps[0], self._load)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_variants(self):
+        cache = DecodedImageCache(100000)
+        cache.get(self.fps[0], self._load, variant=1)
+        cache.get(self.fps[0], self._load, variant=2)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_concurrent_misses_decode_once(self):
+        cache = DecodedImageCache(100000)
+        def slow_load(fp):
+            time.sleep(0.2)
+            return self._load(fp)
+        threads = [Thread(target=cache.get, args=(self.fps[0], slow_load))
+            for _ in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(cache.hits + cache.misses, 8)
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_DecodedImageCache, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
@@ -5,10 +5,14 @@ from loris import img_info
 from loris import loris_exception
 from loris.constants import PROTOCOL
 from os import path
+from shutil import copy, rmtree
+from tempfile import mkdtemp
 from urllib import unquote
 from werkzeug.datastructures import Headers
 import json
 import loris_t
+import os
+import zlib
 
 
 """
@@ -332,17 +336,213 @@ class InfoFunctional(loris_t.LorisTest):
 
 class InfoCache(loris_t.LorisTest):
 
-    def test_info_goes_to_http_fs_cache(self):
-        # there isn't a way to do a fake HTTPS request, but this at least
-        # confirms that HTTP goes to ther right place.
-        request_uri = '/%s/%s' % (self.test_jp2_color_id,'info.json')
-        resp = self.client.get(request_uri)
+    def test_info_goes_to_fs_cache_once(self):
+        for base_url in ('http://localhost/', 'https://localhost/', 'http://example.org/'):
+            request_uri = '/%s/%s' % (self.test_jpeg_id,'info.json')
+            resp = self.client.get(request_uri, base_url=base_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data)['@id'],
+                '%s%s' % (base_url, self.test_jpeg_id))
         expected_path = path.join(
-            self.app.info_cache.http_root,
-            unquote(self.test_jp2_color_id),
+            self.app.info_cache.root,
+            unquote(self.test_jpeg_id),
             'info.json'
         )
         self.assertTrue(path.exists(expected_path))
+        self.assertFalse(path.exists(self.app.info_cache.http_root))
+        self.assertFalse(path.exists(self.app.info_cache.https_root))
+
+    def test_one_entry_for_every_way_of_asking(self):
+        ident = self.test_tiff_id
+        for request_path, base_url in (
+                ('/%s/info.json', 'http://localhost/'),
+                ('/%s/info.json', 'https://localhost/'),
+                ('/%s/info.json?callback=cb', 'http://localhost/'),
+                ('/%s/full/full/0/default.jpg', 'http://localhost/')
+            ):
+            resp = self.client.get(request_path % (ident,), base_url=base_url)
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self.app.info_cache), 1)
+        self.assertTrue(resp.headers['Link'].find('canonical') > -1)
+
+        resp = self.client.get('/%s/info.json?callback=cb' % (ident,),
+            base_url='https://example.org/iiif/')
+        self.assertEqual(resp.data[:3], 'cb(')
+        info = json.loads(resp.data[3:-2])
+        self.assertEqual(info['@id'], 'https://example.org/iiif/%s' % (ident,))
+
+    def test_legacy_entries_are_moved(self):
+        # As the cache used to store them, per scheme, with the @id in them.
+        cache = self.app.info_cache
+        ident = unquote(self.test_jp2_with_embedded_profile_id)
+        info = img_info.ImageInfo.from_image_file('http://old/%s' % (ident,),
+            self.test_jp2_with_embedded_profile_fp, 'jp2', ['jpg'])
+        for root in (cache.http_root, cache.https_root):
+            dp = path.join(root, ident)
+            os.makedirs(dp)
+            with open(path.join(dp, 'info.json'), 'w') as f:
+                f.write(info.to_json())
+            with open(path.join(dp, 'profile.icc'), 'wb') as f:
+                f.write(info.color_profile_bytes)
+
+        def fail(*args):
+            raise AssertionError('should not be extracted again')
+        self.app.resolver.resolve = fail
+
+        resp = self.client.get('/%s/info.json' % (ident,))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['@id'], 'http://localhost/%s' % (ident,))
+
+        moved_dp = path.join(cache.root, ident)
+        self.assertTrue(path.exists(path.join(moved_dp, 'info.json')))
+        self.assertTrue(path.exists(path.join(moved_dp, 'profile.icc')))
+        self.assertFalse(path.exists(path.join(cache.http_root, ident)))
+        self.assertFalse(path.exists(path.join(cache.https_root, ident)))
+        self.assertEqual(cache.stats()['migrated'], 1)
+        cached_info, _ = cache[ident]
+        self.assertEqual(cached_info.color_profile_bytes, info.color_profile_bytes)
+
+    def test_info_is_compressed_when_asked(self):
+        request_uri = '/%s/info.json' % (self.test_tiff_id,)
+        plain = self.client.get(request_uri)
+        self.assertEqual(plain.headers.get('Content-Encoding'), None)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+
+        headers = Headers([('Accept-Encoding', 'gzip, deflate')])
+        resp = self.client.get(request_uri, headers=headers)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(resp.data, 31), plain.data)
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+
+        headers = Headers([('Accept-Encoding', 'gzip;q=0, identity')])
+        resp = self.client.get(request_uri, headers=headers)
+        self.assertEqual(resp.headers.get('Content-Encoding'), None)
+        self.assertEqual(resp.data, plain.data)
+
+    def test_bodies_are_made_once(self):
+        request_uri = '/%s/info.json' % (self.test_tiff_id,)
+        headers = Headers([('Accept-Encoding', 'gzip')])
+        first = self.client.get(request_uri, headers=headers)
+        second = self.client.get(request_uri, headers=headers)
+        self.assertEqual(first.data, second.data)
+        stats = self.app.info_cache.stats()['bodies']
+        # gzip, and the JSON it was made from
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['hits'], 1)
+
+        # another @id is another body...
+        other = self.client.get(request_uri, headers=headers,
+            base_url='https://example.org/')
+        other_info = json.loads(zlib.decompress(other.data, 31))
+        self.assertEqual(other_info['@id'], 'https://example.org/%s' % (self.test_tiff_id,))
+        self.assertEqual(self.app.info_cache.stats()['bodies']['entries'], 4)
+        # ...but the same entry
+        self.assertEqual(len(self.app.info_cache), 1)
+
+    def test_bodies_follow_the_entry(self):
+        cache, src_fp = self._cache_and_source()
+        cache['src.tif'] = self._info(src_fp)
+        info, _ = cache['src.tif']
+        body = cache.body(info, 'http://example.org/src.tif')
+        self.assertEqual(json.loads(body)['@id'], 'http://example.org/src.tif')
+        self.assertTrue(cache.body(info, 'http://example.org/src.tif') is body)
+
+        replaced = self._info(src_fp)
+        replaced.width = 1
+        cache['src.tif'] = replaced
+        info, _ = cache['src.tif']
+        body = cache.body(info, 'http://example.org/src.tif')
+        self.assertEqual(json.loads(body)['width'], 1)
+
+    def _cache_and_source(self, size=500):
+        # a copy of the source that can be changed
+        tmp_dp = mkdtemp()
+        self.addCleanup(rmtree, tmp_dp)
+        src_fp = path.join(tmp_dp, 'src.tif')
+        copy(self.test_tiff_fp, src_fp)
+        return img_info.InfoCache(path.join(tmp_dp, 'cache'), size), src_fp
+
+    def _info(self, src_fp, ident='src.tif'):
+        return img_info.ImageInfo.from_image_file(ident, src_fp, 'tif')
+
+    def test_hits_refresh_recency(self):
+        cache, src_fp = self._cache_and_source(size=2)
+        cache._lru = img_info.ShardedLRU(2, 10 ** 6, shards=1)
+        for ident in ('a', 'b'):
+            cache[ident] = self._info(src_fp, ident)
+        cache.get('a')
+        cache['c'] = self._info(src_fp, 'c')
+        self.assertTrue(cache._lru.peek('a') is not None)
+        self.assertTrue(cache._lru.peek('b') is None)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_read_from_disk_are_bounded(self):
+        cache, src_fp = self._cache_and_source()
+        for ident in ('a', 'b', 'c'):
+            cache[ident] = self._info(src_fp, ident)
+
+        restarted = img_info.InfoCache(path.dirname(cache.root), size=2)
+        for ident in ('a', 'b', 'c'):
+            info, _ = restarted[ident]
+            self.assertEqual(info.ident, ident)
+        self.assertEqual(len(restarted), 2)
+        stats = restarted.stats()
+        self.assertEqual(stats['disk_hits'], 3)
+        restarted.get('c')
+        self.assertEqual(restarted.stats()['hits'], stats['hits'] + 1)
+
+    def test_changed_source_is_a_miss(self):
+        cache, src_fp = self._cache_and_source()
+        cache['src.tif'] = self._info(src_fp)
+        self.assertTrue('src.tif' in cache)
+
+        st = os.stat(src_fp)
+        os.utime(src_fp, (st.st_atime, st.st_mtime + 10))
+        self.assertEqual(cache.get('src.tif'), None)
+        self.assertFalse(path.exists(cache.get_info_fp('src.tif')))
+        self.assertEqual(cache.stats()['stale'], 1)
+
+    def test_changed_source_is_a_miss_after_a_restart(self):
+        cache, src_fp = self._cache_and_source()
+        cache['src.tif'] = self._info(src_fp)
+        restarted = img_info.InfoCache(path.dirname(cache.root))
+        self.assertTrue('src.tif' in restarted)
+
+        with open(src_fp, 'ab') as f:
+            f.write('more')
+        self.assertFalse('src.tif' in restarted)
+
+    def test_replaced_source_is_reread(self):
+        # Functional: a new image under the same identifier gets new info.
+        tmp_dp = mkdtemp()
+        self.addCleanup(rmtree, tmp_dp)
+        src_fp = path.join(tmp_dp, 'replaced.jpg')
+        copy(self.test_jpeg_fp, src_fp)
+        self.app.resolver.source_roots = [tmp_dp]
+        resp = self.client.get('/replaced.jpg/info.json')
+        self.assertEqual(json.loads(resp.data)['width'], self.test_jpeg_dims[0])
+
+        copy(self.test_tiff_fp, src_fp) # not really a JPEG, but Pillow won't mind
+        os.utime(src_fp, (0, 0))
+        resp = self.client.get('/replaced.jpg/info.json')
+        self.assertEqual(json.loads(resp.data)['width'], self.test_tiff_dims[0])
+
+    def test_sharded_layout_moves_previous_entries(self):
+        cache, src_fp = self._cache_and_source()
+        cache['a/b.tif'] = self._info(src_fp, 'a/b.tif')
+        flat_fp = cache.get_info_fp('a/b.tif')
+        self.assertEqual(flat_fp, path.join(cache.root, 'a', 'b.tif', 'info.json'))
+
+        sharded = img_info.InfoCache(path.dirname(cache.root), layout='sharded',
+            previous_layout='flat')
+        sharded_fp = sharded.get_info_fp('a/b.tif')
+        self.assertNotEqual(sharded_fp, flat_fp)
+        self.assertTrue(sharded_fp.endswith(path.join('a', 'b.tif', 'info.json')))
+        self.assertEqual(sharded['a/b.tif'][0].ident, 'a/b.tif')
+        self.assertTrue(path.exists(sharded_fp))
+        self.assertFalse(path.exists(flat_fp))
+        self.assertEqual(sharded.stats()['migrated'], 1)
 
 def suite():
     import unittest
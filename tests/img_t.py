@@ -1,11 +1,14 @@
 #-*- coding: utf-8 -*-
 
+from datetime import datetime
+from os import unlink, utime
 from os.path import exists
 from os.path import islink
 from os.path import isfile
 from os.path import join
 from urllib import unquote
-from loris import img, img_info
+from loris import cache_layout, img, img_info
+from time import sleep
 import loris_t
 
 
@@ -70,9 +73,148 @@ class Test_ImageCache(loris_t.LorisTest):
         self.app.img_cache.create_dir_and_return_file_path(image_request)
 
 
+class Test_ImageCacheIndex(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_ImageCacheIndex, self).setUp()
+        self.request_path = '/%s/full/pct:10/0/default.jpg' % (self.test_tiff_id,)
+        self.image_request = img.ImageRequest(self.test_tiff_id, 'full', 'pct:10',
+            '0', 'default', 'jpg')
+
+    def _count_calls(self, module, name):
+        calls = []
+        real = getattr(module, name)
+        def counted(*args):
+            calls.append(args)
+            return real(*args)
+        setattr(module, name, counted)
+        self.addCleanup(setattr, module, name, real)
+        return calls
+
+    def test_hit_stats_once(self):
+        self.assertEqual(self.client.get(self.request_path).status_code, 200)
+        stats = self._count_calls(img, 'stat')
+        realpaths = self._count_calls(img.path, 'realpath')
+        resp = self.client.get(self.request_path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(realpaths, [])
+        fp, _, size = self.app.img_cache.lookup(self.image_request)
+        self.assertEqual(int(resp.headers['Content-Length']), size)
+        self.assertFalse(islink(fp)) # the canonical file, not the symlink
+
+    def test_removed_files_are_noticed(self):
+        self.client.get(self.request_path)
+        fp = self.app.img_cache.lookup(self.image_request)[0]
+        unlink(fp)
+        self.assertEqual(self.app.img_cache.get(self.image_request), None)
+        resp = self.client.get(self.request_path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(exists(fp))
+
+    def test_replaced_files_are_noticed(self):
+        self.client.get(self.request_path)
+        fp, last_mod, size = self.app.img_cache.lookup(self.image_request)
+        with open(fp, 'ab') as f:
+            f.write('more')
+        utime(fp, (0, 0))
+        fp, new_last_mod, new_size = self.app.img_cache.lookup(self.image_request)
+        self.assertEqual(new_size, size + 4)
+        self.assertEqual(new_last_mod, datetime.utcfromtimestamp(0))
+
+    def test_misses_are_remembered(self):
+        cache = img.ImageCache(self.app.img_cache.cache_root)
+        self.assertEqual(cache.lookup(self.image_request), None)
+        self.client.get(self.request_path) # i.e. another process
+
+        stats = self._count_calls(img, 'stat')
+        self.assertEqual(cache.lookup(self.image_request), None)
+        self.assertEqual(stats, [])
+
+        cache.negative_ttl = 0
+        sleep(0.01)
+        self.assertTrue(cache.lookup(self.image_request) is not None)
+
+    def test_made_by_this_process_beats_remembered_miss(self):
+        self.assertFalse(self.image_request in self.app.img_cache)
+        resp = self.client.get(self.request_path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.image_request in self.app.img_cache)
+
+
+class Test_ImageCacheRam(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_ImageCacheRam, self).setUp()
+        self.app.img_cache = img.ImageCache(self.app.img_cache.cache_root,
+            ram_bytes=1024*1024, ram_item_bytes=1024*1024)
+        self.request_path = '/%s/full/pct:10/0/default.jpg' % (self.test_tiff_id,)
+        self.image_request = img.ImageRequest(self.test_tiff_id, 'full', 'pct:10',
+            '0', 'default', 'jpg')
+
+    def test_second_hit_is_kept(self):
+        made = self.client.get(self.request_path) # opened once
+        self.assertEqual(self.app.img_cache.ram_stats()['entries'], 0)
+        self.client.get(self.request_path) # and again, so it's read in
+        self.assertEqual(self.app.img_cache.ram_stats()['entries'], 1)
+        resp = self.client.get(self.request_path)
+        self.assertEqual(resp.data, made.data)
+        self.assertEqual(int(resp.headers['Content-Length']), len(made.data))
+        self.assertEqual(resp.headers['Last-Modified'], made.headers['Last-Modified'])
+        self.assertEqual(self.app.img_cache.ram_stats()['hits'], 1)
+
+    def test_big_ones_are_not_kept(self):
+        self.app.img_cache.ram_item_bytes = 10
+        for _ in range(3):
+            self.client.get(self.request_path)
+        self.assertEqual(self.app.img_cache.ram_stats()['entries'], 0)
+
+    def test_replaced_files_are_noticed(self):
+        for _ in range(2):
+            self.client.get(self.request_path)
+        fp = self.app.img_cache.lookup(self.image_request)[0]
+        with open(fp, 'ab') as f:
+            f.write('more')
+        utime(fp, (0, 0))
+        resp = self.client.get(self.request_path)
+        self.assertTrue(resp.data.endswith('more'))
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+
+
+class Test_ImageCacheLayout(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_ImageCacheLayout, self).setUp()
+        self.request_path = '/%s/full/pct:10/0/default.jpg' % (self.test_tiff_id,)
+        self.image_request = img.ImageRequest(self.test_tiff_id, 'full', 'pct:10',
+            '0', 'default', 'jpg')
+
+    def test_sharded_layout(self):
+        self.app.img_cache.layout = 'sharded'
+        self.client.get(self.request_path)
+        fp = self.app.img_cache.lookup(self.image_request)[0]
+        ident_dp = cache_layout.ident_dir(unquote(self.test_tiff_id), 'sharded')
+        self.assertTrue(fp.startswith(join(self.app.img_cache.cache_root, ident_dp)))
+        self.assertFalse(exists(join(self.app.img_cache.cache_root,
+            unquote(self.test_tiff_id))))
+
+    def test_previous_layout_is_read(self):
+        self.client.get(self.request_path)
+        flat_fp = self.app.img_cache.lookup(self.image_request)[0]
+
+        cache = img.ImageCache(self.app.img_cache.cache_root, layout='sharded')
+        self.assertEqual(cache.lookup(self.image_request), None)
+        cache = img.ImageCache(self.app.img_cache.cache_root, layout='sharded',
+            previous_layout='flat')
+        self.assertEqual(cache.lookup(self.image_request)[0], flat_fp)
+
+
 def suite():
     import unittest
     test_suites = []
     test_suites.append(unittest.makeSuite(Test_ImageCache, 'test'))
+    test_suites.append(unittest.makeSuite(Test_ImageCacheIndex, 'test'))
+    test_suites.append(unittest.makeSuite(Test_ImageCacheRam, 'test'))
+    test_suites.append(unittest.makeSuite(Test_ImageCacheLayout, 'test'))
     test_suite = unittest.TestSuite(test_suites)
     return test_suite
@@ -0,0 +1,95 @@
+#-*- coding: utf-8 -*-
+
+from loris import info_batch
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+from urllib import unquote
+import json
+import loris_t
+import os
+import sys
+
+
+"""
+Batch info extraction tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.info_batch_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_InfoExtractor(loris_t.LorisTest):
+
+    def test_writes_info_and_profile(self):
+        ident = self.test_jp2_with_embedded_profile_id
+        extractor = info_batch.InfoExtractor(self.app)
+        result = extractor.run(ident)
+
+        info_fp = path.join(self.app.info_cache.root, ident, 'info.json')
+        self.assertEqual(result['written'], info_fp)
+        self.assertTrue(path.exists(path.join(path.dirname(info_fp), 'profile.icc')))
+
+        # and a request finds it
+        resp = self.client.get('/%s/info.json' % (ident,))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['@id'], self.test_jp2_with_embedded_profile_uri)
+        self.assertEqual(self.app.info_cache.stats()['disk_hits'], 1)
+
+    def test_skips_up_to_date_entries(self):
+        ident = unquote(self.test_tiff_id)
+        extractor = info_batch.InfoExtractor(self.app)
+        self.assertFalse(extractor.run(ident).get('skipped'))
+        self.assertTrue(extractor.run(ident)['skipped'])
+
+        # older than the source
+        info_fp = path.join(self.app.info_cache.root, ident, 'info.json')
+        os.utime(info_fp, (0, 0))
+        self.assertFalse(extractor.run(ident).get('skipped'))
+
+        extractor.force = True
+        self.assertFalse(extractor.run(ident).get('skipped'))
+
+
+class Test_main(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_main, self).setUp()
+        self.tmp_dp = mkdtemp()
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        rmtree(self.tmp_dp)
+        super(Test_main, self).tearDown()
+
+    def test_ids(self):
+        ids_fp = path.join(self.tmp_dp, 'ids.txt')
+        idents = [unquote(self.test_jpeg_id), unquote(self.test_tiff_id), 'no/such.jp2']
+        with open(ids_fp, 'w') as f:
+            f.write('\n'.join(idents))
+
+        status = info_batch.main(['--ids', ids_fp, '--processes', '2'])
+        self.assertEqual(status, 1)
+
+        results = dict((r['ident'], r) for r in
+            map(json.loads, sys.stdout.getvalue().splitlines()))
+        self.assertEqual(sorted(results), sorted(idents))
+        self.assertTrue('error' in results['no/such.jp2'])
+        self.assertEqual((results[idents[1]]['width'], results[idents[1]]['height']),
+            self.test_tiff_dims)
+        self.assertTrue('2 extracted, 0 already there, 1 errors' in sys.stderr.getvalue())
+        for ident in idents[:2]:
+            info_fp = path.join(self.app.info_cache.root, ident, 'info.json')
+            self.assertTrue(path.exists(info_fp))
+
+
+def suite():
+    import unittest
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_InfoExtractor, 'test'))
+    test_suites.append(unittest.makeSuite(Test_main, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
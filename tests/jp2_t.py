@@ -0,0 +1,110 @@
+#-*- coding: utf-8 -*-
+
+from loris import jp2
+from os import path
+import loris_t
+import struct
+
+
+"""
+JP2 parser tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.jp2_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_parse(loris_t.LorisTest):
+
+    def _read(self, fp):
+        with open(fp, 'rb') as f:
+            return f.read()
+
+    def test_gray(self):
+        parsed = jp2.parse(self.test_jp2_gray_fp)
+        self.assertEqual((parsed.width, parsed.height), self.test_jp2_gray_dims)
+        self.assertEqual(parsed.num_components, 1)
+        self.assertEqual((parsed.colr_method, parsed.enum_cs), (1, 17))
+        self.assertEqual(parsed.icc_profile, None)
+
+        cs = parsed.codestream
+        self.assertEqual((cs.width, cs.height), self.test_jp2_gray_dims)
+        self.assertEqual(cs.tile_size, (256, 256))
+        self.assertEqual((cs.tiles_across, cs.tiles_down), (10, 13))
+        self.assertEqual(cs.components, [(8, False, 1, 1)])
+        self.assertEqual((cs.levels, cs.layers), (6, 8))
+        self.assertEqual(cs.cod.progression, 'RPCL')
+        self.assertEqual(cs.cod.cblk_size, (64, 64))
+        self.assertEqual(cs.cod.transform, 0)
+        self.assertEqual(cs.cod.precincts, [(256, 256)] * 7)
+        self.assertEqual(cs.qcd.style, 2)
+        self.assertEqual(len(cs.qcd.step_sizes), 3 * 6 + 1)
+        self.assertEqual(cs.tlm, None)
+
+    def test_embedded_profile(self):
+        parsed = jp2.parse(self.test_jp2_with_embedded_profile_fp)
+        self.assertEqual(parsed.colr_method, 2)
+        self.assertEqual(parsed.icc_profile,
+            self._read(self.test_jp2_embedded_profile_copy_fp))
+        self.assertEqual(parsed.codestream.cod.precincts, None)
+
+    def test_precincts_lowest_resolution_first(self):
+        fp = path.join(self.test_img_dir, '67352ccc-d1b0-11e1-89ae-279075081939.jp2')
+        cs = jp2.parse(fp).codestream
+        self.assertEqual(cs.cod.precincts,
+            [(128, 128), (128, 128), (128, 128), (256, 256), (256, 256)])
+
+    def test_skips_other_boxes(self):
+        data = self._read(self.test_jp2_gray_fp)
+        ftyp_end = 12 + struct.unpack('>I', data[12:16])[0]
+        # a big uuid box, and an xml box with an XLBox length
+        junk = ('ihdrcolr\xff\x4f\xff\x51' * 342)[:4096]
+        uuid = struct.pack('>I4s', 8 + len(junk), 'uuid') + junk
+        xml = struct.pack('>I4sQ', 1, 'xml ', 16 + 5) + '<a/>\n'
+        parsed = jp2.parse_buffer(data[:ftyp_end] + uuid + xml + data[ftyp_end:])
+        self.assertEqual((parsed.width, parsed.height), self.test_jp2_gray_dims)
+        self.assertEqual(parsed.codestream.levels, 6)
+
+    def test_stops_at_the_end_of_the_main_header(self):
+        data = self._read(self.test_jp2_gray_fp)
+        cs_start = data.index('jp2c') + 4
+        header_length = jp2.parse_buffer(data).codestream.header_length
+        self.assertEqual(data[cs_start+header_length:cs_start+header_length+2], '\xff\x90')
+        # nothing after the first SOT is needed
+        cut = data[:cs_start + header_length + 4]
+        self.assertEqual(jp2.parse_buffer(cut).codestream.header_length, header_length)
+
+    def test_tlm(self):
+        data = self._read(self.test_jp2_gray_fp)
+        box_start = data.index('jp2c') - 4
+        cs_start = box_start + 8
+        header_length = jp2.parse_buffer(data).codestream.header_length
+        # Ztlm 0, ST=1 (8-bit tile index), SP=1 (32-bit lengths)
+        entries = [(0, 1000), (1, 2000), (2, 3000)]
+        body = struct.pack('>BB', 0, 0x50) + ''.join(struct.pack('>BI', *e) for e in entries)
+        tlm = struct.pack('>HH', 0xFF55, 2 + len(body)) + body
+        box_len = struct.unpack('>I', data[box_start:box_start+4])[0]
+        if box_len:
+            box_len += len(tlm)
+        sot = cs_start + header_length
+        data = data[:box_start] + struct.pack('>I', box_len) + \
+            data[box_start+4:sot] + tlm + data[sot:]
+        cs = jp2.parse_buffer(data).codestream
+        self.assertEqual(cs.tlm, entries)
+        self.assertEqual(cs.header_length, header_length + len(tlm))
+
+    def test_invalid(self):
+        for data in (
+                self._read(self.test_jpeg_fp)[:4096], # not a JP2
+                self._read(self.test_jp2_gray_fp)[:200], # cut off
+                jp2.JP2_SIGNATURE # no boxes
+            ):
+            self.assertRaises(jp2.JP2Exception, jp2.parse_buffer, data)
+
+
+def suite():
+    import unittest
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_parse, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
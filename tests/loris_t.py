@@ -12,6 +12,7 @@ from shutil import rmtree
 from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
 from logging import getLogger
+import re
 
 logger = getLogger(__name__)
 
@@ -130,6 +131,14 @@ class LorisTest(unittest.TestCase):
         ]
 
 
+    def canonical_path(self, response, ident):
+        '''The path to request the canonical derivative for an image response
+        by, from its Link header.
+        '''
+        link = re.search(r'<([^>]*)>;rel="canonical"', response.headers['Link'])
+        params = link.group(1).rsplit('/', 4)[1:]
+        return '/'.join(['', ident] + params)
+
     def tearDown(self):
         # empty the cache
         dps = (
@@ -0,0 +1,78 @@
+#-*- coding: utf-8 -*-
+
+from loris.lru import ShardedLRU
+from threading import Thread
+import unittest
+
+
+"""
+LRU tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.lru_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_ShardedLRU(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = ShardedLRU(3, 1000, shards=1)
+        for k in 'abc':
+            lru.put(k, k.upper())
+        self.assertEqual(lru.get('a'), 'A') # now b is the oldest
+        lru.put('d', 'D')
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual([lru.peek(k) for k in 'acd'], ['A', 'C', 'D'])
+        self.assertEqual(len(lru), 3)
+
+    def test_bounded_by_bytes(self):
+        lru = ShardedLRU(100, 10, shards=1)
+        lru.put('a', 1, 4)
+        lru.put('b', 2, 4)
+        lru.put('c', 3, 4)
+        self.assertFalse('a' in lru)
+        self.assertEqual(lru.size_bytes, 8)
+        self.assertFalse(lru.put('big', 4, 11))
+        self.assertFalse('big' in lru)
+
+    def test_replacing_and_popping_keep_bytes(self):
+        lru = ShardedLRU(10, 100, shards=1)
+        lru.put('a', 1, 10)
+        lru.put('a', 2, 20)
+        self.assertEqual(lru.size_bytes, 20)
+        self.assertEqual(lru.pop('a'), 2)
+        self.assertEqual(lru.size_bytes, 0)
+        self.assertEqual(lru.pop('a'), None)
+
+    def test_stats(self):
+        lru = ShardedLRU(2, 1000, shards=2)
+        lru.put('a', 1, 5)
+        lru.get('a')
+        lru.get('b')
+        lru.put('b', 2)
+        lru.put('c', 3)
+        stats = lru.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['entries'] + stats['evictions'], 3)
+
+    def test_threads(self):
+        lru = ShardedLRU(500, 10 ** 6)
+        def work(n):
+            for i in range(2000):
+                key = (n * 7 + i) % 800
+                if lru.get(key) is None:
+                    lru.put(key, i, 10)
+        threads = [Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(len(lru) <= 500)
+        self.assertEqual(lru.size_bytes, len(lru) * 10)
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_ShardedLRU, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
@@ -0,0 +1,147 @@
+#-*- coding: utf-8 -*-
+
+from loris import img
+from loris.pack_store import PackStore, HEADER
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import loris_t
+import os
+import unittest
+
+
+"""
+Pack store tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.pack_store_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_PackStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def test_put_and_read(self):
+        store = PackStore(self.root)
+        store.put('a/full/full/0/default.jpg', 'AAA')
+        location = store.put('b/full/full/0/default.jpg', 'B' * 100000,
+            aliases=('b/full/pct:100/0/default.jpg',))
+        self.assertEqual(store.get('b/full/pct:100/0/default.jpg'), location)
+        self.assertEqual(''.join(store.open(location)), 'B' * 100000)
+        self.assertEqual(store.read(store.get('a/full/full/0/default.jpg')), 'AAA')
+        self.assertEqual(store.get('c/full/full/0/default.jpg'), None)
+        self.assertEqual(store.stats()['entries'], 2)
+        self.assertEqual(store.stats()['aliases'], 1)
+
+    def test_replace_and_delete(self):
+        store = PackStore(self.root)
+        store.put('a', 'old')
+        store.put('a', 'new')
+        self.assertEqual(store.read(store.get('a')), 'new')
+        self.assertEqual(store.stats()['live'], 3)
+        store.alias('b', 'a')
+        store.delete('a')
+        self.assertEqual(store.get('a'), None)
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.stats()['live'], 0)
+
+    def test_shared_between_stores(self):
+        # e.g. two Loris processes
+        one = PackStore(self.root)
+        two = PackStore(self.root)
+        one.put('a', 'A')
+        two.put('b', 'B')
+        self.assertEqual(one.read(one.get('b')), 'B')
+        self.assertEqual(two.read(two.get('a')), 'A')
+
+    def test_new_segments(self):
+        store = PackStore(self.root, segment_bytes=100)
+        for k in 'abc':
+            store.put(k, k * 60)
+        self.assertEqual(store.stats()['segments'], 3)
+        self.assertEqual([store.read(store.get(k)) for k in 'abc'], ['a' * 60, 'b' * 60, 'c' * 60])
+
+    def test_unindexed_records_are_recovered(self):
+        store = PackStore(self.root)
+        store.put('a', 'A')
+        # as if a process died between writing 'a' and indexing it
+        store._db.execute('UPDATE segments SET size = 0')
+        store._db.execute('DELETE FROM entries')
+        reopened = PackStore(self.root)
+        self.assertEqual(reopened.read(reopened.get('a')), 'A')
+
+    def test_torn_records_are_truncated(self):
+        store = PackStore(self.root)
+        store.put('a', 'A')
+        seg_fp = store._segment_fp(1)
+        size = path.getsize(seg_fp)
+        with open(seg_fp, 'ab') as f:
+            f.write(HEADER.pack('LPK1', 1, 1000, 0, 0) + 'bxxx')
+        store.put('c', 'C') # notices, and cuts it off first
+        self.assertEqual(store.get('c')[1], size + HEADER.size + 1)
+        self.assertEqual(store.read(store.get('c')), 'C')
+        self.assertEqual(store.get('b'), None)
+
+    def test_compact(self):
+        store = PackStore(self.root, segment_bytes=200, compact_below=0.5)
+        store.put('a', 'a' * 50)
+        store.put('b', 'b' * 50)
+        store.put('c', 'c' * 150) # a new segment
+        store.put('b', 'B' * 50) # and another; the first is now mostly dead
+        self.assertEqual(store.stats()['segments'], 3)
+        self.assertEqual(store.compact(), 1)
+        self.assertFalse(path.exists(store._segment_fp(1)))
+        self.assertEqual(store.read(store.get('a')), 'a' * 50)
+        self.assertEqual(store.read(store.get('b')), 'B' * 50)
+        stats = store.stats()
+        self.assertEqual(stats['live'], 250)
+        self.assertEqual(stats['entries'], 3)
+
+    def test_evict_oldest_segments(self):
+        store = PackStore(self.root, segment_bytes=100, max_bytes=200)
+        for k in 'abc':
+            store.put(k, k * 60)
+        self.assertEqual(store.evict(), 1)
+        self.assertEqual(store.get('a'), None)
+        self.assertEqual(store.read(store.get('c')), 'c' * 60)
+
+
+class Test_PackImageCache(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_PackImageCache, self).setUp()
+        self.app.img_cache = img.PackImageCache(self.app.img_cache.cache_root)
+        self.request_path = '/%s/full/pct:10/0/default.jpg' % (self.test_tiff_id,)
+        self.image_request = img.ImageRequest(self.test_tiff_id, 'full', 'pct:10',
+            '0', 'default', 'jpg')
+
+    def test_made_and_served_from_the_store(self):
+        made = self.client.get(self.request_path)
+        self.assertEqual(made.status_code, 200)
+        self.assertEqual(os.listdir(self.app.img_cache.staging_dp), [])
+
+        location, last_mod, size = self.app.img_cache.lookup(self.image_request)
+        hit = self.client.get(self.request_path)
+        self.assertEqual(hit.status_code, 200)
+        self.assertEqual(hit.data, made.data)
+        self.assertEqual(int(hit.headers['Content-Length']), size)
+        self.assertEqual(len(hit.data), size)
+        self.assertEqual(hit.headers['Link'], made.headers['Link'])
+        self.assertEqual(self.app.img_cache.store.stats()['aliases'], 1)
+
+        resp = self.client.get(self.request_path,
+            headers={'If-Modified-Since' : hit.headers['Last-Modified']})
+        self.assertEqual(resp.status_code, 304)
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_PackStore, 'test'))
+    test_suites.append(unittest.makeSuite(Test_PackImageCache, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
@@ -0,0 +1,128 @@
+#-*- coding: utf-8 -*-
+
+from PIL import Image, ImageChops, ImageStat
+from loris import img_info, pregen
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+import json
+import loris_t
+
+
+"""
+Pregeneration tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.pregen_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_pyramid(loris_t.LorisTest):
+
+    def _gray_info(self):
+        return img_info.ImageInfo.from_image_file(self.test_jp2_gray_uri,
+            self.test_jp2_gray_fp, self.test_jp2_gray_fmt)
+
+    def test_levels(self):
+        info = self._gray_info() # 2477x3200, 256px tiles
+        levels = pregen.pyramid(self.test_jp2_gray_id, info)
+        scales = [lvl.scale for lvl in levels]
+        self.assertEqual(scales, sorted(scales, reverse=True))
+        full_res = [lvl for lvl in levels if lvl.scale == 1][0]
+        self.assertEqual(full_res.size, (2477, 3200))
+        tiles = [d for d in full_res.derivatives if d.request.region_value != 'full']
+        self.assertEqual(len(tiles), 10 * 13)
+
+    def test_tile_requests(self):
+        info = self._gray_info()
+        levels = dict((lvl.scale, lvl) for lvl in pregen.pyramid(self.test_jp2_gray_id, info))
+        paths = [(d.request.region_value, d.request.size_value, d.box)
+            for d in levels[4].derivatives]
+        self.assertTrue(('0,0,1024,1024', '256,', (0, 0, 256, 256)) in paths)
+        # right and bottom edges
+        self.assertTrue(('2048,3072,429,128', '108,', (512, 768, 620, 800)) in paths)
+        # one tile for the whole image
+        self.assertEqual(levels[16].derivatives[0].request.region_value, 'full')
+        self.assertEqual(levels[16].derivatives[0].request.size_value, '155,')
+
+    def test_no_duplicates(self):
+        info = self._gray_info()
+        paths = [(d.request.region_value, d.request.size_value)
+            for lvl in pregen.pyramid(self.test_jp2_gray_id, info)
+            for d in lvl.derivatives]
+        self.assertEqual(len(paths), len(set(paths)))
+
+    def test_default_tiles(self):
+        info = img_info.ImageInfo.from_image_file(self.test_tiff_uri,
+            self.test_tiff_fp, self.test_tiff_fmt) # 839x1080
+        tiles = pregen.default_tiles(info, 256)
+        self.assertEqual(tiles, [{'width' : 256, 'scaleFactors' : [1, 2, 4, 8]}])
+
+
+class Test_Pregenerator(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_Pregenerator, self).setUp()
+        self.out_dp = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dp)
+        super(Test_Pregenerator, self).tearDown()
+
+    def test_into_image_cache(self):
+        output = pregen.CacheOutput(self.app.img_cache)
+        pregenerator = pregen.Pregenerator(self.app, output)
+        result = pregenerator.run(self.test_tiff_id)
+        self.assertEqual(result['made'], 4 * 5 + 2 * 3 + 2 * 1 + 1)
+        self.assertEqual(result['skipped'], 0)
+
+        # served from the cache, without transforming anything
+        def fail(*args):
+            raise AssertionError('should have come from the cache')
+        self.app.transformers['tif'].transform = fail
+        resp = self.client.get('/%s/256,512,256,256/256,/0/default.jpg' % (self.test_tiff_id,))
+        self.assertEqual(resp.status_code, 200)
+
+    def test_resumes(self):
+        output = pregen.CacheOutput(self.app.img_cache)
+        pregenerator = pregen.Pregenerator(self.app, output)
+        first = pregenerator.run(self.test_tiff_id)
+        second = pregenerator.run(self.test_tiff_id)
+        self.assertEqual(second['made'], 0)
+        self.assertEqual(second['skipped'], first['made'])
+
+    def test_static_level0(self):
+        output = pregen.StaticOutput(self.out_dp, 'https://example.org/iiif/')
+        pregenerator = pregen.Pregenerator(self.app, output)
+        pregenerator.run(self.test_jp2_gray_id)
+
+        ident_dp = path.join(self.out_dp, '01', '02', 'gray.jp2')
+        with open(path.join(ident_dp, 'info.json')) as f:
+            info = json.load(f)
+        self.assertEqual(info['@id'], 'https://example.org/iiif/01/02/gray.jp2')
+        self.assertEqual(info['profile'], [pregen.LEVEL0_COMPLIANCE])
+        self.assertEqual(info['tiles'][0]['width'], 256)
+
+        for size in info['sizes']:
+            fp = path.join(ident_dp, 'full', '%d,' % (size['width'],), '0', 'default.jpg')
+            self.assertEqual(Image.open(fp).size, (size['width'], size['height']))
+
+        tile_fp = path.join(ident_dp, '2048,3072,429,128', '108,', '0', 'default.jpg')
+        tile = Image.open(tile_fp)
+        self.assertEqual(tile.size, (108, 32))
+
+        # about the same as Loris would have made
+        resp = self.client.get('/%s/2048,3072,429,128/108,/0/default.jpg' % (self.test_jp2_gray_id,))
+        live = Image.open(StringIO(resp.data))
+        diff = ImageStat.Stat(ImageChops.difference(tile.convert('L'), live.convert('L'))).mean
+        self.assertTrue(max(diff) < 3, diff)
+
+
+def suite():
+    import unittest
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_pyramid, 'test'))
+    test_suites.append(unittest.makeSuite(Test_Pregenerator, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
@@ -5,13 +5,23 @@ from loris.resolver import (
         SimpleHTTPResolver,
         TemplateHTTPResolver,
         SourceImageCachingResolver,
-        SimpleFSResolver
+        SimpleFSResolver,
+        IwmFSResolver,
+        DRAIN_BYTES
     )
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import sleep
+from urlparse import urlparse, parse_qs
 from os.path import dirname
 from os.path import isfile
 from os.path import join
 from os.path import realpath
 from os.path import exists
+import json
 import unittest
 from urllib import unquote, quote_plus
 
@@ -301,21 +311,259 @@ class Test_TemplateHTTPResolver(loris_t.LorisTest):
         self.assertEqual(None,
             self.app.resolver._web_request_url('unknown:id2')[0])
 
+class _StandIn(ThreadingMixIn, HTTPServer):
+    # An HTTP server on localhost, in a thread of its own, that keeps what
+    # it's asked (and the client's address, so which connection it came on)
+    # in `queries`.
+    daemon_threads = True
+
+    def __init__(self, handler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.queries = []
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url_root(self):
+        return 'http://127.0.0.1:%d/' % (self.server_address[1],)
+
+    @property
+    def connections(self):
+        return len(set(address for _, address in self.queries))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        pass # e.g. a client hanging up part way through a response
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # so that connections can be kept open
+
+    def _send(self, status, body, content_type='application/json', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StandInSolr(_StandIn):
+    # Answers the queries IwmFSResolver makes from `docs`.
+
+    def __init__(self, docs):
+        _StandIn.__init__(self, _StandInSolrHandler)
+        self.docs = docs
+
+    @property
+    def url(self):
+        return self.url_root + 'solr/select/'
+
+
+class _StandInSolrHandler(_StandInHandler):
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        self.server.queries.append((params, self.client_address))
+        object_q, media_q = params['q'][0].split(' AND ')
+        object_id = object_q.split(':', 1)[1]
+        media_id = media_q.split(':', 1)[1]
+        docs = [d for d in self.server.docs
+            if d['identifier'] == object_id and media_id in d['mediaReference']]
+        self._send(200, json.dumps({'response' : {'numFound' : len(docs), 'docs' : docs}}))
+
+
+class _StandInOrigin(_StandIn):
+    # Serves `images` (name -> data) from /images/, honouring Range:
+    # bytes=0-0 if `ranges`, and after `delay` seconds. `most_fetching` is
+    # the most GETs it was answering at once.
+
+    def __init__(self, images, ranges=True, delay=0):
+        _StandIn.__init__(self, _StandInOriginHandler)
+        self.images = images
+        self.ranges = ranges
+        self.delay = delay
+        self.fetching = 0
+        self.most_fetching = 0
+        self.lock = Lock()
+
+
+class _StandInOriginHandler(_StandInHandler):
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        server.queries.append(((self.command, self.path, self.headers.get('Range')),
+            self.client_address))
+        with server.lock:
+            server.fetching += 1
+            server.most_fetching = max(server.most_fetching, server.fetching)
+        try:
+            sleep(server.delay)
+            data = server.images.get(self.path[len('/images/'):])
+            if data is None:
+                self._send(404, 'Not Found', 'text/plain')
+            elif self.headers.get('Range') == 'bytes=0-0' and server.ranges:
+                self._send(206, data[:1], 'image/jpeg',
+                    [('Content-Range', 'bytes 0-0/%d' % (len(data),))])
+            else:
+                self._send(200, data, 'image/jpeg')
+        finally:
+            with server.lock:
+                server.fetching -= 1
+
+
+class Test_HTTPResolverConnections(loris_t.LorisTest):
+    'Test how SimpleHTTPResolver and TemplateHTTPResolver use connections'
+
+    def setUp(self):
+        super(Test_HTTPResolverConnections, self).setUp()
+        self.images = dict(('%d.jpg' % (n,), chr(n) * 1000) for n in range(8))
+        self.images['big.jpg'] = 'b' * (DRAIN_BYTES * 4)
+        self.cache_root = mkdtemp()
+        self.addCleanup(rmtree, self.cache_root)
+
+    def _origin(self, **kwargs):
+        origin = _StandInOrigin(self.images, **kwargs)
+        self.addCleanup(origin.stop)
+        return origin
+
+    def _resolver(self, origin, **config):
+        config['cache_root'] = self.cache_root
+        config['source_prefix'] = origin.url_root + 'images/'
+        return SimpleHTTPResolver(config)
+
+    def test_connection_is_kept(self):
+        origin = self._origin()
+        resolver = self._resolver(origin)
+        self.assertTrue(resolver.is_resolvable('1.jpg'))
+        self.assertFalse(resolver.is_resolvable('missing.jpg'))
+        self.assertFalse(resolver.is_resolvable('missing.jpg'))
+        self.assertRaises(ResolverException, resolver.resolve, 'missing.jpg')
+        fp, fmt = resolver.resolve('1.jpg')
+        self.assertEqual(open(fp, 'rb').read(), self.images['1.jpg'])
+        resolver.resolve('2.jpg')
+        # probes only asked for a byte, and what's missing was remembered
+        self.assertEqual([q[0] for q in origin.queries], [
+            ('GET', '/images/1.jpg', 'bytes=0-0'),
+            ('GET', '/images/missing.jpg', 'bytes=0-0'),
+            ('GET', '/images/1.jpg', None),
+            ('GET', '/images/2.jpg', None)])
+        self.assertEqual(origin.connections, 1)
+
+    def test_head_probes(self):
+        origin = self._origin()
+        resolver = self._resolver(origin, head_resolvable=True)
+        self.assertTrue(resolver.is_resolvable('1.jpg'))
+        self.assertTrue(resolver.is_resolvable('big.jpg'))
+        self.assertFalse(resolver.is_resolvable('missing.jpg'))
+        self.assertEqual([q[0][0] for q in origin.queries], ['HEAD'] * 3)
+        self.assertEqual(origin.connections, 1)
+
+    def test_server_that_ignores_range(self):
+        origin = self._origin(ranges=False)
+        resolver = self._resolver(origin)
+        self.assertTrue(resolver.is_resolvable('1.jpg'))
+        # rather than read all of it, that connection is dropped
+        self.assertTrue(resolver.is_resolvable('big.jpg'))
+        self.assertTrue(resolver.is_resolvable('2.jpg'))
+        self.assertEqual(origin.connections, 2)
+
+    def test_fetches_are_capped(self):
+        origin = self._origin(delay=0.1)
+        resolver = self._resolver(origin, max_fetches=2, pool_size=4)
+        threads = [Thread(target=resolver.resolve, args=('%d.jpg' % (n,),))
+            for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(origin.queries), 8)
+        self.assertEqual(origin.most_fetching, 2)
+        self.assertTrue(origin.connections <= 4)
+
+    def test_a_pool_per_template(self):
+        origin = self._origin()
+        config = {
+            'cache_root' : self.cache_root,
+            'templates' : 'a, b',
+            'a' : {'url' : origin.url_root + 'images/%s'},
+            'b' : {'url' : origin.url_root + 'images/%s', 'max_fetches' : 1}
+        }
+        resolver = TemplateHTTPResolver(config)
+        resolver.resolve('a:1.jpg')
+        resolver.resolve('a:2.jpg')
+        resolver.resolve('b:3.jpg')
+        self.assertEqual(origin.connections, 2)
+
+
 class Test_IwmFSResolver(loris_t.LorisTest):
-    'Test IwmFSResolver'
+    'Test IwmFSResolver, against a stand-in for the CIIM Solr index'
+
+    def setUp(self):
+        super(Test_IwmFSResolver, self).setUp()
+        self.solr = _StandInSolr([{
+            'identifier' : 'object-1',
+            'mediaReference' : ['media-2', 'media-3'],
+            'largeMediaLocation' : ['01/04/0001.tif', '01/03/0001.jpg'],
+            'midMediaLocation' : ['01/03/0001.jpg', '01/03/0001.jpg'],
+            'thumbMediaLocation' : ['01/02/missing.jpg', '01/03/0001.jpg']
+        }])
+        self.addCleanup(self.solr.stop)
+
+    def _resolver(self, **config):
+        config.setdefault('src_img_roots', [join(self.test_img_dir, 'nowhere'),
+            self.test_img_dir])
+        config['ciim_url'] = self.solr.url
+        resolver = IwmFSResolver(config)
+        self.addCleanup(resolver.session.close)
+        return resolver
 
     def test_iwm_fs_resolver(self):
+        self.app.resolver = self._resolver()
+        resolved_path, fmt = self.app.resolver.resolve('object-1/media-2/large')
+        self.assertEqual(resolved_path, join(self.test_img_dir, '01', '04', '0001.tif'))
+        self.assertEqual(fmt, 'tif')
+        self.assertTrue(isfile(resolved_path))
 
-        config = {
-            'src_img_roots' : [self.test_img_dir]
-        }
-        self.app.resolver = IwmFSResolver(config)
-        expected_path = self.test_iwmfsresolver_fp
-
-        resolved_path, fmt = self.app.resolver.resolve(self.test_iwmfsresolver_id)
-        self.assertEqual(expected_path, resolved_path)
+        # the other sizes came with it
+        self.assertTrue(self.app.resolver.is_resolvable('object-1/media-2/mid'))
+        resolved_path, fmt = self.app.resolver.resolve('object-1%2Fmedia-2%2Fmid')
         self.assertEqual(fmt, 'jpg')
-        self.assertTrue(isfile(resolved_path))
+        self.assertEqual(len(self.solr.queries), 1)
+        params = self.solr.queries[0][0]
+        self.assertEqual(params['q'], ['identifier:object-1 AND mediaReference:media-2'])
+        self.assertEqual(params['fl'], ['*MediaLocation,mediaReference'])
+
+    def test_not_found_is_remembered(self):
+        resolver = self._resolver()
+        for _ in range(2):
+            # in Solr, but not on disk
+            self.assertFalse(resolver.is_resolvable('object-1/media-2/thumb'))
+            # not in Solr
+            self.assertRaises(ResolverException, resolver.resolve, 'object-1/media-9/large')
+            self.assertRaises(ResolverException, resolver.resolve, 'object-1/media-2/huge')
+            self.assertRaises(ResolverException, resolver.resolve, 'object-1')
+        self.assertEqual(len(self.solr.queries), 2)
+
+    def test_expiry_and_kept_connection(self):
+        resolver = self._resolver(resolved_ttl=0, missing_ttl=0)
+        resolver.resolve('object-1/media-3/large')
+        resolver.resolve('object-1/media-3/large')
+        self.assertEqual(len(self.solr.queries), 2)
+        # both over the same connection
+        self.assertEqual(self.solr.queries[0][1], self.solr.queries[1][1])
 
 
 def suite():
@@ -326,6 +574,7 @@ def suite():
     test_suites.append(unittest.makeSuite(Test_SourceImageCachingResolver, 'test'))
     test_suites.append(unittest.makeSuite(Test_SimpleHTTPResolver, 'test'))
     test_suites.append(unittest.makeSuite(Test_TemplateHTTPResolver, 'test'))
+    test_suites.append(unittest.makeSuite(Test_HTTPResolverConnections, 'test'))
     test_suites.append(unittest.makeSuite(Test_IwmFSResolver, 'test'))
     test_suite = unittest.TestSuite(test_suites)
     return test_suite
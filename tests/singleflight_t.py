@@ -0,0 +1,96 @@
+#-*- coding: utf-8 -*-
+
+from loris.singleflight import SingleFlight
+from os import makedirs, path, utime
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+import time
+import unittest
+
+
+"""
+SingleFlight tests. To run this test on its own, do:
+
+$ python -m unittest -v tests.singleflight_t
+
+from the `/loris` (not `/loris/loris`) directory.
+"""
+
+class Test_SingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.dp = mkdtemp()
+        makedirs(path.join(self.dp, 'a'))
+        self.target = path.join(self.dp, 'a', 'default.jpg')
+        self.calls = []
+
+    def tearDown(self):
+        rmtree(self.dp)
+
+    def _work(self, delay=0):
+        def work():
+            self.calls.append(1)
+            time.sleep(delay)
+            with open(self.target, 'w') as f:
+                f.write('x')
+        return work
+
+    def _is_done(self):
+        return path.exists(self.target)
+
+    def test_concurrent_calls_work_once(self):
+        flight = SingleFlight(timeout=5)
+        work = self._work(delay=0.2)
+        threads = [Thread(target=flight.run, args=(self.target, work, self._is_done))
+            for _ in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(self._is_done())
+        self.assertFalse(path.exists(self.target + '.lock'))
+
+    def test_waits_on_lock_file_from_another_process(self):
+        flight = SingleFlight(timeout=5, poll_interval=0.01)
+        lock_fp = self.target + '.lock'
+        self.assertTrue(flight._acquire(lock_fp))
+
+        def other_process_finishes():
+            time.sleep(0.2)
+            self._work()()
+            flight._release(lock_fp)
+        Thread(target=other_process_finishes).start()
+
+        did_work = flight.run(self.target, self._work(), self._is_done)
+        self.assertFalse(did_work)
+        self.assertEqual(len(self.calls), 1) # the "other process"
+
+    def test_does_the_work_after_timeout(self):
+        flight = SingleFlight(timeout=0.2, poll_interval=0.01)
+        lock_fp = self.target + '.lock'
+        self.assertTrue(flight._acquire(lock_fp))
+        did_work = flight.run(self.target, self._work(), self._is_done)
+        self.assertTrue(did_work)
+        self.assertTrue(self._is_done())
+
+    def test_stale_lock_is_removed(self):
+        flight = SingleFlight(timeout=1)
+        lock_fp = self.target + '.lock'
+        self.assertTrue(flight._acquire(lock_fp))
+        an_hour_ago = time.time() - 3600
+        utime(lock_fp, (an_hour_ago, an_hour_ago))
+        self.assertTrue(flight._acquire(lock_fp))
+
+    def test_nothing_to_do(self):
+        flight = SingleFlight()
+        self._work()()
+        did_work = flight.run(self.target, self._work(), self._is_done)
+        self.assertFalse(did_work)
+        self.assertEqual(len(self.calls), 1)
+
+
+def suite():
+    test_suites = []
+    test_suites.append(unittest.makeSuite(Test_SingleFlight, 'test'))
+    test_suite = unittest.TestSuite(test_suites)
+    return test_suite
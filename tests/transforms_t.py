@@ -1,7 +1,16 @@
 #-*- coding: utf-8 -*-
 
 import loris_t, operator, itertools
+from loris import img, img_info
+from loris.webapp import create_app
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+from PIL import Image, ImageChops, ImageStat
 from PIL.ImageFile import Parser
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
 from cStringIO import StringIO
 
 """
@@ -35,6 +44,180 @@ class Test_KakaduJP2Transformer(loris_t.LorisTest):
 
         self.assertEqual(expected_dims, image.size)
 
+    def _gray_request(self, region, size):
+        info = img_info.ImageInfo.from_image_file(self.test_jp2_gray_uri,
+            self.test_jp2_gray_fp, self.test_jp2_gray_fmt)
+        image_request = img.ImageRequest(self.test_jp2_gray_id, region, size,
+            '0', 'default', 'jpg')
+        image_request.info = info
+        return image_request
+
+    def test_reduce_arg_for_regions(self):
+        transformer = self.app.transformers['jp2']
+        # a deep zoom tile at 1/4
+        image_request = self._gray_request('0,0,1024,1024', '256,')
+        self.assertEqual(transformer._scales_to_reduce_arg(image_request), '2')
+        # an edge tile at 1/4
+        image_request = self._gray_request('2048,3072,429,128', '108,')
+        self.assertEqual(transformer._scales_to_reduce_arg(image_request), '2')
+        # a little too big for 1/4
+        image_request = self._gray_request('0,0,1024,1024', '257,')
+        self.assertEqual(transformer._scales_to_reduce_arg(image_request), '1')
+        # full resolution
+        image_request = self._gray_request('0,0,256,256', '256,')
+        self.assertEqual(transformer._scales_to_reduce_arg(image_request), '0')
+        # still works for the full region
+        image_request = self._gray_request('full', '310,')
+        self.assertEqual(transformer._scales_to_reduce_arg(image_request), '3')
+
+    def test_reduced_region_request(self):
+        for params, expected_dims in (
+                ('0,0,1024,1024/256,', (256, 256)),
+                ('2048,3072,429,128/108,', (108, 32)),
+                ('pct:10,10,50,50/300,', (300, 387))
+            ):
+            request_path = '/%s/%s/0/default.jpg' % (self.test_jp2_gray_id, params)
+            resp = self.client.get(request_path)
+            self.assertEqual(resp.status_code, 200)
+            p = Parser()
+            p.feed(resp.data)
+            image = p.close()
+            self.assertEqual(image.size, expected_dims)
+
+class Test_OPJ_LibJP2Transformer(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_OPJ_LibJP2Transformer, self).setUp()
+        self.app = create_app(debug=True, debug_jp2_transformer='opjlib')
+        self.client = Client(self.app, BaseResponse)
+
+    def _get_image(self, request_path):
+        resp = self.client.get(request_path)
+        self.assertEqual(resp.status_code, 200)
+        p = Parser()
+        p.feed(resp.data)
+        return p.close()
+
+    def test_is_configured(self):
+        transformer = self.app.transformers['jp2']
+        self.assertEqual(transformer.__class__.__name__, 'OPJ_LibJP2Transformer')
+
+    def test_reduced_region_request(self):
+        for params, expected_dims in (
+                ('full/full', (2477, 3200)),
+                ('0,0,1024,1024/256,', (256, 256)),
+                ('2048,3072,429,128/108,', (108, 32)),
+                ('pct:10,10,50,50/300,', (300, 387))
+            ):
+            request_path = '/%s/%s/0/default.jpg' % (self.test_jp2_gray_id, params)
+            image = self._get_image(request_path)
+            self.assertEqual(image.size, expected_dims)
+
+    def test_matches_kdu_expand(self):
+        # Compare full-res regions with what the Kakadu transformer makes of
+        # them (rendered afresh, not served from the cache this one filled).
+        kdu_app = create_app(debug=True)
+        kdu_app.enable_caching = False
+        kdu_client = Client(kdu_app, BaseResponse)
+        for region in ('0,0,256,256', '2048,3072,429,128'):
+            request_path = '/%s/%s/full/0/default.png' % (self.test_jp2_gray_id, region)
+            image = self._get_image(request_path).convert('L')
+            resp = kdu_client.get(request_path)
+            self.assertEqual(resp.status_code, 200)
+            p = Parser()
+            p.feed(resp.data)
+            reference = p.close().convert('L')
+            self.assertEqual(image.size, reference.size)
+            # Two decoders may round the odd sample differently, but a
+            # misplaced or mis-scaled region would be far out.
+            diff = ImageStat.Stat(ImageChops.difference(image, reference)).mean
+            self.assertTrue(max(diff) < 1, diff)
+
+    def test_color_with_embedded_profile(self):
+        ident = self.test_jp2_with_embedded_profile_id
+        image = self._get_image('/%s/full/full/0/default.jpg' % (ident,))
+        self.assertEqual(image.mode, 'RGB')
+
+    def test_source_is_kept_open(self):
+        decoder = self.app.transformers['jp2'].decoder
+        first = decoder.sources.get(self.test_jp2_gray_fp)
+        decoder.decode(self.test_jp2_gray_fp, (0, 0, 64, 64), 0)
+        self.assertIs(decoder.sources.get(self.test_jp2_gray_fp), first)
+
+class Test_JPG_Transformer(loris_t.LorisTest):
+
+    def _jpeg_request(self, region, size, quality='default'):
+        info = img_info.ImageInfo.from_image_file(self.test_jpeg_uri,
+            self.test_jpeg_fp, self.test_jpeg_fmt)
+        image_request = img.ImageRequest(self.test_jpeg_id, region, size,
+            '0', quality, 'jpg')
+        image_request.info = info
+        return image_request
+
+    def _derive(self, image_request, draft=True):
+        transformer = self.app.transformers['jpg']
+        transformer.decoded_cache = None
+        target_fp = path.join(self.tmp_dp, '%s.png' % ('draft' if draft else 'full',))
+        if draft:
+            transformer.transform(self.test_jpeg_fp, target_fp, image_request)
+        else:
+            im = Image.open(self.test_jpeg_fp)
+            transformer._derive_with_pil(im, target_fp, image_request)
+        image = Image.open(target_fp)
+        image.load()
+        return image
+
+    def setUp(self):
+        super(Test_JPG_Transformer, self).setUp()
+        self.tmp_dp = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp_dp)
+        super(Test_JPG_Transformer, self).tearDown()
+
+    def test_draft_scale(self):
+        transformer = self.app.transformers['jpg']
+        # 3600x2987
+        for region, size, expected in (
+                ('full', 'full', 1),
+                ('full', '450,', 8),
+                ('full', '451,', 4),
+                ('full', '1800,', 2),
+                ('full', '1801,', 1),
+                ('0,0,1024,1024', '256,', 4),
+                ('0,0,1024,1024', '128,', 8),
+                ('0,0,256,256', '256,', 1)
+            ):
+            image_request = self._jpeg_request(region, size)
+            self.assertEqual(transformer._draft_scale(image_request), expected,
+                '%s/%s' % (region, size))
+
+    def test_draft_gives_requested_size(self):
+        for region, size, expected_dims in (
+                ('full', '450,', (450, 373)),
+                ('full', '300,', (300, 248)),
+                ('0,0,1024,1024', '256,', (256, 256)),
+                ('3000,2500,600,487', '70,', (70, 56)),
+                ('pct:10,10,50,50', '300,', (300, 248))
+            ):
+            image = self._derive(self._jpeg_request(region, size))
+            self.assertEqual(image.size, expected_dims, '%s/%s' % (region, size))
+
+    def test_draft_matches_full_decode(self):
+        for region, size in (('1000,1000,1600,1200', '200,'), ('full', '400,')):
+            drafted = self._derive(self._jpeg_request(region, size))
+            full = self._derive(self._jpeg_request(region, size), draft=False)
+            self.assertEqual(drafted.size, full.size)
+            # DCT scaling filters differently than ANTIALIAS does, but being
+            # a pixel out would put the mean difference at ~15.
+            diff = ImageStat.Stat(ImageChops.difference(drafted, full)).mean
+            self.assertTrue(max(diff) < 10, diff)
+
+    def test_gray_decodes_luma_only(self):
+        image = self._derive(self._jpeg_request('full', '300,', 'gray'))
+        self.assertEqual(image.mode, 'L')
+        self.assertEqual(image.size, (300, 248))
+
 class Test_PILTransformer(loris_t.LorisTest):
 
     def test_png_rotate_has_alpha_transparency(self):
@@ -67,6 +250,44 @@ class Test_PILTransformer(loris_t.LorisTest):
 
         self.assertTrue(transparency)
 
+    def test_tiles_decode_the_source_once(self):
+        self.app.enable_caching = False
+        cache = self.app.transformers['tif'].decoded_cache
+        for region in ('0,0,256,256', '256,0,256,256', '0,256,256,256'):
+            request_path = '/%s/%s/full/0/default.jpg' % (self.test_tiff_id, region)
+            resp = self.client.get(request_path)
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual((cache.misses, cache.hits), (1, 2))
+
+    def test_shared_source_saved_to_two_formats_at_once(self):
+        # full/full/0/default of an RGB source would save() the decoded image
+        # as it is, so that mustn't be the one in the cache.
+        transformer = self.app.transformers['tif']
+        info = img_info.ImageInfo.from_image_file(self.test_tiff_uri,
+            self.test_tiff_fp, self.test_tiff_fmt)
+        tmp_dp = mkdtemp()
+        self.addCleanup(rmtree, tmp_dp)
+        made = {}
+        def derive(fmt):
+            image_request = img.ImageRequest(self.test_tiff_id, 'full', 'full',
+                '0', 'default', fmt)
+            image_request.info = info
+            target_fp = path.join(tmp_dp, 'full.%s' % (fmt,))
+            transformer.transform(self.test_tiff_fp, target_fp, image_request)
+            made[fmt] = target_fp
+        threads = [Thread(target=derive, args=(fmt,)) for fmt in ('jpg', 'png')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for fmt, pil_format in (('jpg', 'JPEG'), ('png', 'PNG')):
+            image = Image.open(made[fmt])
+            self.assertEqual(image.format, pil_format)
+            self.assertEqual(image.size, (info.width, info.height))
+        shared = transformer.decoded_cache.get(self.test_tiff_fp, Image.open)
+        self.assertFalse(hasattr(shared, 'encoderinfo'))
+
     """
     Return the alpha channel as a sequence of values
 
@@ -89,6 +310,8 @@ def suite():
     import unittest
     test_suites = []
     test_suites.append(unittest.makeSuite(Test_KakaduJP2Transformer, 'test'))
+    test_suites.append(unittest.makeSuite(Test_OPJ_LibJP2Transformer, 'test'))
+    test_suites.append(unittest.makeSuite(Test_JPG_Transformer, 'test'))
     test_suites.append(unittest.makeSuite(Test_PILTransformer, 'test'))
     test_suite = unittest.TestSuite(test_suites)
     return test_suite
@@ -2,15 +2,19 @@
 #-*- coding: utf-8 -*-
 
 from datetime import datetime
-from os import path, listdir
+from os import path, listdir, unlink
+from threading import Thread
 from time import sleep
 from unittest import TestCase
+from urllib import unquote
 from werkzeug.datastructures import Headers
 from werkzeug.http import http_date
-from werkzeug.test import EnvironBuilder
-from werkzeug.wrappers import Request
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import BaseResponse, Request
+import json
 import re
 import loris_t
+from loris import img
 from loris import img_info
 from loris import webapp
 from loris import loris_exception
@@ -222,7 +226,9 @@ class TestGetInfo(loris_t.LorisTest):
         req = Request(env)
         base_uri = 'http://example.org/01%2F02%2F0001.jp2'
         info, last_mod = self.app._get_info(self.test_jp2_color_id, req, base_uri)
-        self.assertEqual(info.ident, base_uri)
+        # the same info for every base_uri; it's only the @id in the json
+        self.assertEqual(info.ident, unquote(self.test_jp2_color_id))
+        self.assertEqual(json.loads(info.to_json(base_uri))['@id'], base_uri)
 
     def test_get_info_invalid_src_format(self):
         path = '/%s/' % self.test_jp2_color_id
@@ -401,7 +407,160 @@ class WebappIntegration(loris_t.LorisTest):
         resp = self.client.get(to_get, headers=headers)
         self.assertEqual(resp.status_code, 304)
 
-    def test_bad_format_returns_400(self):
+    def test_img_etag(self):
+        to_get = '/%s/full/full/0/default.jpg' % (self.test_jp2_color_id,)
+        made = self.client.get(to_get)
+        etag = made.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        hit = self.client.get(to_get)
+        self.assertEqual(hit.headers['ETag'], etag)
+        # the same derivative by another name
+        scaled = self.client.get('/%s/full/pct:10/0/default.jpg' % (self.test_jp2_color_id,))
+        other = self.client.get(self.canonical_path(scaled, self.test_jp2_color_id))
+        self.assertEqual(other.headers['ETag'], scaled.headers['ETag'])
+        self.assertNotEqual(other.headers['ETag'], etag)
+
+        resp = self.client.get(to_get, headers=Headers([('If-None-Match', etag)]))
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.data, '')
+
+        # If-None-Match wins over If-Modified-Since
+        headers = Headers([('If-None-Match', '"nope"'),
+            ('If-Modified-Since', made.headers['Last-Modified'])])
+        resp = self.client.get(to_get, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, made.data)
+
+    def test_info_etag(self):
+        to_get = '/%s/info.json' % (self.test_jp2_color_id,)
+        plain = self.client.get(to_get)
+        etag = plain.headers['ETag']
+        resp = self.client.get(to_get, headers=Headers([('If-None-Match', etag)]))
+        self.assertEqual(resp.status_code, 304)
+
+        # other representations, other tags
+        gzipped = self.client.get(to_get, headers=Headers([('Accept-Encoding', 'gzip')]))
+        jsonp = self.client.get(to_get + '?callback=cb')
+        other_host = self.client.get(to_get, base_url='https://example.org/')
+        tags = set(r.headers['ETag'] for r in (plain, gzipped, jsonp, other_host))
+        self.assertEqual(len(tags), 4)
+
+        resp = self.client.get(to_get, headers=Headers([('If-None-Match', '*')]))
+        self.assertEqual(resp.status_code, 304)
+
+    def test_img_hit_uses_file_wrapper(self):
+        # without the RAM tier, which would have the second hit
+        self.app.img_cache = img.ImageCache(self.app.img_cache.cache_root)
+        to_get = '/%s/full/full/0/default.jpg' % (self.test_jp2_color_id,)
+        self.client.get(to_get)
+        wrapped = []
+        def file_wrapper(f, block_size):
+            wrapped.append(f)
+            return iter(lambda: f.read(block_size), '')
+        environ = EnvironBuilder(path=to_get).get_environ()
+        environ['wsgi.file_wrapper'] = file_wrapper
+        app_iter = self.app(environ, lambda status, headers: None)
+        self.assertEqual(len(wrapped), 1)
+        self.assertTrue(len(''.join(app_iter)) > 0)
+
+    def test_img_hit_skips_resolver(self):
+        scaled = '/%s/full/pct:10/0/default.jpg' % (self.test_jp2_color_id,)
+        made = self.client.get(scaled)
+        canonical = self.canonical_path(made, self.test_jp2_color_id)
+        class Unreachable(object):
+            def resolve(self, ident):
+                raise AssertionError('resolved %s on a cache hit' % (ident,))
+        self.app.resolver = Unreachable()
+        # by its symlink, and by its canonical path, both made above
+        for to_get in (scaled, canonical):
+            hit = self.client.get(to_get)
+            self.assertEqual(hit.status_code, 200)
+            self.assertEqual(hit.headers['Link'], made.headers['Link'])
+
+    def test_img_range(self):
+        to_get = '/%s/full/full/0/default.jpg' % (self.test_jp2_color_id,)
+        full = self.client.get(to_get)
+        size = len(full.data)
+        self.assertEqual(full.headers['Accept-Ranges'], 'bytes')
+
+        resp = self.client.get(to_get, headers=Headers([('Range', 'bytes=100-199')]))
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, full.data[100:200])
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 100-199/%d' % (size,))
+        self.assertEqual(int(resp.headers['Content-Length']), 100)
+
+        resp = self.client.get(to_get, headers=Headers([('Range', 'bytes=-10'),
+            ('If-Range', full.headers['ETag'])]))
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, full.data[-10:])
+
+        # the derivative has changed since
+        resp = self.client.get(to_get, headers=Headers([('Range', 'bytes=0-9'),
+            ('If-Range', '"nope"')]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, full.data)
+
+        # more than one range isn't done
+        resp = self.client.get(to_get, headers=Headers([('Range', 'bytes=0-9,20-29')]))
+        self.assertEqual(resp.status_code, 200)
+
+    def test_img_offload(self):
+        to_get = '/%s/full/full/0/default.jpg' % (self.test_jp2_color_id,)
+        image_request = img.ImageRequest(self.test_jp2_color_id, 'full', 'full',
+            '0', 'default', 'jpg')
+        made = self.client.get(to_get)
+        fp = self.app.img_cache.lookup(image_request)[0]
+
+        self.app.offload = 'X-Sendfile'
+        resp = self.client.get(to_get)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['X-Sendfile'], fp)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], made.headers['ETag'])
+
+        self.app.offload = 'X-Accel-Redirect'
+        self.app.offload_prefix = '/cache/'
+        resp = self.client.get(to_get)
+        rel = path.relpath(fp, self.app.offload_root)
+        self.assertEqual(resp.headers['X-Accel-Redirect'], '/cache/%s' % (rel,))
+        self.assertEqual(resp.data, '')
+
+    def test_img_evicted_as_soon_as_made(self):
+        class Forgetful(img.PackImageCache):
+            def _put_file(self, image_request, fp):
+                pass # and keep nothing
+        self.app.img_cache = Forgetful(self.app.img_cache.cache_root)
+        resp = self.client.get('/%s/full/pct:10/0/default.jpg' % (self.test_jp2_color_id,))
+        self.assertEqual(resp.status_code, 500)
+
+    def test_img_unlinked_as_soon_as_made(self):
+        to_get = '/%s/full/full/0/default.jpg' % (self.test_jp2_color_id,)
+        unlinked = []
+        class Unlinking(img.ImageCache):
+            # as though it were evicted between the lookup and the open()
+            def lookup(self, image_request):
+                found = super(Unlinking, self).lookup(image_request)
+                if found is not None and len(unlinked) < self.unlinks:
+                    unlink(found[0])
+                    unlinked.append(found[0])
+                return found
+        cache_root = self.app.img_cache.cache_root
+
+        self.app.img_cache = Unlinking(cache_root)
+        self.app.img_cache.unlinks = 1
+        resp = self.client.get(to_get)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(unlinked), 1)
+        self.assertEqual(len(resp.data), int(resp.headers['Content-Length']))
+
+        del unlinked[:]
+        self.app.img_cache = Unlinking(cache_root)
+        self.app.img_cache.unlinks = 3
+        resp = self.client.get(to_get)
+        self.assertEqual(resp.status_code, 500)
+
+
         to_get = '/%s/full/full/0/default.hey' % (self.test_jp2_color_id,)
         resp = self.client.get(to_get)
         self.assertEqual(resp.status_code, 400)
@@ -431,6 +590,28 @@ class WebappIntegration(loris_t.LorisTest):
         resp = self.client.get(to_get)
         self.assertEqual(resp.status_code, 400)
 
+    def test_concurrent_requests_render_once(self):
+        transformer = self.app.transformers['tif']
+        transform = transformer.transform
+        calls = []
+        def slow_transform(*args):
+            calls.append(1)
+            sleep(0.2)
+            transform(*args)
+        transformer.transform = slow_transform
+
+        to_get = '/%s/full/100,/0/default.jpg' % (self.test_tiff_id,)
+        statuses = []
+        def get():
+            client = Client(self.app, BaseResponse)
+            statuses.append(client.get(to_get).status_code)
+        threads = [Thread(target=get) for _ in range(5)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertEqual(statuses, [200]*5)
+        self.assertEqual(len(calls), 1)
+
     def test_cleans_up_when_not_caching(self):
         self.app.enable_caching = False
         to_get = '/%s/full/full/0/default.jpg' % (self.test_jp2_color_id,)